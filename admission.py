@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Admission control for the AI Energy Optimizer
+Per-route concurrency limits with a bounded wait queue, load shedding with Retry-After,
+and request body size and time limits
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_MAX_CONCURRENT = 64
+DEFAULT_MAX_QUEUE = 128
+DEFAULT_QUEUE_TIMEOUT = 2.0
+
+# Per-request socket read timeout once a request has started; the idle
+# keep-alive timeout between requests is the handler's own ``timeout``
+DEFAULT_READ_TIMEOUT = 10.0
+# Whole-body deadline, so a client trickling bytes cannot hold a slot forever
+DEFAULT_BODY_TIMEOUT = 60.0
+DEFAULT_MAX_BODY_BYTES = 1024 * 1024
+
+# Never queued or counted: probes and scrapes must answer while the server is busy
+PRIORITY_ROUTES = ('/', '/health', '/metrics')
+
+# Concurrent requests per route; CPU-heavy and long-running routes get few
+ROUTE_LIMITS = {
+    '/optimize': 4,
+    '/schedule': 4,
+    '/telemetry/export': 4,
+    '/devices/batch': 8,
+    '/telemetry/ingest': 16,
+    '/predictions': 32,
+    '/analytics/summary': 32,
+}
+
+# Bodies larger than the default; ingest is parsed as it streams in
+BODY_LIMITS = {
+    '/telemetry/ingest': 256 * 1024 * 1024,
+    '/devices/batch': 8 * 1024 * 1024,
+}
+BODY_TIMEOUTS = {
+    '/telemetry/ingest': 600.0,
+}
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed; carries the status and Retry-After seconds"""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class BodyLimitError(Exception):
+    """Raised while reading a body that is too large (413) or too slow (408)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LimitedReader:
+    """Wraps a body stream, failing once it passes ``limit`` bytes or ``deadline``"""
+
+    def __init__(self, stream, limit, deadline):
+        self._stream = stream
+        self._limit = limit
+        self._deadline = deadline
+        self._read = 0
+
+    def _check(self, data):
+        self._read += len(data)
+        if self._read > self._limit:
+            raise BodyLimitError(413, f"Request body exceeds {self._limit} bytes")
+        if time.monotonic() > self._deadline:
+            raise BodyLimitError(408, "Request body was not received in time")
+        return data
+
+    def read(self, n=-1):
+        if n < 0:
+            # Bounded even when the whole body is asked for
+            n = self._limit - self._read + 1
+        return self._check(self._stream.read(n))
+
+    def readline(self, limit=-1):
+        return self._check(self._stream.readline(limit))
+
+
+class _RouteState:
+    __slots__ = ('limit', 'active', 'waiting', 'admitted', 'rejected')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {}
+
+
+class AdmissionController:
+    """Bounds concurrent work per route and overall, queueing briefly before shedding
+
+    A request runs when both its route and the server have a free slot.
+    Otherwise it waits, up to ``queue_timeout`` seconds, in a queue of at
+    most ``max_queue`` requests. A request is rejected straight away with
+    429 when its route already has as many waiting as running, and with
+    503 when the queue is full or the wait runs out. Rejections carry a
+    Retry-After hint. ``PRIORITY_ROUTES`` bypass admission entirely, so
+    /health never waits behind /optimize.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, max_queue=DEFAULT_MAX_QUEUE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, route_limits=None,
+                 priority_routes=PRIORITY_ROUTES):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.route_limits = dict(ROUTE_LIMITS if route_limits is None else route_limits)
+        self.priority_routes = frozenset(priority_routes)
+        self.read_timeout = DEFAULT_READ_TIMEOUT
+        self.body_timeout = DEFAULT_BODY_TIMEOUT
+        self.max_body_bytes = DEFAULT_MAX_BODY_BYTES
+        self.body_limits = dict(BODY_LIMITS)
+        self.body_timeouts = dict(BODY_TIMEOUTS)
+        self._condition = threading.Condition()
+        self._routes = {}
+        self._active = 0
+        self._waiting = 0
+
+    def configure(self, max_concurrent=None, max_queue=None, queue_timeout=None,
+                  route_limits=None, read_timeout=None, max_body_bytes=None):
+        """Change limits; ``route_limits`` entries are merged into the current ones"""
+        with self._condition:
+            if max_concurrent is not None:
+                self.max_concurrent = max(1, int(max_concurrent))
+            if max_queue is not None:
+                self.max_queue = max(0, int(max_queue))
+            if queue_timeout is not None:
+                self.queue_timeout = max(0.0, float(queue_timeout))
+            if route_limits:
+                self.route_limits.update(route_limits)
+                for route, limit in route_limits.items():
+                    if route in self._routes:
+                        self._routes[route].limit = limit
+            if read_timeout is not None:
+                self.read_timeout = float(read_timeout)
+            if max_body_bytes is not None:
+                self.max_body_bytes = int(max_body_bytes)
+            self._condition.notify_all()
+
+    # ------------------------------------------------------------------
+    # Body limits
+    # ------------------------------------------------------------------
+
+    def body_limit(self, route):
+        return self.body_limits.get(route, self.max_body_bytes)
+
+    def limit_body(self, stream, route):
+        """``stream`` wrapped with the route's size limit and whole-body deadline"""
+        deadline = time.monotonic() + self.body_timeouts.get(route, self.body_timeout)
+        return LimitedReader(stream, self.body_limit(route), deadline)
+
+    # ------------------------------------------------------------------
+    # Concurrency
+    # ------------------------------------------------------------------
+
+    def _route(self, route):
+        state = self._routes.get(route)
+        if state is None:
+            state = self._routes[route] = _RouteState(self.route_limits.get(route, self.max_concurrent))
+        return state
+
+    def _retry_after(self):
+        return max(1, math.ceil(self.queue_timeout))
+
+    def _reject(self, state, status, message):
+        state.rejected[status] = state.rejected.get(status, 0) + 1
+        raise Overloaded(status, message, self._retry_after())
+
+    @contextmanager
+    def slot(self, route):
+        """Hold a slot for ``route`` while the block runs; raises Overloaded when shed"""
+        if route in self.priority_routes:
+            yield
+            return
+        with self._condition:
+            state = self._route(route)
+            if self._active >= self.max_concurrent or state.active >= state.limit:
+                if state.waiting >= state.limit:
+                    self._reject(state, 429, f"Too many concurrent requests for {route}")
+                if self._waiting >= self.max_queue:
+                    self._reject(state, 503, "Server is overloaded")
+                deadline = time.monotonic() + self.queue_timeout
+                state.waiting += 1
+                self._waiting += 1
+                try:
+                    while self._active >= self.max_concurrent or state.active >= state.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject(state, 503, "Server is overloaded")
+                        self._condition.wait(remaining)
+                finally:
+                    state.waiting -= 1
+                    self._waiting -= 1
+            state.active += 1
+            state.admitted += 1
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                state.active -= 1
+                self._active -= 1
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "routes": {route: {"active": state.active, "waiting": state.waiting,
+                                   "limit": state.limit, "admitted": state.admitted,
+                                   "rejected": dict(state.rejected)}
+                           for route, state in self._routes.items()}
+            }
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Usage analytics for the AI Energy Optimizer
+Per-minute, hourly and daily rollups maintained incrementally as telemetry arrives
+"""
+
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from telemetry import MAX_CLOCK_SKEW
+
+# (name, bucket seconds, buckets kept per device, buckets kept per location/type/fleet)
+GRANULARITIES = (
+    ('minute', 60, 120, 2880),
+    ('hour', 3600, 168, 24 * 90),
+    ('day', 86400, 62, 730),
+)
+DEFAULT_RANGE_SECONDS = 7 * 86400
+PEAK_HOUR_SHARE = 0.8
+
+FLEET = 0
+SCOPE_KINDS = ('fleet', 'location', 'device_type')
+
+
+def _unique_cells(cells, buckets):
+    """Collapse readings that hit the same ring cell, keeping the newest bucket
+
+    Returns ``(unique_cells, inverse, newest_bucket_per_cell)``.
+    """
+    unique, inverse = np.unique(cells, return_inverse=True)
+    newest = np.full(len(unique), -1, dtype=np.int64)
+    np.maximum.at(newest, inverse, buckets)
+    return unique, inverse, newest
+
+
+def parse_time(value):
+    """Epoch seconds from a query value: a number or an ISO-8601 string"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class _DeviceLevel:
+    """Ring buffers of count/sum/min/max per device for one granularity"""
+
+    def __init__(self, seconds, retention):
+        self.seconds = seconds
+        self.retention = retention
+        self.bucket = np.full((0, retention), -1, dtype=np.int64)
+        self.count = np.zeros((0, retention), dtype=np.int64)
+        self.total = np.zeros((0, retention))
+        self.low = np.zeros((0, retention))
+        self.high = np.zeros((0, retention))
+
+    def grow(self, rows):
+        extra = rows - self.bucket.shape[0]
+        shape = (extra, self.retention)
+        self.bucket = np.concatenate((self.bucket, np.full(shape, -1, dtype=np.int64)))
+        self.count = np.concatenate((self.count, np.zeros(shape, dtype=np.int64)))
+        self.total = np.concatenate((self.total, np.zeros(shape)))
+        self.low = np.concatenate((self.low, np.full(shape, np.inf)))
+        self.high = np.concatenate((self.high, np.full(shape, -np.inf)))
+
+
+class _AggregateLevel:
+    """Ring buffers of energy (kWh) per location, device type and fleet"""
+
+    def __init__(self, seconds, retention):
+        self.seconds = seconds
+        self.retention = retention
+        self.bucket = np.full((0, retention), -1, dtype=np.int64)
+        self.energy = np.zeros((0, retention))
+
+    def grow(self, scopes):
+        extra = scopes - self.bucket.shape[0]
+        shape = (extra, self.retention)
+        self.bucket = np.concatenate((self.bucket, np.full(shape, -1, dtype=np.int64)))
+        self.energy = np.concatenate((self.energy, np.zeros(shape)))
+
+    def add(self, scopes, buckets, energy):
+        """Add energy deltas, resetting cells that roll over to a newer bucket"""
+        cells = scopes * self.retention + buckets % self.retention
+        unique, inverse, newest = _unique_cells(cells, buckets)
+        flat_bucket = self.bucket.reshape(-1)
+        flat_energy = self.energy.reshape(-1)
+        stored = flat_bucket[unique]
+        stale = stored < newest
+        flat_energy[unique[stale]] = 0.0
+        flat_bucket[unique[stale]] = newest[stale]
+        # Drop deltas for buckets older than what the cell now holds
+        keep = buckets == flat_bucket[cells]
+        np.add.at(flat_energy, cells[keep], energy[keep])
+
+    def series(self, scope, first, last):
+        """Energy per bucket in ``[first, last]``; missing buckets are NaN"""
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        positions = buckets % self.retention
+        present = self.bucket[scope, positions] == buckets
+        return buckets, np.where(present, self.energy[scope, positions], np.nan)
+
+
+class RollupStore:
+    """Incrementally maintained usage rollups
+
+    Each ingested batch updates per-device minute/hour/day buckets (count,
+    sum, min, max of power) and, through the change in each bucket's mean
+    power, the energy buckets of the device's location, its device type and
+    the whole fleet. Every structure is a fixed-size ring, so memory is
+    bounded and a summary only reads the buckets in the requested range.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._scope_rows = np.zeros((0, len(SCOPE_KINDS)), dtype=np.intp)
+        self._scopes = {('fleet', ''): FLEET}
+        self._device_levels = {}
+        self._aggregate_levels = {}
+        for name, seconds, device_keep, aggregate_keep in GRANULARITIES:
+            self._device_levels[name] = _DeviceLevel(seconds, device_keep)
+            level = self._aggregate_levels[name] = _AggregateLevel(seconds, aggregate_keep)
+            level.grow(1)
+
+    def _scope(self, kind, key):
+        index = self._scopes.get((kind, key))
+        if index is None:
+            index = self._scopes[(kind, key)] = len(self._scopes)
+            for level in self._aggregate_levels.values():
+                level.grow(index + 1)
+        return index
+
+    def _row(self, device_id):
+        row = self._rows.get(device_id)
+        if row is None:
+            device = self.registry.get(device_id) or {}
+            row = self._rows[device_id] = len(self._rows)
+            scopes = (FLEET,
+                      self._scope('location', device.get('location', 'unknown')),
+                      self._scope('device_type', device.get('device_type', 'other')))
+            if row >= len(self._scope_rows):
+                capacity = max(64, 2 * (row + 1))
+                self._scope_rows = np.concatenate(
+                    (self._scope_rows, np.zeros((capacity - row, len(SCOPE_KINDS)), dtype=np.intp)))
+                for level in self._device_levels.values():
+                    level.grow(capacity)
+            self._scope_rows[row] = scopes
+        return row
+
+    # ------------------------------------------------------------------
+    # Ingest
+    # ------------------------------------------------------------------
+
+    def observe(self, readings):
+        """Fold a batch of ``(device_id, timestamp, power)`` readings into the rollups"""
+        if not readings:
+            return
+        ids, timestamps, powers = zip(*readings)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        powers = np.asarray(powers, dtype=np.float64)
+        # A reading from the far future would claim its ring cells ahead of the present
+        current = timestamps <= time.time() + MAX_CLOCK_SKEW
+        if not current.all():
+            ids = [device_id for device_id, keep in zip(ids, current.tolist()) if keep]
+            timestamps, powers = timestamps[current], powers[current]
+            if not ids:
+                return
+        with self._lock:
+            rows = np.fromiter((self._row(i) for i in ids), dtype=np.intp, count=len(ids))
+            for name, level in self._device_levels.items():
+                self._update(level, self._aggregate_levels[name], rows, timestamps, powers)
+
+    def _update(self, level, aggregate, rows, timestamps, powers):
+        retention = level.retention
+        buckets = (timestamps // level.seconds).astype(np.int64)
+        cells = rows * retention + buckets % retention
+        unique, inverse, newest = _unique_cells(cells, buckets)
+
+        flat_bucket = level.bucket.reshape(-1)
+        flat_count = level.count.reshape(-1)
+        flat_total = level.total.reshape(-1)
+        flat_low = level.low.reshape(-1)
+        flat_high = level.high.reshape(-1)
+
+        stored = flat_bucket[unique]
+        usable = stored <= newest
+        stale = stored < newest
+        old_mean = np.where(~stale & (flat_count[unique] > 0),
+                            flat_total[unique] / np.maximum(flat_count[unique], 1), 0.0)
+
+        reset = unique[stale]
+        flat_bucket[reset] = newest[stale]
+        flat_count[reset] = 0
+        flat_total[reset] = 0.0
+        flat_low[reset] = np.inf
+        flat_high[reset] = -np.inf
+
+        keep = (buckets == newest[inverse]) & usable[inverse]
+        target = cells[keep]
+        values = powers[keep]
+        np.add.at(flat_count, target, 1)
+        np.add.at(flat_total, target, values)
+        np.minimum.at(flat_low, target, values)
+        np.maximum.at(flat_high, target, values)
+
+        # Energy of a bucket is its mean power times its length
+        touched = unique[usable]
+        new_mean = flat_total[touched] / np.maximum(flat_count[touched], 1)
+        delta = (new_mean - old_mean[usable]) * (level.seconds / 3600.0)
+        scope_rows = self._scope_rows[touched // retention]
+        touched_buckets = newest[usable]
+        for column in range(len(SCOPE_KINDS)):
+            aggregate.add(scope_rows[:, column], touched_buckets, delta)
+
+    def load_from_store(self, store, device_ids=None, since=0.0):
+        """Rebuild rollups from stored readings, one device at a time"""
+        if device_ids is None:
+            device_ids = [device['device_id'] for device in self.registry.to_list()]
+        for device_id in device_ids:
+            rows = store.readings(device_id, since)
+            if rows:
+                self.observe([(device_id, ts, power) for ts, power in rows])
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def energy_series(self, granularity, start, end, location=None, device_type=None):
+        """``(bucket_starts, kWh)`` for buckets overlapping ``[start, end)``
+
+        Buckets without data are NaN. A single filter reads the matching
+        aggregate ring; combining both filters sums the matching devices.
+        Ranges longer than the ring's retention raise ValueError, and the
+        range ends no later than the current time.
+        """
+        aggregate = self._aggregate_levels[granularity]
+        both = location is not None and device_type is not None
+        level = self._device_levels[granularity] if both else aggregate
+        seconds = level.seconds
+        if end - start > level.retention * seconds:
+            raise ValueError(f"range exceeds the {level.retention} {granularity} buckets kept")
+        first = int(start // seconds)
+        last = min(int((end - 1) // seconds), int((time.time() + MAX_CLOCK_SKEW) // seconds))
+        with self._lock:
+            if both:
+                return self._device_energy(granularity, first, last, location, device_type)
+            if location is not None:
+                scope = self._scopes.get(('location', location))
+            elif device_type is not None:
+                scope = self._scopes.get(('device_type', device_type))
+            else:
+                scope = FLEET
+            if scope is None:
+                buckets = np.arange(first, last + 1, dtype=np.int64)
+                return buckets * seconds, np.full(len(buckets), np.nan)
+            buckets, energy = aggregate.series(scope, first, last)
+        return buckets * seconds, energy
+
+    def _device_energy(self, granularity, first, last, location, device_type):
+        level = self._device_levels[granularity]
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        positions = buckets % level.retention
+        energy = np.full(len(buckets), np.nan)
+        ids = self.registry.find_ids(device_type=device_type, location=location)
+        rows = [self._rows[i] for i in ids if i in self._rows]
+        if rows:
+            rows = np.asarray(rows, dtype=np.intp)[:, None]
+            present = level.bucket[rows, positions] == buckets
+            means = level.total[rows, positions] / np.maximum(level.count[rows, positions], 1)
+            contribution = np.where(present, means * (level.seconds / 3600.0), 0.0)
+            any_present = present.any(axis=0)
+            energy[any_present] = contribution.sum(axis=0)[any_present]
+        return buckets * level.seconds, energy
+
+    def summary(self, start=None, end=None, location=None, device_type=None):
+        """Usage summary over ``[start, end)`` from the hourly and daily rollups"""
+        end = time.time() if end is None else end
+        start = end - DEFAULT_RANGE_SECONDS if start is None else start
+        if start >= end:
+            raise ValueError("start must be before end")
+
+        _, hourly = self.energy_series('hour', start, end, location, device_type)
+        _, daily = self.energy_series('day', start, end, location, device_type)
+        hourly = hourly[~np.isnan(hourly)]
+        daily = daily[~np.isnan(daily)]
+
+        if hourly.size:
+            peak = float(hourly.max())
+            mean = float(hourly.mean())
+            minimum = float(hourly.min())
+            peak_hours = int(np.count_nonzero(hourly >= PEAK_HOUR_SHARE * peak)) if peak > 0 else 0
+            # Load factor: a flat profile uses capacity efficiently
+            efficiency = 100.0 * mean / peak if peak > 0 else 0.0
+        else:
+            peak = mean = minimum = efficiency = 0.0
+            peak_hours = 0
+
+        return {
+            "average_daily_usage": round(float(daily.mean()) if daily.size else 0.0, 2),
+            "peak_usage": round(peak, 2),
+            "min_usage": round(minimum, 2),
+            "peak_hours_count": peak_hours,
+            "efficiency_score": round(efficiency, 1),
+            "total_usage": round(float(hourly.sum()), 2),
+            "hours_with_data": int(hourly.size),
+            "range": {
+                "start": datetime.fromtimestamp(start).isoformat(),
+                "end": datetime.fromtimestamp(end).isoformat()
+            },
+            "location": location,
+            "device_type": device_type
+        }
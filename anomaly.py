@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Anomaly detection for the AI Energy Optimizer
+Streaming per-device checks of power readings against rolling (EWMA) statistics and
+hour-of-week baselines, raising alerts that /anomalies lists and /optimize acts on
+"""
+
+import itertools
+import math
+import threading
+from array import array
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from device_registry import iter_changes
+
+HOUR_SECONDS = 3600.0
+HOURS_PER_WEEK = 168
+
+# Rolling statistics follow roughly the last 1/alpha readings; each
+# hour-of-week cell follows roughly its last 1/alpha readings
+EWMA_ALPHA = 0.05
+SEASONAL_ALPHA = 0.1
+# Anomalous readings move the baselines this much less, so a device stuck
+# on is not learned as normal within the hour
+OUTLIER_WEIGHT = 0.1
+
+Z_THRESHOLD = 4.0
+MIN_SAMPLES = 10
+MIN_SEASONAL_SAMPLES = 3
+# Consecutive readings needed to open an alert, and to resolve one
+ALERT_READINGS = 3
+# Spread never counts as smaller than this, so quiet devices do not alert on noise
+MIN_STD_KW = 0.01
+RELATIVE_STD = 0.1
+MAX_RESOLVED = 1000
+# A vectorized pass costs about as much as this many readings run one by one;
+# smaller passes (a few devices with long histories) use the scalar loop
+MIN_PASS_ROWS = 64
+MAX_LIMIT = 1000
+
+KINDS = {1: 'high_usage', -1: 'low_usage'}
+
+# What /optimize recommends for a device drawing more than its baseline
+RECOMMENDED_ACTIONS = {
+    'thermostat': 'check_thermostat_schedule',
+    'lighting': 'turn_off_lights',
+    'hvac': 'inspect_hvac',
+    'appliances': 'check_appliance',
+}
+DEFAULT_ACTION = 'check_device'
+
+
+def _utc_offset_seconds():
+    offset = datetime.now().astimezone().utcoffset()
+    return offset.total_seconds() if offset else 0.0
+
+
+def hour_of_week(timestamps, utc_offset=0.0):
+    """Local hour of the week for epoch timestamps, 0 being Monday midnight"""
+    hours = (np.asarray(timestamps, dtype=np.float64) + utc_offset) // HOUR_SECONDS
+    # Epoch day 0 was a Thursday, 72 hours into its week
+    return ((hours + 72) % HOURS_PER_WEEK).astype(np.intp)
+
+
+def _ranks(rows):
+    """Position of each reading among earlier readings of the same row"""
+    order = np.argsort(rows, kind='stable')
+    ordered = rows[order]
+    starts = np.flatnonzero(np.concatenate(([True], ordered[1:] != ordered[:-1])))
+    sizes = np.diff(np.append(starts, len(rows)))
+    ranks = np.empty(len(rows), dtype=np.intp)
+    ranks[order] = np.arange(len(rows)) - np.repeat(starts, sizes)
+    return ranks
+
+
+class AnomalyDetector:
+    """Online anomaly detection over every device's power readings
+
+    Each device keeps an exponentially weighted mean and variance, plus one
+    for each of the 168 hours of the week. A reading is scored against its
+    hour-of-week baseline once that cell has seen a few readings, and
+    against the rolling statistics until then. ``ALERT_READINGS``
+    consecutive scores beyond ``Z_THRESHOLD`` in one direction open an
+    alert; as many ordinary readings resolve it. State is fixed-size
+    arrays per device and each batch is applied with vectorized NumPy
+    operations, so the cost per reading does not grow with history. When
+    a batch holds many readings for a few devices, those are run through
+    a scalar loop per device instead of one NumPy pass per reading.
+    """
+
+    def __init__(self, registry, utc_offset=None):
+        self.registry = registry
+        self.utc_offset = _utc_offset_seconds() if utc_offset is None else utc_offset
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._ids = []
+        self._listeners = []
+        self._alert_ids = itertools.count(1)
+        self._open = {}
+        self._resolved = deque(maxlen=MAX_RESOLVED)
+        self.opened_total = 0
+        self.readings_total = 0
+        self._allocate(0)
+        registry.add_listener(self._on_devices)
+
+    def _allocate(self, capacity):
+        def grow(array, fill=0):
+            extra = np.full((capacity - len(array),) + array.shape[1:], fill, dtype=array.dtype)
+            return np.concatenate((array, extra))
+
+        if capacity == 0:
+            self._count = np.zeros(0, dtype=np.int64)
+            self._mean = np.zeros(0)
+            self._var = np.zeros(0)
+            self._season_count = np.zeros((0, HOURS_PER_WEEK), dtype=np.uint8)
+            self._season_mean = np.zeros((0, HOURS_PER_WEEK), dtype=np.float32)
+            self._season_var = np.zeros((0, HOURS_PER_WEEK), dtype=np.float32)
+            self._streak = np.zeros(0, dtype=np.int32)
+            self._calm = np.zeros(0, dtype=np.int32)
+            self._state = np.zeros(0, dtype=np.int8)
+            self._peak = np.zeros(0)
+            self._anomalous = np.zeros(0, dtype=np.int64)
+            self._last_power = np.zeros(0)
+            self._last_expected = np.zeros(0)
+            self._last_seen = np.zeros(0)
+            return
+        for name in ('_count', '_mean', '_var', '_season_count', '_season_mean', '_season_var',
+                     '_streak', '_calm', '_state', '_peak', '_anomalous', '_last_power',
+                     '_last_expected', '_last_seen'):
+            setattr(self, name, grow(getattr(self, name)))
+
+    def _row(self, device_id):
+        row = self._rows.get(device_id)
+        if row is None:
+            row = self._rows[device_id] = len(self._ids)
+            self._ids.append(device_id)
+            if row >= len(self._count):
+                self._allocate(max(64, 2 * (row + 1)))
+        return row
+
+    def add_listener(self, callback):
+        """Call ``callback(event, alert)`` when an alert is 'opened' or 'resolved'"""
+        self._listeners.append(callback)
+
+    # ------------------------------------------------------------------
+    # Ingest
+    # ------------------------------------------------------------------
+
+    def observe(self, readings):
+        """Score and learn from a batch of ``(device_id, timestamp, power)`` readings"""
+        if not readings:
+            return
+        ids, timestamps, powers = zip(*readings)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        powers = np.asarray(powers, dtype=np.float64)
+        events = []
+        with self._lock:
+            rows = np.fromiter((self._row(i) for i in ids), dtype=np.intp, count=len(ids))
+            ranks = _ranks(rows)
+            # A device's readings must be applied in order; each pass takes at
+            # most one reading per device so the pass can be vectorized
+            if not ranks.any():
+                self._apply(rows, timestamps, powers, events)
+            else:
+                by_rank = np.argsort(ranks, kind='stable')
+                sizes = np.bincount(ranks)
+                bounds = np.cumsum(sizes)
+                # Pass sizes only shrink, so the small passes form the tail
+                passes = int(np.count_nonzero(sizes >= MIN_PASS_ROWS))
+                for start, stop in zip((bounds - sizes)[:passes].tolist(), bounds[:passes].tolist()):
+                    picked = by_rank[start:stop]
+                    self._apply(rows[picked], timestamps[picked], powers[picked], events)
+                rest = by_rank[bounds[passes - 1] if passes else 0:]
+                if len(rest):
+                    # Stable, so each device's readings stay in rank order
+                    rest = rest[np.argsort(rows[rest], kind='stable')]
+                    hours = hour_of_week(timestamps[rest], self.utc_offset)
+                    starts = np.flatnonzero(np.diff(rows[rest], prepend=-1))
+                    for start, stop in zip(starts.tolist(), np.append(starts[1:], len(rest)).tolist()):
+                        picked = rest[start:stop]
+                        self._apply_sequence(int(rows[picked[0]]), hours[start:stop].tolist(),
+                                             timestamps[picked].tolist(), powers[picked].tolist(), events)
+            self.readings_total += len(rows)
+        for event, alert in events:
+            for callback in self._listeners:
+                callback(event, alert)
+
+    def _apply(self, rows, timestamps, powers, events):
+        """Score then learn one reading each for distinct ``rows``"""
+        hours = hour_of_week(timestamps, self.utc_offset)
+        count = self._count[rows]
+        mean = self._mean[rows]
+        var = self._var[rows]
+        cell_count = self._season_count[rows, hours].astype(np.int64)
+        cell_mean = self._season_mean[rows, hours].astype(np.float64)
+        cell_var = self._season_var[rows, hours].astype(np.float64)
+
+        seasonal = cell_count >= MIN_SEASONAL_SAMPLES
+        expected = np.where(seasonal, cell_mean, mean)
+        spread = np.sqrt(np.maximum(np.where(seasonal, cell_var, var), 0.0))
+        spread = np.maximum(spread, np.maximum(MIN_STD_KW, RELATIVE_STD * np.abs(expected)))
+        score = np.where(seasonal | (count >= MIN_SAMPLES), (powers - expected) / spread, 0.0)
+        direction = np.where(score > Z_THRESHOLD, 1, np.where(score < -Z_THRESHOLD, -1, 0))
+        weight = np.where(direction != 0, OUTLIER_WEIGHT, 1.0)
+
+        # Exponentially weighted mean and variance; the first reading seeds them
+        alpha = np.where(count == 0, 1.0, EWMA_ALPHA * weight)
+        diff = powers - mean
+        self._mean[rows] = mean + alpha * diff
+        self._var[rows] = (1.0 - alpha) * (var + alpha * diff * diff)
+        self._count[rows] = count + 1
+        alpha = np.where(cell_count == 0, 1.0, SEASONAL_ALPHA * weight)
+        diff = powers - cell_mean
+        self._season_mean[rows, hours] = cell_mean + alpha * diff
+        self._season_var[rows, hours] = (1.0 - alpha) * (cell_var + alpha * diff * diff)
+        self._season_count[rows, hours] = np.minimum(cell_count + 1, 255)
+
+        streak = self._streak[rows]
+        streak = np.where(direction == 0, 0, np.where(np.sign(streak) == direction, streak + direction, direction))
+        self._streak[rows] = streak
+        state = self._state[rows]
+        in_alert = state != 0
+        calm = np.where(in_alert & (direction != state), self._calm[rows] + 1, 0)
+        self._calm[rows] = calm
+
+        if in_alert.any():
+            alerted = rows[in_alert]
+            same = direction[in_alert] == state[in_alert]
+            self._peak[alerted] = np.where(same, np.maximum(self._peak[alerted], np.abs(score[in_alert])),
+                                           self._peak[alerted])
+            self._anomalous[alerted] += same
+            self._last_power[alerted] = powers[in_alert]
+            self._last_expected[alerted] = expected[in_alert]
+            self._last_seen[alerted] = timestamps[in_alert]
+            for i in np.flatnonzero(in_alert & (calm >= ALERT_READINGS)).tolist():
+                events.append(('resolved', self._resolve(int(rows[i]), float(timestamps[i]))))
+
+        for i in np.flatnonzero(~in_alert & (np.abs(streak) >= ALERT_READINGS)).tolist():
+            row = int(rows[i])
+            self._state[row] = direction[i]
+            self._peak[row] = abs(score[i])
+            self._anomalous[row] = abs(streak[i])
+            self._last_power[row] = powers[i]
+            self._last_expected[row] = expected[i]
+            self._last_seen[row] = timestamps[i]
+            self._calm[row] = 0
+            self._open[row] = {"alert_id": next(self._alert_ids), "device_id": self._ids[row],
+                               "kind": KINDS[int(direction[i])], "started_at": float(timestamps[i])}
+            self.opened_total += 1
+            events.append(('opened', self._alert(row)))
+
+    def _apply_sequence(self, row, hours, timestamps, powers, events):
+        """``_apply`` for consecutive readings of one device, as a scalar loop
+
+        The state is held in locals and written back once; hour-of-week
+        cells go through float32 arrays so they round as the NumPy path does.
+        """
+        count = int(self._count[row])
+        mean = float(self._mean[row])
+        var = float(self._var[row])
+        season_count = self._season_count[row].tolist()
+        season_mean = array('f', self._season_mean[row].tobytes())
+        season_var = array('f', self._season_var[row].tobytes())
+        streak = int(self._streak[row])
+        calm = int(self._calm[row])
+        state = int(self._state[row])
+        peak = float(self._peak[row])
+        anomalous = int(self._anomalous[row])
+        last = None
+
+        for hour, timestamp, power in zip(hours, timestamps, powers):
+            cell_count = season_count[hour]
+            cell_mean = season_mean[hour]
+            cell_var = season_var[hour]
+            seasonal = cell_count >= MIN_SEASONAL_SAMPLES
+            expected = cell_mean if seasonal else mean
+            spread = math.sqrt(max(cell_var if seasonal else var, 0.0))
+            spread = max(spread, MIN_STD_KW, RELATIVE_STD * abs(expected))
+            score = (power - expected) / spread if seasonal or count >= MIN_SAMPLES else 0.0
+            direction = 1 if score > Z_THRESHOLD else -1 if score < -Z_THRESHOLD else 0
+            weight = OUTLIER_WEIGHT if direction else 1.0
+
+            alpha = 1.0 if count == 0 else EWMA_ALPHA * weight
+            diff = power - mean
+            mean += alpha * diff
+            var = (1.0 - alpha) * (var + alpha * diff * diff)
+            count += 1
+            alpha = 1.0 if cell_count == 0 else SEASONAL_ALPHA * weight
+            diff = power - cell_mean
+            season_mean[hour] = cell_mean + alpha * diff
+            season_var[hour] = (1.0 - alpha) * (cell_var + alpha * diff * diff)
+            season_count[hour] = min(cell_count + 1, 255)
+
+            if direction == 0:
+                streak = 0
+            else:
+                streak = streak + direction if (streak > 0) - (streak < 0) == direction else direction
+            if state:
+                calm = calm + 1 if direction != state else 0
+                if direction == state:
+                    peak = max(peak, abs(score))
+                    anomalous += 1
+                last = (power, expected, timestamp)
+                if calm >= ALERT_READINGS:
+                    self._store_alert_state(row, streak, calm, state, peak, anomalous, last)
+                    events.append(('resolved', self._resolve(row, timestamp)))
+                    streak = calm = state = 0
+            else:
+                calm = 0
+                if abs(streak) >= ALERT_READINGS:
+                    state, peak, anomalous = direction, abs(score), abs(streak)
+                    last = (power, expected, timestamp)
+                    self._store_alert_state(row, streak, calm, state, peak, anomalous, last)
+                    self._open[row] = {"alert_id": next(self._alert_ids), "device_id": self._ids[row],
+                                       "kind": KINDS[direction], "started_at": timestamp}
+                    self.opened_total += 1
+                    events.append(('opened', self._alert(row)))
+
+        self._count[row] = count
+        self._mean[row] = mean
+        self._var[row] = var
+        self._season_count[row] = season_count
+        self._season_mean[row] = np.frombuffer(season_mean, dtype=np.float32)
+        self._season_var[row] = np.frombuffer(season_var, dtype=np.float32)
+        self._store_alert_state(row, streak, calm, state, peak, anomalous, last)
+
+    def _store_alert_state(self, row, streak, calm, state, peak, anomalous, last):
+        self._streak[row] = streak
+        self._calm[row] = calm
+        self._state[row] = state
+        self._peak[row] = peak
+        self._anomalous[row] = anomalous
+        if last is not None:
+            self._last_power[row], self._last_expected[row], self._last_seen[row] = last
+
+    def _alert(self, row):
+        """Dict for the open alert on ``row``"""
+        return {
+            **self._open[row],
+            "status": "active",
+            "last_seen": float(self._last_seen[row]),
+            "power": round(float(self._last_power[row]), 3),
+            "expected": round(float(self._last_expected[row]), 3),
+            "score": round(float(self._peak[row]), 2),
+            "readings": int(self._anomalous[row])
+        }
+
+    def _resolve(self, row, timestamp):
+        alert = self._alert(row)
+        alert.update(status="resolved", ended_at=timestamp)
+        del self._open[row]
+        self._state[row] = 0
+        self._streak[row] = 0
+        self._calm[row] = 0
+        self._resolved.append(alert)
+        return alert
+
+    def _on_devices(self, event, devices):
+        """Forget deleted devices so a re-added id starts from scratch"""
+        deleted = [device['device_id'] for change, device in iter_changes(event, devices)
+                   if change == 'deleted']
+        if not deleted:
+            return
+        with self._lock:
+            for device_id in deleted:
+                row = self._rows.get(device_id)
+                if row is None:
+                    continue
+                self._open.pop(row, None)
+                for name in ('_count', '_season_count', '_streak', '_calm', '_state', '_anomalous'):
+                    getattr(self, name)[row] = 0
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def alerts(self, status='active', device_id=None, device_type=None, location=None, limit=100):
+        """Alerts, strongest first when active and newest first when resolved
+
+        ``status`` is 'active', 'resolved' or 'all'. Alerts carry the
+        device's current type and location.
+        """
+        if status not in ('active', 'resolved', 'all'):
+            raise ValueError("status must be 'active', 'resolved' or 'all'")
+        if not 1 <= limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+        with self._lock:
+            active = [self._alert(row) for row in self._open] if status != 'resolved' else []
+            resolved = list(self._resolved) if status != 'active' else []
+        active.sort(key=lambda alert: -alert['score'])
+        resolved.reverse()
+        matched = []
+        for alert in active + resolved:
+            if device_id is not None and alert['device_id'] != device_id:
+                continue
+            device = self.registry.get(alert['device_id'])
+            if device is None:
+                continue
+            if device_type is not None and device['device_type'] != device_type:
+                continue
+            if location is not None and device['location'] != location:
+                continue
+            matched.append({**alert, "device_type": device['device_type'], "location": device['location']})
+            if len(matched) >= limit:
+                break
+        return matched
+
+    def boosts(self):
+        """``{device_id: (action, savings fraction)}`` for devices drawing above baseline
+
+        The fraction is the share of the current draw above what the
+        device's baseline expects, i.e. what returning to normal would save.
+        """
+        with self._lock:
+            high = [(self._open[row]['device_id'], float(self._last_power[row]), float(self._last_expected[row]))
+                    for row in self._open if self._state[row] > 0]
+        boosts = {}
+        for device_id, power, expected in high:
+            device = self.registry.get(device_id)
+            if device is None or power <= 0:
+                continue
+            action = RECOMMENDED_ACTIONS.get(device['device_type'], DEFAULT_ACTION)
+            boosts[device_id] = (action, min(1.0, max(0.0, 1.0 - expected / power)))
+        return boosts
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._ids),
+                "active": len(self._open),
+                "opened_total": self.opened_total,
+                "readings_total": self.readings_total
+            }
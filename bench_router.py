@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Request dispatch benchmark for the AI Energy Optimizer
+Drives the HTTP handler over an in-memory connection and reports
+requests/sec and socket writes per request for each endpoint
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ENDPOINTS = (
+    ('GET', '/health', None),
+    ('GET', '/', None),
+    ('GET', '/predictions', None),
+    ('GET', '/devices/sample', None),
+    ('GET', '/analytics/summary', None),
+    ('POST', '/optimize', b'{"top_k": 5}'),
+    ('GET', '/missing', None),
+)
+
+
+class FakeConnection:
+    """Socket stand-in: requests come from a buffer, writes are counted"""
+
+    def __init__(self, payload):
+        self._payload = payload
+        self.sends = 0
+        self.bytes_sent = 0
+
+    def makefile(self, mode, buffering=-1):
+        return io.BufferedReader(io.BytesIO(self._payload))
+
+    def sendall(self, data):
+        self.sends += 1
+        self.bytes_sent += len(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+
+def load_server(path, name):
+    """Import a simple_server.py from ``path`` as an independent module"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    class QuietHandler(module.EnergyOptimizerHandler):
+        def log_message(self, format, *args):
+            pass
+
+    return QuietHandler
+
+
+def request_bytes(method, path, body):
+    lines = [f"{method} {path} HTTP/1.1", "Host: bench", "Accept: application/json"]
+    if body is not None:
+        lines.append("Content-Type: application/json")
+        lines.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b'')
+
+
+def run_endpoint(handler_class, method, path, body, requests):
+    """Pipeline ``requests`` keep-alive requests through one handler instance"""
+    one = request_bytes(method, path, body)
+    handler_class(FakeConnection(one * 20), ('127.0.0.1', 0), None)  # Warm caches
+    connection = FakeConnection(one * requests)
+    started = time.perf_counter()
+    handler_class(connection, ('127.0.0.1', 0), None)
+    elapsed = time.perf_counter() - started
+    return {
+        "requests_per_second": round(requests / elapsed, 1),
+        "writes_per_request": round(connection.sends / requests, 2)
+    }
+
+
+def run_benchmark(server_path, requests=2000, name='bench_server'):
+    handler_class = load_server(server_path, name)
+    return {f"{method} {path}": run_endpoint(handler_class, method, path, body, requests)
+            for method, path, body in ENDPOINTS}
+
+
+def main(argv=None):
+    """Command line entry point"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark request dispatch and response writing")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per endpoint")
+    parser.add_argument('--server-path', default=os.path.join(here, 'simple_server.py'),
+                        help="simple_server.py to measure (default: this checkout)")
+    parser.add_argument('--compare', metavar='REV',
+                        help="also measure simple_server.py from a git revision, e.g. HEAD~1")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, here)
+
+    print("🧪 Benchmarking request dispatch...", file=sys.stderr)
+    results = {"current": run_benchmark(args.server_path, args.requests)}
+    if args.compare:
+        source = subprocess.run(['git', 'show', f'{args.compare}:simple_server.py'], cwd=here,
+                                check=True, capture_output=True).stdout
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline_path = os.path.join(tmp, 'simple_server_baseline.py')
+            with open(baseline_path, 'wb') as f:
+                f.write(source)
+            results["baseline"] = run_benchmark(baseline_path, args.requests, 'bench_baseline')
+        results["speedup"] = {
+            endpoint: round(current["requests_per_second"]
+                            / results["baseline"][endpoint]["requests_per_second"], 2)
+            for endpoint, current in results["current"].items()
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
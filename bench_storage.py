@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Storage benchmark for the AI Energy Optimizer
+Measures sustained telemetry inserts/sec and read latency on the SQLite store
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import EnergyStore
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_benchmark(devices=10000, readings_per_device=20, batch_size=1000,
+                  producers=4, reads=2000, readers=8, path=None):
+    """Run the ingest and read phases and return the results as a dict"""
+    cleanup = path is None
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    store = EnergyStore(path, pool_size=readers)
+    try:
+        device_ids = [f"device_{i:06d}" for i in range(devices)]
+        for device_id in device_ids:
+            store.save_device({
+                "device_id": device_id,
+                "device_name": device_id,
+                "device_type": "appliances",
+                "current_power": 1.0,
+                "location": "benchmark",
+                "is_active": True
+            })
+        store.flush()
+
+        # Ingest phase: producers push batches as telemetry gateways would
+        base_ts = time.time() - readings_per_device * 60
+        total = devices * readings_per_device
+
+        def produce(worker):
+            rng = random.Random(worker)
+            batch = []
+            for step in range(worker, readings_per_device, producers):
+                ts = base_ts + step * 60
+                for device_id in device_ids:
+                    batch.append((device_id, ts, rng.uniform(0.1, 5.0)))
+                    if len(batch) >= batch_size:
+                        store.record_readings(batch)
+                        batch = []
+            if batch:
+                store.record_readings(batch)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.flush()
+        ingest_seconds = time.perf_counter() - started
+
+        # Read phase: concurrent range queries for random devices
+        def read_one(seed):
+            rng = random.Random(seed)
+            device_id = rng.choice(device_ids)
+            start = base_ts + rng.randint(0, readings_per_device // 2) * 60
+            t0 = time.perf_counter()
+            store.readings(device_id, start, start + 3600)
+            return (time.perf_counter() - t0) * 1000.0
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=readers) as pool:
+            latencies = list(pool.map(read_one, range(reads)))
+        read_seconds = time.perf_counter() - started
+    finally:
+        store.close()
+        if cleanup:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+
+    return {
+        "devices": devices,
+        "readings": total,
+        "ingest_seconds": round(ingest_seconds, 3),
+        "inserts_per_second": round(total / ingest_seconds, 1),
+        "reads": reads,
+        "reads_per_second": round(reads / read_seconds, 1),
+        "read_latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3)
+        }
+    }
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite energy store")
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--readings-per-device', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--db', help="database path (default: temporary file)")
+    args = parser.parse_args(argv)
+
+    print("🧪 Benchmarking energy store...", file=sys.stderr)
+    results = run_benchmark(args.devices, args.readings_per_device, args.batch_size,
+                            args.producers, args.reads, args.readers, args.db)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Device command dispatch for the AI Energy Optimizer
+Per-device outbound command queues delivered in the background, batched per gateway through a
+pluggable transport, with coalescing of redundant commands and retries with exponential backoff
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SENDERS = 8
+MAX_BATCH = 100
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+MAX_PENDING = 500000
+MAX_PER_DEVICE = 64
+# Finished commands kept for GET /commands/{id}
+MAX_FINISHED = 100000
+MAX_SUBMIT = 5000
+
+QUEUED = 'queued'
+SENDING = 'sending'
+RETRYING = 'retrying'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+COALESCED = 'coalesced'
+CANCELLED = 'cancelled'
+FINAL_STATUSES = (DELIVERED, FAILED, COALESCED, CANCELLED)
+
+# Applying one of these twice leaves the device as it was
+SELF_CANCELLING = frozenset(('toggle',))
+
+
+class CommandQueueFull(RuntimeError):
+    """Raised when a command would exceed the pending limit overall or for its device"""
+
+
+def gateway_for(device):
+    """Gateway that relays commands to ``device``: one hub per location"""
+    return device.get('location') or 'default'
+
+
+class Command:
+    __slots__ = ('command_id', 'site_id', 'device_id', 'gateway', 'action', 'params', 'status',
+                 'attempts', 'error', 'created_at', 'updated_at', 'not_before', 'coalesced_with')
+
+    def __init__(self, site_id, device_id, gateway, action, params):
+        self.command_id = uuid.uuid4().hex
+        self.site_id = site_id
+        self.device_id = device_id
+        self.gateway = gateway
+        self.action = action
+        self.params = params
+        self.status = QUEUED
+        self.attempts = 0
+        self.error = None
+        self.created_at = self.updated_at = time.time()
+        self.not_before = 0.0
+        self.coalesced_with = None
+
+    @property
+    def key(self):
+        return self.site_id, self.device_id
+
+    def payload(self):
+        """What the transport sends to the gateway"""
+        return {"command_id": self.command_id, "device_id": self.device_id,
+                "action": self.action, "params": self.params}
+
+    def to_dict(self):
+        return {
+            "command_id": self.command_id,
+            "device_id": self.device_id,
+            "gateway": self.gateway,
+            "action": self.action,
+            "params": self.params,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "coalesced_with": self.coalesced_with,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
+# ----------------------------------------------------------------------
+# Transports
+# ----------------------------------------------------------------------
+
+class Transport:
+    """Delivers command batches to one gateway
+
+    ``send`` runs on a sender thread and may block on I/O. It returns a
+    dict of ``command_id -> error`` for the commands the gateway rejected;
+    every other command counts as delivered. Raising fails the whole batch,
+    e.g. when the gateway cannot be reached. Failed commands are retried.
+    """
+
+    def send(self, site_id, gateway, commands):
+        raise NotImplementedError
+
+
+class StubTransport(Transport):
+    """Delivers nowhere; records what it was sent, optionally slowly or unreliably"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None, history=1000):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.unreachable = set()
+        self.delivered = 0
+        self.batches = deque(maxlen=history)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, site_id, gateway, commands):
+        if self.latency:
+            time.sleep(self.latency)
+        if gateway in self.unreachable:
+            raise ConnectionError(f"gateway '{gateway}' is unreachable")
+        with self._lock:
+            rejected = {command['command_id']: "device did not acknowledge" for command in commands
+                        if self.failure_rate and self._random.random() < self.failure_rate}
+            self.batches.append((site_id, gateway, [command for command in commands
+                                                    if command['command_id'] not in rejected]))
+            self.delivered += len(commands) - len(rejected)
+        return rejected
+
+
+# ----------------------------------------------------------------------
+# Dispatcher
+# ----------------------------------------------------------------------
+
+class CommandDispatcher:
+    """Background delivery of device commands
+
+    Each device has a FIFO queue with at most one command in flight, so a
+    device sees its commands in order. Ready commands are grouped by
+    gateway, and each gateway gets one batch of up to ``max_batch`` at a
+    time on a pool of ``senders`` threads. A slow gateway therefore holds
+    up only its own devices. Failed deliveries are retried after an
+    exponential backoff with jitter, up to ``max_attempts`` times.
+
+    Before a command is queued it is coalesced with ones still waiting. A
+    toggle cancels a waiting toggle. Any other action replaces a waiting
+    command with the same action, since the newer parameters win anyway.
+    ``submit`` only touches in-memory queues, so HTTP handlers return
+    straight away.
+    """
+
+    def __init__(self, transport=None, senders=DEFAULT_SENDERS, max_batch=MAX_BATCH,
+                 max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 max_pending=MAX_PENDING, seed=None):
+        self.transport = transport or StubTransport()
+        self.senders = senders
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_pending = max_pending
+        self._random = random.Random(seed)
+        self._condition = threading.Condition()
+        self._commands = {}
+        self._queues = {}
+        self._ready = {}
+        self._waiting = {}
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._busy = set()
+        self._finished = deque()
+        self._pending = 0
+        self._totals = {status: 0 for status in FINAL_STATUSES}
+        self._totals['retries'] = 0
+        self._worker = None
+        self._executor = None
+        self._closed = False
+
+    # ------------------------------------------------------------------
+    # Submitting
+    # ------------------------------------------------------------------
+
+    def submit(self, site_id, device, action, params=None):
+        """Queue one command for ``device`` (a device dict) and return it as a dict"""
+        return self.submit_many(site_id, [(device, action, params)])[0]
+
+    def submit_many(self, site_id, commands):
+        """Queue ``(device, action, params)`` commands; all are queued or none are
+
+        Returns one dict per command. A command absorbed by coalescing comes
+        back already final, with status 'coalesced'.
+        """
+        with self._condition:
+            if self._pending + len(commands) > self.max_pending:
+                raise CommandQueueFull(f"more than {self.max_pending} commands pending")
+            added = {}
+            for device, _action, _params in commands:
+                key = (site_id, device['device_id'])
+                added[key] = added.get(key, len(self._queues.get(key, ()))) + 1
+                if added[key] > MAX_PER_DEVICE:
+                    raise CommandQueueFull(f"more than {MAX_PER_DEVICE} commands pending for "
+                                           f"device '{device['device_id']}'")
+            submitted = []
+            for device, action, params in commands:
+                command = Command(site_id, device['device_id'], gateway_for(device), action, params or {})
+                self._commands[command.command_id] = command
+                self._enqueue(command)
+                submitted.append(command.to_dict())
+            self._condition.notify_all()
+        self.start()
+        return submitted
+
+    def _enqueue(self, command):
+        key = command.key
+        queue = self._queues.setdefault(key, deque())
+        if command.action in SELF_CANCELLING:
+            if queue and queue[-1].action == command.action and queue[-1].status != SENDING:
+                previous = queue[-1]
+                self._remove(queue, previous, COALESCED, command.command_id)
+                command.coalesced_with = previous.command_id
+                self._finish(command, COALESCED)
+                if not queue:
+                    del self._queues[key]
+                return
+        else:
+            for previous in queue:
+                if previous.action == command.action and previous.status != SENDING:
+                    self._remove(queue, previous, COALESCED, command.command_id)
+                    break
+        queue.append(command)
+        self._pending += 1
+        if len(queue) == 1:
+            self._schedule(key, command)
+
+    def _remove(self, queue, command, status, coalesced_with=None):
+        """Take a command that is not in flight out of its queue as final"""
+        head = queue[0] is command
+        if head:
+            self._unschedule(command)
+        queue.remove(command)
+        self._pending -= 1
+        command.coalesced_with = coalesced_with
+        self._finish(command, status)
+        if head and queue:
+            self._schedule(command.key, queue[0])
+
+    def cancel_device(self, site_id, device_id):
+        """Drop a device's waiting commands, e.g. once it is deleted; returns how many"""
+        with self._condition:
+            queue = self._queues.get((site_id, device_id))
+            if not queue:
+                return 0
+            waiting = [command for command in queue if command.status != SENDING]
+            for command in waiting:
+                self._remove(queue, command, CANCELLED)
+            if not queue:
+                del self._queues[(site_id, device_id)]
+            return len(waiting)
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+
+    def _schedule(self, key, head):
+        """Make a queue head dispatchable now or once its backoff ends"""
+        delay = head.not_before - time.monotonic()
+        if delay > 0:
+            sequence = next(self._sequence)
+            self._waiting[key] = sequence
+            heapq.heappush(self._delayed, (head.not_before, sequence, key))
+        else:
+            self._ready.setdefault((head.site_id, head.gateway), {})[key] = None
+
+    def _unschedule(self, head):
+        ready = self._ready.get((head.site_id, head.gateway))
+        if ready is not None:
+            ready.pop(head.key, None)
+            if not ready:
+                del self._ready[(head.site_id, head.gateway)]
+        self._waiting.pop(head.key, None)
+
+    def _finish(self, command, status, error=None):
+        command.status = status
+        command.error = error
+        command.updated_at = time.time()
+        self._totals[status] += 1
+        self._finished.append(command.command_id)
+        while len(self._finished) > MAX_FINISHED:
+            self._commands.pop(self._finished.popleft(), None)
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay * self._random.uniform(0.5, 1.0)
+
+    def start(self):
+        with self._condition:
+            if self._worker is not None or self._closed:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix='command-send')
+            self._worker = threading.Thread(target=self._run, name='command-dispatch', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, sequence, key = heapq.heappop(self._delayed)
+                    if self._waiting.get(key) == sequence:
+                        del self._waiting[key]
+                        head = self._queues[key][0]
+                        self._ready.setdefault((head.site_id, head.gateway), {})[key] = None
+
+                for gateway in [gateway for gateway in self._ready if gateway not in self._busy]:
+                    devices = self._ready[gateway]
+                    batch = []
+                    for key in itertools.islice(devices, self.max_batch):
+                        command = self._queues[key][0]
+                        command.status = SENDING
+                        command.attempts += 1
+                        command.updated_at = time.time()
+                        batch.append(command)
+                    for command in batch:
+                        del devices[command.key]
+                    if not devices:
+                        del self._ready[gateway]
+                    self._busy.add(gateway)
+                    self._executor.submit(self._send, gateway, batch)
+
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _send(self, gateway, batch):
+        site_id, name = gateway
+        try:
+            rejected = self.transport.send(site_id, name, [command.payload() for command in batch]) or {}
+            errors = {command.command_id: rejected.get(command.command_id) for command in batch}
+        except Exception as e:
+            errors = dict.fromkeys((command.command_id for command in batch), f"{type(e).__name__}: {e}")
+
+        with self._condition:
+            self._busy.discard(gateway)
+            for command in batch:
+                queue = self._queues.get(command.key)
+                error = errors[command.command_id]
+                if error is not None and command.attempts < self.max_attempts:
+                    command.status = RETRYING
+                    command.error = error
+                    command.updated_at = time.time()
+                    command.not_before = time.monotonic() + self._backoff(command.attempts)
+                    self._totals['retries'] += 1
+                    self._schedule(command.key, command)
+                    continue
+                queue.popleft()
+                self._pending -= 1
+                self._finish(command, DELIVERED if error is None else FAILED, error)
+                if queue:
+                    self._schedule(command.key, queue[0])
+                else:
+                    del self._queues[command.key]
+            self._condition.notify_all()
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def get(self, command_id):
+        with self._condition:
+            command = self._commands.get(command_id)
+            return command.to_dict() if command is not None else None
+
+    def site_of(self, command_id):
+        command = self._commands.get(command_id)
+        return command.site_id if command is not None else None
+
+    def wait(self, timeout=None):
+        """Block until nothing is pending; returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending": self._pending,
+                "devices_waiting": len(self._queues),
+                "gateways_busy": len(self._busy),
+                "totals": dict(self._totals)
+            }
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            worker, executor = self._worker, self._executor
+        if worker is not None:
+            worker.join()
+            executor.shutdown(wait=True)
@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+"""
+Device registry for the AI Energy Optimizer
+Thread-safe, indexed device storage shared by the request handlers and the optimizer
+"""
+
+import base64
+import json
+import math
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+import numpy as np
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEVICE_FIELDS = ('device_id', 'device_name', 'device_type', 'current_power', 'location', 'is_active')
+SORT_KEYS = ('device_id', 'current_power', '-current_power')
+MAX_BATCH_OPERATIONS = 5000
+# Batches with more operations rebuild each touched sorted index once at the
+# end instead of shifting it on every operation
+DEFERRED_INDEX_OPERATIONS = 64
+BATCH_OPS = ('add', 'delete', 'toggle', 'update')
+UPDATABLE_FIELDS = ('device_name', 'device_type', 'current_power', 'location', 'is_active')
+TEXT_FIELDS = ('device_name', 'device_type', 'location')
+
+
+def encode_cursor(position):
+    """Opaque, URL-safe token for a page position"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Page position from ``encode_cursor``; raises ValueError when malformed"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def iter_changes(event, devices):
+    """``(event, device)`` pairs from a listener call, for single mutations and batches alike"""
+    if event == 'batch':
+        return [(change['event'], change['device']) for change in devices]
+    return [(event, device) for device in devices]
+
+
+def check_fields(fields):
+    """Copy of device ``fields`` with ``current_power`` as a float; raises ValueError
+
+    Text fields must be strings since they key the indexes, and the power
+    must be a finite number.
+    """
+    if any(not isinstance(fields[name], str) for name in TEXT_FIELDS if name in fields):
+        raise ValueError(f"{', '.join(TEXT_FIELDS)} must be strings")
+    fields = dict(fields)
+    if 'current_power' in fields:
+        try:
+            power = float(fields['current_power'])
+        except (TypeError, ValueError):
+            raise ValueError("current_power must be a number") from None
+        if not math.isfinite(power):
+            raise ValueError("current_power must be a finite number")
+        fields['current_power'] = power
+    return fields
+
+
+def _remove_sorted(items, value):
+    index = bisect_right(items, value) - 1
+    if index >= 0 and items[index] == value:
+        del items[index]
+
+
+class BatchError(ValueError):
+    """A batch that was rejected as a whole; ``errors`` lists the failing operations"""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} operation(s) failed; nothing was applied")
+        self.errors = errors
+
+
+class DeviceRecord:
+    """Compact device record; power and state live in the registry's columns"""
+
+    __slots__ = ('slot', 'device_id', 'device_name', 'device_type', 'location')
+
+    def __init__(self, slot, device_id, device_name, device_type, location):
+        self.slot = slot
+        self.device_id = device_id
+        self.device_name = device_name
+        self.device_type = device_type
+        self.location = location
+
+
+class DeviceRegistry:
+    """Devices keyed by ``device_id`` with secondary indexes on type, location and state
+
+    Lookups are O(1) through the id map, and filtered queries intersect the
+    secondary indexes instead of scanning. ``current_power`` and ``is_active``
+    are stored in ``array`` columns addressed by each record's slot so bulk
+    readers such as the optimizer can take a cheap columnar snapshot.
+
+    Two locks keep writers from stepping on each other: ``_lock`` guards
+    membership and the indexes, ``_power_lock`` guards the power column so
+    telemetry updates never wait on index maintenance.
+
+    Every index also keeps its ids in a sorted list, so ``page`` can seek to
+    a cursor with a binary search and read one page without scanning.
+    """
+
+    def __init__(self, devices=None):
+        self._lock = threading.RLock()
+        self._power_lock = threading.Lock()
+        self._records = {}
+        self._free_slots = []
+        self._power = array('d')
+        self._active = array('b')
+        self._by_type = {}
+        self._by_location = {}
+        self._by_active = {True: set(), False: set()}
+        self._ordered = []
+        self._ordered_by_type = {}
+        self._ordered_by_location = {}
+        self._ordered_by_active = {True: [], False: []}
+        self._slot_ids = []
+        self._deferred = None
+        self._listeners = []
+        # Bumped on every change so caches can tell when a snapshot is stale
+        self.version = 0
+        self.power_version = 0
+
+        for device in devices or ():
+            self.add(device, notify=False)
+
+    # ------------------------------------------------------------------
+    # Listeners
+    # ------------------------------------------------------------------
+
+    def add_listener(self, callback):
+        """Call ``callback(event, devices)`` after every mutation
+
+        Single mutations use the events 'added', 'deleted', 'toggled' and
+        'updated' with a one-device list. ``apply_batch`` fires one 'batch'
+        event whose list holds ``{"event": ..., "device": ...}`` changes.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, event, devices):
+        for callback in self._listeners:
+            callback(event, devices)
+
+    # ------------------------------------------------------------------
+    # Internal helpers (callers hold ``_lock``)
+    # ------------------------------------------------------------------
+
+    def _to_dict(self, record):
+        slot = record.slot
+        return {
+            "device_id": record.device_id,
+            "device_name": record.device_name,
+            "device_type": record.device_type,
+            "current_power": self._power[slot],
+            "location": record.location,
+            "is_active": bool(self._active[slot])
+        }
+
+    def _order_insert(self, ordered, device_id):
+        if self._deferred is None:
+            insort(ordered, device_id)
+        else:
+            self._deferred.setdefault(id(ordered), (ordered, {}))[1][device_id] = True
+
+    def _order_remove(self, ordered, device_id):
+        if self._deferred is None:
+            _remove_sorted(ordered, device_id)
+        else:
+            self._deferred.setdefault(id(ordered), (ordered, {}))[1][device_id] = False
+
+    def _apply_deferred(self):
+        """Rebuild every sorted list touched while ``_deferred`` was set, once each"""
+        deferred, self._deferred = self._deferred, None
+        for ordered, changes in deferred.values():
+            # Copy the runs between touched ids, then append the ones that stay;
+            # sort() merges that short tail into the long sorted run
+            drop = []
+            for device_id in changes:
+                index = bisect_left(ordered, device_id)
+                if index < len(ordered) and ordered[index] == device_id:
+                    drop.append(index)
+            drop.sort()
+            kept = []
+            start = 0
+            for index in drop:
+                kept += ordered[start:index]
+                start = index + 1
+            kept += ordered[start:]
+            kept += [device_id for device_id, present in changes.items() if present]
+            kept.sort()
+            ordered[:] = kept
+
+    def _index(self, record):
+        device_id = record.device_id
+        active = bool(self._active[record.slot])
+        self._by_type.setdefault(record.device_type, set()).add(device_id)
+        self._by_location.setdefault(record.location, set()).add(device_id)
+        self._by_active[active].add(device_id)
+        self._order_insert(self._ordered_by_type.setdefault(record.device_type, []), device_id)
+        self._order_insert(self._ordered_by_location.setdefault(record.location, []), device_id)
+        self._order_insert(self._ordered_by_active[active], device_id)
+
+    def _unindex(self, record):
+        device_id = record.device_id
+        for index, ordered, key in ((self._by_type, self._ordered_by_type, record.device_type),
+                                    (self._by_location, self._ordered_by_location, record.location)):
+            members = index.get(key)
+            if members is not None:
+                members.discard(device_id)
+                self._order_remove(ordered[key], device_id)
+                if not members:
+                    del index[key]
+                    del ordered[key]
+        active = bool(self._active[record.slot])
+        self._by_active[active].discard(device_id)
+        self._order_remove(self._ordered_by_active[active], device_id)
+
+    def _insert(self, device):
+        # Checked before any state changes, so a bad device leaves nothing half indexed
+        device = check_fields(device)
+        device_id = device['device_id']
+        with self._power_lock:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._power[slot] = float(device.get('current_power', 0.0))
+                self._active[slot] = bool(device.get('is_active', True))
+                self._slot_ids[slot] = device_id
+            else:
+                slot = len(self._power)
+                self._power.append(float(device.get('current_power', 0.0)))
+                self._active.append(bool(device.get('is_active', True)))
+                self._slot_ids.append(device_id)
+        record = DeviceRecord(
+            slot,
+            device_id,
+            device.get('device_name', device_id),
+            device.get('device_type', 'other'),
+            device.get('location', 'unknown'),
+        )
+        self._records[device_id] = record
+        self._index(record)
+        self._order_insert(self._ordered, device_id)
+        self.version += 1
+        return self._to_dict(record)
+
+    def _delete(self, record):
+        self._records.pop(record.device_id)
+        self._unindex(record)
+        self._order_remove(self._ordered, record.device_id)
+        removed = self._to_dict(record)
+        with self._power_lock:
+            self._power[record.slot] = 0.0
+            self._active[record.slot] = 0
+            self._slot_ids[record.slot] = None
+            self._free_slots.append(record.slot)
+        self.version += 1
+        return removed
+
+    def _toggle(self, record):
+        self._unindex(record)
+        self._active[record.slot] = not self._active[record.slot]
+        self._index(record)
+        self.version += 1
+        return self._to_dict(record)
+
+    def _update(self, record, fields):
+        fields = check_fields(fields)
+        self._unindex(record)
+        for name in TEXT_FIELDS:
+            if name in fields:
+                setattr(record, name, fields[name])
+        if 'is_active' in fields:
+            self._active[record.slot] = bool(fields['is_active'])
+        if 'current_power' in fields:
+            with self._power_lock:
+                self._power[record.slot] = float(fields['current_power'])
+        self._index(record)
+        self.version += 1
+        return self._to_dict(record)
+
+    # ------------------------------------------------------------------
+    # Mutations
+    # ------------------------------------------------------------------
+
+    def add(self, device, notify=True):
+        """Register a device dict and return its stored representation"""
+        with self._lock:
+            if device['device_id'] in self._records:
+                raise ValueError(f"Device '{device['device_id']}' already exists")
+            stored = self._insert(device)
+        if notify:
+            self._notify('added', [stored])
+        return stored
+
+    def remove(self, device_id):
+        """Remove a device; returns False when it is not registered"""
+        with self._lock:
+            record = self._records.get(device_id)
+            if record is None:
+                return False
+            removed = self._delete(record)
+        self._notify('deleted', [removed])
+        return True
+
+    def toggle(self, device_id):
+        """Flip ``is_active``; returns the updated device or None"""
+        with self._lock:
+            record = self._records.get(device_id)
+            if record is None:
+                return None
+            updated = self._toggle(record)
+        self._notify('toggled', [updated])
+        return updated
+
+    def update(self, device_id, **fields):
+        """Update descriptive fields of a device; returns the updated device or None"""
+        with self._lock:
+            record = self._records.get(device_id)
+            if record is None:
+                return None
+            updated = self._update(record, fields)
+        self._notify('updated', [updated])
+        return updated
+
+    def apply_batch(self, operations):
+        """Apply add/delete/toggle/update operations atomically
+
+        Each operation is a dict with ``op`` and ``device_id``; 'add' also
+        takes ``device`` (the fields to store) and 'update' takes ``fields``.
+        Every operation is checked against the registry as the earlier ones
+        in the batch leave it, so a batch may add a device and then toggle
+        it. If any check fails, BatchError is raised and nothing changes.
+        Otherwise all operations are applied under one lock hold, listeners
+        get a single 'batch' event and the per-operation results are returned.
+        """
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            raise BatchError([{"index": None, "message":
+                               f"at most {MAX_BATCH_OPERATIONS} operations per batch"}])
+        with self._lock:
+            prepared = self._validate_batch(operations)
+            changes = []
+            if len(prepared) > DEFERRED_INDEX_OPERATIONS:
+                self._deferred = {}
+            try:
+                for op, device_id, payload in prepared:
+                    if op == 'add':
+                        device = self._insert(payload)
+                        event = 'added'
+                    elif op == 'delete':
+                        device = self._delete(self._records[device_id])
+                        event = 'deleted'
+                    elif op == 'toggle':
+                        device = self._toggle(self._records[device_id])
+                        event = 'toggled'
+                    else:
+                        device = self._update(self._records[device_id], payload)
+                        event = 'updated'
+                    changes.append({"event": event, "device": device})
+            finally:
+                if self._deferred is not None:
+                    self._apply_deferred()
+        if changes:
+            self._notify('batch', changes)
+        return [{"index": index, "op": op, "device_id": device_id, "success": True,
+                 "device": change['device']}
+                for index, ((op, device_id, _), change) in enumerate(zip(prepared, changes))]
+
+    def _validate_batch(self, operations):
+        """Normalized ``(op, device_id, payload)`` tuples; raises BatchError"""
+        exists = {}
+        prepared = []
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if not isinstance(operation, dict):
+                    raise ValueError("operation must be an object")
+                op = operation.get('op')
+                if op not in BATCH_OPS:
+                    raise ValueError(f"op must be one of {', '.join(BATCH_OPS)}")
+                payload = operation.get('device' if op == 'add' else 'fields') or {}
+                if not isinstance(payload, dict):
+                    raise ValueError("device/fields must be an object")
+                device_id = operation.get('device_id', payload.get('device_id'))
+                if not isinstance(device_id, str) or not device_id:
+                    raise ValueError("device_id is required")
+                payload = check_fields(payload)
+                present = exists.get(device_id, device_id in self._records)
+                if op == 'add':
+                    if present:
+                        raise ValueError(f"Device '{device_id}' already exists")
+                    payload = dict(payload, device_id=device_id,
+                                   current_power=payload.get('current_power', 0.0),
+                                   is_active=bool(payload.get('is_active', True)))
+                elif not present:
+                    raise ValueError(f"Device '{device_id}' not found")
+                elif op == 'update':
+                    unknown = set(payload) - set(UPDATABLE_FIELDS)
+                    if unknown:
+                        raise ValueError(f"cannot update {', '.join(sorted(unknown))}")
+            except (TypeError, ValueError) as e:
+                errors.append({"index": index, "op": operation.get('op') if isinstance(operation, dict)
+                               else None, "message": str(e)})
+                continue
+            exists[device_id] = op != 'delete'
+            prepared.append((op, device_id, payload))
+        if errors:
+            raise BatchError(errors)
+        return prepared
+
+    def update_powers(self, readings):
+        """Set ``current_power`` from ``(device_id, power)`` pairs
+
+        Returns the ids that are not registered. Only the power column lock is
+        taken, once per batch, so ingest never serializes behind index updates.
+        """
+        records = self._records
+        power = self._power
+        unknown = []
+        with self._power_lock:
+            for device_id, value in readings:
+                record = records.get(device_id)
+                if record is None:
+                    unknown.append(device_id)
+                else:
+                    power[record.slot] = value
+            self.power_version += 1
+        return unknown
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, device_id):
+        return device_id in self._records
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def get(self, device_id):
+        """Return a device dict by id, or None"""
+        with self._lock:
+            record = self._records.get(device_id)
+            return self._to_dict(record) if record is not None else None
+
+    def find_ids(self, device_type=None, location=None, is_active=None):
+        """Ids matching every given filter, resolved from the secondary indexes"""
+        with self._lock:
+            candidates = []
+            if device_type is not None:
+                candidates.append(self._by_type.get(device_type, set()))
+            if location is not None:
+                candidates.append(self._by_location.get(location, set()))
+            if is_active is not None:
+                candidates.append(self._by_active[bool(is_active)])
+            if not candidates:
+                return set(self._records)
+            candidates.sort(key=len)
+            return set(candidates[0]).intersection(*candidates[1:])
+
+    def find(self, device_type=None, location=None, is_active=None):
+        """Device dicts matching every given filter"""
+        ids = self.find_ids(device_type, location, is_active)
+        with self._lock:
+            return [self._to_dict(self._records[i]) for i in ids if i in self._records]
+
+    def to_list(self):
+        """Snapshot of every device as a list of dicts"""
+        with self._lock:
+            return [self._to_dict(record) for record in self._records.values()]
+
+    def device_types(self):
+        with self._lock:
+            return sorted(self._by_type)
+
+    def locations(self):
+        with self._lock:
+            return sorted(self._by_location)
+
+    def page(self, device_type=None, location=None, is_active=None, sort='device_id',
+             cursor=None, limit=DEFAULT_PAGE_SIZE, fields=None):
+        """One page of matching devices and the position after it
+
+        ``sort`` is ``device_id``, ``current_power`` or ``-current_power``;
+        ``cursor`` is the position returned for the previous page (None for
+        the first). Returns ``(devices, next_position)`` where the position
+        is None on the last page. ``fields`` limits each device dict to the
+        named keys.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+        if fields is not None:
+            unknown = set(fields) - set(DEVICE_FIELDS)
+            if unknown:
+                raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        with self._lock:
+            if sort == 'device_id':
+                ids, position = self._page_by_id(device_type, location, is_active, cursor, limit)
+            else:
+                ids, position = self._page_by_power(device_type, location, is_active, cursor, limit,
+                                                    descending=sort.startswith('-'))
+            devices = [self._to_dict(self._records[i]) for i in ids]
+        if fields is not None:
+            devices = [{name: device[name] for name in fields} for device in devices]
+        return devices, position
+
+    def _page_by_id(self, device_type, location, is_active, cursor, limit):
+        """Seek into the shortest ordered index, checking other filters by set membership"""
+        if cursor is not None and not isinstance(cursor, str):
+            raise ValueError("cursor does not match sort order")
+        ordered = [self._ordered]
+        checks = []
+        if device_type is not None:
+            ordered.append(self._ordered_by_type.get(device_type, []))
+            checks.append(self._by_type.get(device_type, set()))
+        if location is not None:
+            ordered.append(self._ordered_by_location.get(location, []))
+            checks.append(self._by_location.get(location, set()))
+        if is_active is not None:
+            ordered.append(self._ordered_by_active[bool(is_active)])
+            checks.append(self._by_active[bool(is_active)])
+        source = min(ordered, key=len)
+
+        ids = []
+        start = bisect_right(source, cursor) if cursor is not None else 0
+        for index in range(start, len(source)):
+            device_id = source[index]
+            if all(device_id in members for members in checks):
+                if len(ids) == limit:
+                    return ids, ids[-1]
+                ids.append(device_id)
+        return ids, None
+
+    def _page_by_power(self, device_type, location, is_active, cursor, limit, descending):
+        """Keyset page over the power column: ``(power, slot)`` orders ties"""
+        if device_type is None and location is None and is_active is None:
+            slots = np.fromiter((r.slot for r in self._records.values()), dtype=np.intp,
+                                count=len(self._records))
+        else:
+            ids = self.find_ids(device_type, location, is_active)
+            slots = np.fromiter((self._records[i].slot for i in ids), dtype=np.intp, count=len(ids))
+        with self._power_lock:
+            power = np.frombuffer(self._power, dtype=np.float64)[slots]
+        key = -power if descending else power
+
+        if cursor is not None:
+            try:
+                last_power, last_slot = float(cursor[0]), int(cursor[1])
+            except (TypeError, ValueError, IndexError, KeyError):
+                raise ValueError("cursor does not match sort order")
+            last_key = -last_power if descending else last_power
+            after = (key > last_key) | ((key == last_key) & (slots > last_slot))
+            slots, key = slots[after], key[after]
+
+        if len(slots) > limit:
+            # Partition out the page without sorting the whole fleet; ties on
+            # the boundary value are settled by slot so pages never overlap
+            threshold = np.partition(key, limit - 1)[limit - 1]
+            better = key < threshold
+            tied = np.flatnonzero(key == threshold)
+            need = limit - int(better.sum())
+            tied = tied[np.argsort(slots[tied], kind='stable')[:need]]
+            chosen = np.concatenate((np.flatnonzero(better), tied))
+            more = True
+        else:
+            chosen = np.arange(len(slots))
+            more = False
+        chosen = chosen[np.lexsort((slots[chosen], key[chosen]))]
+        page_slots = slots[chosen].tolist()
+        ids = [self._slot_ids[slot] for slot in page_slots]
+        if not more or not ids:
+            return ids, None
+        last = page_slots[-1]
+        return ids, [-float(key[chosen[-1]]) if descending else float(key[chosen[-1]]), last]
+
+    def columns(self, active_only=False, device_type=None, location=None):
+        """Columnar snapshot for vectorized consumers
+
+        Returns ``(device_ids, device_types, locations, power)`` where
+        ``power`` is an ``array('d')`` aligned with the id list. Filters are
+        resolved through the secondary indexes.
+        """
+        with self._lock:
+            if device_type is None and location is None:
+                records = list(self._records.values())
+                if active_only:
+                    active = self._active
+                    records = [r for r in records if active[r.slot]]
+            else:
+                ids = self.find_ids(device_type, location, True if active_only else None)
+                records = [self._records[i] for i in ids]
+            with self._power_lock:
+                source = self._power
+                power = array('d', [source[r.slot] for r in records])
+        return (
+            [r.device_id for r in records],
+            [r.device_type for r in records],
+            [r.location for r in records],
+            power,
+        )
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Load test for the AI Energy Optimizer
+Boots the real request handler on an ephemeral port and drives a concurrent client mix
+across every endpoint, reporting throughput, latency percentiles and memory growth as JSON
+"""
+
+import argparse
+import gc
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from bench_storage import percentile
+from simulator import DEVICE_TYPES, LOCATIONS, Fleet
+from telemetry import ingest_stream
+
+DEFAULT_FLEET_SIZES = (100, 1000, 10000)
+DEFAULT_CLIENTS = 8
+DEFAULT_DURATION = 5.0
+WARMUP_SECONDS = 1.0
+HISTORY_HOURS = 2
+HISTORY_STEP_SECONDS = 600
+LOAD_TEST_MODES = ('threaded', 'asyncio', 'single')
+DEFAULT_MAX_REGRESSION = 0.25
+
+# Relative weight of each request kind in the client mix
+DEFAULT_MIX = {
+    'health': 5,
+    'predictions': 10,
+    'devices_sample': 10,
+    'devices_by_power': 5,
+    'device_detail': 10,
+    'analytics_summary': 5,
+    'metrics': 1,
+    'optimize': 5,
+    'schedule': 2,
+    'telemetry_ingest': 10,
+    'devices_batch': 3,
+    'not_found': 1,
+}
+
+
+# ----------------------------------------------------------------------
+# Requests
+# ----------------------------------------------------------------------
+
+def _ingest_body(rng, device_ids, readings=200):
+    now = time.time()
+    lines = [f"{rng.choice(device_ids)},{now:.3f},{rng.uniform(0.1, 5.0):.3f}" for _ in range(readings)]
+    return '\n'.join(lines).encode(), 'text/csv'
+
+
+def build_request(kind, rng, device_ids):
+    """``(method, path, body, content_type)`` for one request of ``kind``"""
+    if kind == 'health':
+        return 'GET', '/health', None, None
+    if kind == 'predictions':
+        return 'GET', f"/predictions?hours={rng.choice((6, 24, 48))}", None, None
+    if kind == 'devices_sample':
+        return 'GET', f"/devices/sample?limit=100&device_type={rng.choice(DEVICE_TYPES)}", None, None
+    if kind == 'devices_by_power':
+        return 'GET', '/devices/sample?limit=50&sort=-current_power&fields=device_id,current_power', \
+            None, None
+    if kind == 'device_detail':
+        return 'GET', f"/devices/{rng.choice(device_ids)}", None, None
+    if kind == 'analytics_summary':
+        return 'GET', f"/analytics/summary?location={rng.choice(LOCATIONS)}", None, None
+    if kind == 'metrics':
+        return 'GET', '/metrics', None, None
+    if kind == 'optimize':
+        return 'POST', '/optimize', json.dumps({"top_k": 10}).encode(), 'application/json'
+    if kind == 'schedule':
+        return 'POST', '/schedule', b'{}', 'application/json'
+    if kind == 'telemetry_ingest':
+        body, content_type = _ingest_body(rng, device_ids)
+        return 'POST', '/telemetry/ingest', body, content_type
+    if kind == 'devices_batch':
+        operations = [{"op": "toggle", "device_id": rng.choice(device_ids)} for _ in range(2)]
+        # Toggling a device twice in one batch is legal and leaves the fleet as it was
+        operations += operations
+        return 'POST', '/devices/batch', json.dumps({"operations": operations}).encode(), \
+            'application/json'
+    if kind == 'not_found':
+        return 'GET', '/no/such/endpoint', None, None
+    raise ValueError(f"unknown request kind '{kind}'")
+
+
+def parse_mix(text):
+    """``name=weight,...`` on top of DEFAULT_MIX; a weight of 0 drops a kind"""
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"unknown request kind '{name}'")
+        mix[name] = float(weight)
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+    if not mix:
+        raise ValueError("the mix must contain at least one request kind")
+    return mix
+
+
+# ----------------------------------------------------------------------
+# Fleet and process state
+# ----------------------------------------------------------------------
+
+def rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def replace_devices(registry, devices, chunk=5000):
+    """Swap every registered device for ``devices``, a few batches at a time"""
+    existing = [device['device_id'] for device in registry.to_list()]
+    for start in range(0, len(existing), chunk):
+        registry.apply_batch([{"op": "delete", "device_id": device_id}
+                              for device_id in existing[start:start + chunk]])
+    for start in range(0, len(devices), chunk):
+        registry.apply_batch([{"op": "add", "device_id": device['device_id'], "device": device}
+                              for device in devices[start:start + chunk]])
+
+
+def load_fleet(server, size, seed=0, chunk=5000):
+    """Replace the server's devices with ``size`` simulated ones plus recent history"""
+    registry = server.DEVICES
+    fleet = Fleet(size, seed)
+    replace_devices(registry, fleet.devices(), chunk)
+
+    # A little history so forecasts and rollups have data to work with
+    steps = HISTORY_HOURS * 3600 // HISTORY_STEP_SECONDS
+    for readings in fleet.iter_readings(time.time() - HISTORY_HOURS * 3600, steps, HISTORY_STEP_SECONDS, chunk):
+        ingest_stream(iter(readings), registry, server.TELEMETRY)
+    return fleet.device_ids()
+
+
+# ----------------------------------------------------------------------
+# Client mix
+# ----------------------------------------------------------------------
+
+def _client(port, mix, device_ids, deadline, seed, samples):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            method, path, body, content_type = build_request(kind, rng, device_ids)
+            headers = {'Content-Type': content_type} if content_type else {}
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                status = 0
+            samples.append((kind, status, time.perf_counter() - started))
+    finally:
+        conn.close()
+
+
+def run_mix(port, mix, device_ids, clients, duration, seed=0):
+    """Run ``clients`` keep-alive clients for ``duration`` seconds; returns (samples, elapsed)"""
+    samples = []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=_client, args=(port, mix, device_ids, deadline, seed + n, samples))
+               for n in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def _latency_ms(latencies):
+    return {
+        "p50": round(percentile(latencies, 50) * 1000.0, 3),
+        "p95": round(percentile(latencies, 95) * 1000.0, 3),
+        "p99": round(percentile(latencies, 99) * 1000.0, 3),
+        "max": round(max(latencies, default=0.0) * 1000.0, 3)
+    }
+
+
+def summarize(samples, elapsed):
+    """Throughput, latency percentiles and status counts, overall and per request kind"""
+    by_kind = {}
+    for kind, status, latency in samples:
+        by_kind.setdefault(kind, []).append((status, latency))
+    endpoints = {}
+    for kind, rows in sorted(by_kind.items()):
+        statuses = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        endpoints[kind] = {
+            "requests": len(rows),
+            "requests_per_second": round(len(rows) / elapsed, 1),
+            "errors": sum(1 for status, _ in rows if status == 0 or status >= 500),
+            "statuses": statuses,
+            "latency_ms": _latency_ms([latency for _, latency in rows])
+        }
+    return {
+        "requests": len(samples),
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": _latency_ms([latency for _, _, latency in samples]),
+        "endpoints": endpoints
+    }
+
+
+# ----------------------------------------------------------------------
+# Runs
+# ----------------------------------------------------------------------
+
+def run_load_test(fleet_sizes=DEFAULT_FLEET_SIZES, clients=DEFAULT_CLIENTS, duration=DEFAULT_DURATION,
+                  mix=None, mode='threaded', workers=None, warmup=WARMUP_SECONDS, seed=0,
+                  access_log=False):
+    """Boot the server, run the mix once per fleet size and return the report dict"""
+    import simple_server
+    from server_modes import create_server
+
+    if mode not in LOAD_TEST_MODES:
+        raise ValueError(f"mode must be one of {', '.join(LOAD_TEST_MODES)}")
+    mix = mix or dict(DEFAULT_MIX)
+    access_log_enabled = simple_server.ACCESS_LOG.enabled
+    simple_server.ACCESS_LOG.enabled = access_log
+    httpd = create_server(mode, ('127.0.0.1', 0), simple_server.EnergyOptimizerHandler, workers)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    port = httpd.server_address[1]
+    original_devices = simple_server.DEVICES.to_list()
+    results = []
+    try:
+        for size in fleet_sizes:
+            device_ids = load_fleet(simple_server, size, seed)
+            gc.collect()
+            rss_loaded = rss_bytes()
+            if warmup > 0:
+                run_mix(port, mix, device_ids, clients, warmup, seed)
+            gc.collect()
+            rss_warm = rss_bytes()
+            samples, elapsed = run_mix(port, mix, device_ids, clients, duration, seed + 1000)
+            gc.collect()
+            rss_end = rss_bytes()
+            result = {"fleet_size": size, **summarize(samples, elapsed)}
+            # Growth after warm-up is what points at a leak; warm-up growth is caches filling
+            result["memory_mb"] = {
+                "rss_after_fleet_load": round(rss_loaded / 2 ** 20, 1),
+                "rss_after_warmup": round(rss_warm / 2 ** 20, 1),
+                "rss_end": round(rss_end / 2 ** 20, 1),
+                "growth_during_run": round((rss_end - rss_warm) / 2 ** 20, 1)
+            }
+            results.append(result)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        simple_server.ACCESS_LOG.enabled = access_log_enabled
+        replace_devices(simple_server.DEVICES, original_devices)
+
+    return {
+        "config": {
+            "mode": mode,
+            "clients": clients,
+            "duration_seconds": duration,
+            "warmup_seconds": warmup,
+            "fleet_sizes": list(fleet_sizes),
+            "mix": mix,
+            "python": sys.version.split()[0]
+        },
+        "results": results
+    }
+
+
+def compare(report, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """Regressions of ``report`` against ``baseline`` for fleet sizes both measured
+
+    A regression is throughput falling, or p95 latency rising, by more than
+    ``max_regression`` (a fraction) overall or for any request kind.
+    """
+    previous = {result["fleet_size"]: result for result in baseline.get("results", ())}
+    regressions = []
+
+    def check(fleet_size, scope, current, before):
+        if before["requests_per_second"] and \
+                current["requests_per_second"] < before["requests_per_second"] * (1 - max_regression):
+            regressions.append({"fleet_size": fleet_size, "scope": scope, "metric": "requests_per_second",
+                                "baseline": before["requests_per_second"],
+                                "current": current["requests_per_second"]})
+        if before["latency_ms"]["p95"] and \
+                current["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + max_regression):
+            regressions.append({"fleet_size": fleet_size, "scope": scope, "metric": "p95_ms",
+                                "baseline": before["latency_ms"]["p95"],
+                                "current": current["latency_ms"]["p95"]})
+
+    for result in report["results"]:
+        before = previous.get(result["fleet_size"])
+        if before is None:
+            continue
+        check(result["fleet_size"], "overall", result, before)
+        for kind, endpoint in result["endpoints"].items():
+            if kind in before.get("endpoints", {}):
+                check(result["fleet_size"], kind, endpoint, before["endpoints"][kind])
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point; exits 1 on errors or regressions against --baseline"""
+    parser = argparse.ArgumentParser(description="Load test the AI Energy Optimizer server")
+    parser.add_argument('--fleet-sizes', default=','.join(map(str, DEFAULT_FLEET_SIZES)),
+                        help="comma-separated device counts (default: %(default)s)")
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help="concurrent clients")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help="measured seconds per fleet size")
+    parser.add_argument('--warmup', type=float, default=WARMUP_SECONDS)
+    parser.add_argument('--mix', default='',
+                        help="weights overriding the default mix, e.g. predictions=20,metrics=0")
+    parser.add_argument('--mode', choices=LOAD_TEST_MODES, default='threaded')
+    parser.add_argument('--workers', type=int, default=0, help="asyncio worker threads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    parser.add_argument('--baseline', help="JSON report to compare against")
+    parser.add_argument('--max-regression', type=float, default=DEFAULT_MAX_REGRESSION,
+                        help="allowed throughput drop / p95 rise as a fraction (default: %(default)s)")
+    parser.add_argument('--access-log', action='store_true', help="keep the server's access log on")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    print("🧪 Load testing the energy optimizer server...", file=sys.stderr)
+    report = run_load_test([int(size) for size in args.fleet_sizes.split(',') if size.strip()],
+                           args.clients, args.duration, parse_mix(args.mix), args.mode,
+                           args.workers or None, args.warmup, args.seed, args.access_log)
+    failed = any(result["errors"] for result in report["results"])
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.max_regression)
+        failed = failed or bool(report["regressions"])
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if failed:
+        print("❌ Load test found errors or regressions", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Runtime metrics for the AI Energy Optimizer
+Per-route counters, latency histograms and gauges in Prometheus text format, plus a
+buffered access log written off the request path
+"""
+
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'energy_'
+
+ACCESS_LOG_FLUSH_INTERVAL = 0.5
+ACCESS_LOG_MAX_PENDING = 10000
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Fixed-bucket histogram with quantiles interpolated inside the buckets"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimated ``q`` quantile; 0.0 before the first observation"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= target:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index]
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+
+class _RouteStats:
+    __slots__ = ('statuses', 'latency', 'in_flight')
+
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram()
+        self.in_flight = 0
+
+
+class MetricsRegistry:
+    """Request metrics per ``(method, route)``, named counters and collectors
+
+    Routes are the route table patterns, so ``/devices/{device_id}`` is
+    one series however many devices exist. Collectors are callables
+    returning ``(name, type, help, value)`` tuples, where value is a number
+    or a list of ``(labels, number)`` pairs; they are read at scrape time so
+    components keep their own counters and pay nothing per request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._counters = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def request_started(self, method, route):
+        with self._lock:
+            stats = self._routes.get((method, route))
+            if stats is None:
+                stats = self._routes[(method, route)] = _RouteStats()
+            stats.in_flight += 1
+        return stats
+
+    def request_finished(self, stats, status, seconds):
+        with self._lock:
+            stats.in_flight -= 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency.observe(seconds)
+
+    def inc(self, name, value=1, help='', **labels):
+        """Add ``value`` to the counter ``name`` with ``labels``"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.get(name)
+            if series is None:
+                series = self._counters[name] = (help, {})
+            series[1][key] = series[1].get(key, 0) + value
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """Per-route request counts and latency quantiles as plain data"""
+        with self._lock:
+            return {
+                f"{method} {route}": {
+                    "requests": sum(stats.statuses.values()),
+                    "in_flight": stats.in_flight,
+                    **{f"p{round(q * 100)}": round(stats.latency.quantile(q), 6) for q in QUANTILES}
+                }
+                for (method, route), stats in self._routes.items()
+            }
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{PREFIX}{name}{suffix}{_labels(labels)} {_number(value)}")
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+            requests, buckets, quantiles, in_flight = [], [], [], []
+            for (method, route), stats in routes:
+                base = (('route', route), ('method', method))
+                for status, count in sorted(stats.statuses.items()):
+                    requests.append(('', base + (('status', status),), count))
+                latency = stats.latency
+                cumulative = 0
+                for bound, count in zip(latency.bounds + (float('inf'),), latency.counts):
+                    cumulative += count
+                    buckets.append(('_bucket', base + (('le', _number(bound)),), cumulative))
+                buckets.append(('_sum', base, latency.sum))
+                buckets.append(('_count', base, latency.count))
+                for q in QUANTILES:
+                    quantiles.append(('', base + (('quantile', q),), latency.quantile(q)))
+                in_flight.append(('', base, stats.in_flight))
+            counters = [(name, help_text, sorted(series.items()))
+                        for name, (help_text, series) in sorted(self._counters.items())]
+
+        family('http_requests_total', 'counter', 'Requests handled by route, method and status',
+               requests)
+        family('http_request_duration_seconds', 'histogram', 'Request latency by route', buckets)
+        family('http_request_duration_quantile_seconds', 'gauge',
+               'Estimated p50/p95/p99 request latency by route', quantiles)
+        family('http_requests_in_flight', 'gauge', 'Requests being handled right now', in_flight)
+        for name, help_text, series in counters:
+            family(name, 'counter', help_text or name, [('', labels, value) for labels, value in series])
+        family('uptime_seconds', 'gauge', 'Seconds since the metrics registry was created',
+               [('', (), round(time.time() - self.started, 3))])
+
+        for collector in self._collectors:
+            for name, kind, help_text, value in collector():
+                if isinstance(value, (list, tuple)):
+                    samples = [('', tuple(labels.items()), sample) for labels, sample in value]
+                else:
+                    samples = [('', (), value)]
+                family(name, kind, help_text, samples)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class AccessLog:
+    """Access log lines queued by request threads and written in batches
+
+    A background thread drains the queue and writes everything pending
+    with one call, so handlers never block on the log stream. The thread
+    starts on first use, which also covers pre-forked workers. When more
+    than ``max_pending`` lines are waiting the newest are dropped and
+    counted rather than growing memory without bound.
+    """
+
+    def __init__(self, stream=None, flush_interval=ACCESS_LOG_FLUSH_INTERVAL,
+                 max_pending=ACCESS_LOG_MAX_PENDING):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enabled = True
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def write(self, line):
+        if not self.enabled:
+            return
+        if self._thread is None:
+            self._start()
+        if self._queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return
+        self._queue.put(line)
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                return
+            # Give the burst a moment to accumulate, then write it in one go
+            time.sleep(self.flush_interval)
+            lines = [line]
+            stop = False
+            while True:
+                try:
+                    line = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    stop = True
+                    break
+                lines.append(line)
+            self._write(''.join(lines))
+            if stop:
+                return
+
+    def _write(self, text):
+        stream = self.stream or sys.stderr
+        try:
+            stream.write(text)
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        """Write out everything queued and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Optimization engine for the AI Energy Optimizer
+Scores candidate actions for every active device with vectorized NumPy operations
+"""
+
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Candidate actions per device type:
+#   (action, fraction of the device's power saved, comfort impact 0-1, load shifting)
+ACTIONS = {
+    'thermostat': [
+        ('lower_temp', 0.12, 0.40, False),
+        ('schedule_optimization', 0.10, 0.15, True),
+        ('eco_mode', 0.08, 0.10, False),
+    ],
+    'lighting': [
+        ('dim_lights', 0.25, 0.30, False),
+        ('motion_sensors', 0.30, 0.05, False),
+        ('led_upgrade', 0.50, 0.00, False),
+    ],
+    'hvac': [
+        ('zone_control', 0.20, 0.25, False),
+        ('maintenance', 0.10, 0.00, False),
+        ('smart_scheduling', 0.15, 0.10, True),
+    ],
+    'appliances': [
+        ('delay_operation', 0.30, 0.20, True),
+        ('eco_mode', 0.12, 0.05, False),
+        ('power_management', 0.08, 0.05, False),
+    ],
+    'other': [
+        ('power_management', 0.08, 0.05, False),
+    ],
+}
+
+# Weekday hours when grid prices and demand peak; load shifting pays off more here
+PEAK_HOURS = range(17, 21)
+PEAK_SHIFT_MULTIPLIER = 1.5
+OFF_PEAK_SHIFT_MULTIPLIER = 0.5
+
+# Returning an anomalous device to its usual draw costs little comfort, but not none
+BOOST_COMFORT_IMPACT = 0.05
+
+DEFAULT_TOP_K = 12
+MAX_HOURS = 8760
+MAX_TOP_K = 10000
+HIGH_PRIORITY_SAVINGS = 0.3
+
+
+def _action_tables(peak):
+    """Per-type arrays of actions ordered by savings, with compounded fractions
+
+    Applying several actions to one device does not add their savings: the
+    second action acts on the power left after the first. Ordering each
+    type's actions by savings and compounding the fractions keeps every
+    candidate's expected savings additive.
+    """
+    types = sorted(ACTIONS)
+    width = max(len(actions) for actions in ACTIONS.values())
+    names = np.full((len(types), width), '', dtype=object)
+    fractions = np.zeros((len(types), width))
+    comfort = np.zeros((len(types), width))
+    for row, device_type in enumerate(types):
+        adjusted = []
+        for action, fraction, impact, shifting in ACTIONS[device_type]:
+            if shifting:
+                fraction *= PEAK_SHIFT_MULTIPLIER if peak else OFF_PEAK_SHIFT_MULTIPLIER
+            adjusted.append((fraction, action, impact))
+        adjusted.sort(reverse=True)
+        remaining = 1.0
+        for col, (fraction, action, impact) in enumerate(adjusted):
+            names[row, col] = action
+            fractions[row, col] = remaining * fraction
+            comfort[row, col] = impact
+            remaining *= 1.0 - fraction
+    return types, names, fractions, comfort
+
+
+_TABLES = {peak: _action_tables(peak) for peak in (False, True)}
+
+
+def optimize_arrays(device_ids, device_types, power, top_k=DEFAULT_TOP_K, comfort_budget=None,
+                    actions_per_device=3, hours=1.0, peak=False, boosts=None):
+    """Rank candidate actions for devices given as parallel arrays
+
+    ``power`` is the current draw in kW of each device. Returns the response
+    payload for /optimize. ``boosts`` optionally maps device ids to extra
+    recommendations (action, savings fraction) that outrank the table, e.g.
+    devices flagged by anomaly detection. A boosted device gets its boost
+    instead of table actions, and boosts count against ``comfort_budget``.
+    """
+    types, names, fractions, comfort = _TABLES[bool(peak)]
+    power = np.asarray(power, dtype=np.float64)
+    count = len(power)
+    width = names.shape[1]
+    actions_per_device = max(1, min(int(actions_per_device), width))
+
+    type_codes = {device_type: code for code, device_type in enumerate(types)}
+    fallback = type_codes['other']
+    codes = np.fromiter((type_codes.get(t, fallback) for t in device_types), dtype=np.intp,
+                        count=count)
+
+    # (devices x actions) candidate matrices; unused action slots save nothing
+    savings = power[:, None] * fractions[codes, :actions_per_device] * hours
+    impact = comfort[codes, :actions_per_device]
+
+    boosted = []
+    if boosts:
+        positions = {device_id: d for d, device_id in enumerate(device_ids)}
+        for device_id, (action, fraction) in boosts.items():
+            d = positions.get(device_id)
+            if d is not None and power[d] * fraction > 0:
+                boosted.append((float(power[d]) * fraction * hours, d, action))
+        boosted.sort(key=lambda boost: -boost[0])
+        if comfort_budget is not None:
+            # Boosts are taken first, as far as the budget allows
+            affordable = np.cumsum(np.full(len(boosted), BOOST_COMFORT_IMPACT)) <= comfort_budget
+            boosted = boosted[:int(affordable.sum())]
+        # A boost replaces the device's table actions, so its savings are never counted twice
+        savings[[d for _, d, _ in boosted]] = 0.0
+    boost_comfort = BOOST_COMFORT_IMPACT * len(boosted)
+    table_k = max(0, top_k - len(boosted))
+
+    flat_savings = savings.ravel()
+    flat_impact = impact.ravel()
+    candidates = np.flatnonzero(flat_savings > 0)
+
+    if comfort_budget is None:
+        # Only the top_k best candidates are needed: partition, then sort those
+        k = min(table_k, len(candidates))
+        best = candidates[np.argpartition(-flat_savings[candidates], k - 1)[:k]] if k else candidates[:0]
+        chosen = best[np.argsort(-flat_savings[best], kind='stable')]
+    else:
+        # Greedy knapsack: best savings per unit of comfort first, within what boosts left
+        ratio = flat_savings[candidates] / (flat_impact[candidates] + 1e-3)
+        ordered = candidates[np.argsort(-ratio, kind='stable')]
+        within = np.cumsum(flat_impact[ordered]) <= comfort_budget - boost_comfort
+        chosen = ordered[within][:table_k]
+
+    device_index, action_index = np.divmod(chosen, actions_per_device)
+    chosen_types = codes[device_index]
+    recommendations = [{
+        'device_id': device_ids[d],
+        'recommended_action': action,
+        'expected_savings': round(saved, 2),
+        'priority': 'high'
+    } for saved, d, action in boosted]
+    for d, a, t, saved in zip(device_index.tolist(), action_index.tolist(),
+                              chosen_types.tolist(), flat_savings[chosen].tolist()):
+        recommendations.append({
+            'device_id': device_ids[d],
+            'recommended_action': names[t, a],
+            'expected_savings': round(saved, 2),
+            'priority': 'high' if saved > HIGH_PRIORITY_SAVINGS else 'medium'
+        })
+
+    current_usage = float(power.sum()) * hours
+    total_savings = sum(r['expected_savings'] for r in recommendations)
+    savings_percentage = (total_savings / current_usage) * 100 if current_usage > 0 else 0.0
+
+    return {
+        "recommendations": recommendations,
+        "total_potential_savings": round(total_savings, 2),
+        "savings_percentage": round(savings_percentage, 1),
+        "current_usage": round(current_usage, 2),
+        "devices_evaluated": count,
+        "comfort_used": round(boost_comfort + float(flat_impact[chosen].sum()), 2),
+        "peak_hours": bool(peak)
+    }
+
+
+def is_peak(when=None):
+    """True during weekday peak-tariff hours"""
+    when = when or datetime.now()
+    return when.weekday() < 5 and when.hour in PEAK_HOURS
+
+
+def optimize_fleet(registry, options=None, boosts=None):
+    """Optimize every active device in ``registry`` using request ``options``
+
+    Recognized options: ``top_k``, ``comfort_budget``, ``actions_per_device``,
+    ``hours``, ``device_type``, ``location`` and ``peak`` (defaults to the
+    current time of day).
+    """
+    options = options or {}
+    top_k = max(1, min(int(options.get('top_k', DEFAULT_TOP_K)), MAX_TOP_K))
+    comfort_budget = options.get('comfort_budget')
+    if comfort_budget is not None:
+        comfort_budget = float(comfort_budget)
+    hours = float(options.get('hours', 1.0))
+    if not (math.isfinite(hours) and 0 < hours <= MAX_HOURS):
+        raise ValueError(f"hours must be a number above 0 and at most {MAX_HOURS}")
+    peak = options.get('peak')
+    peak = is_peak() if peak is None else bool(peak)
+
+    started = time.perf_counter()
+    device_ids, device_types, _locations, power = registry.columns(
+        active_only=True, device_type=options.get('device_type'), location=options.get('location'))
+    response = optimize_arrays(device_ids, device_types, np.frombuffer(power, dtype=np.float64),
+                               top_k=top_k, comfort_budget=comfort_budget,
+                               actions_per_device=options.get('actions_per_device', 3),
+                               hours=hours, peak=peak, boosts=boosts)
+    response["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return response
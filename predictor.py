@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Energy prediction engine for the AI Energy Optimizer
+Per-device seasonal regression models trained incrementally from telemetry
+"""
+
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+MAX_HORIZON_HOURS = 168
+HOUR_SECONDS = 3600.0
+DAY_HARMONICS = 3
+WEEK_HARMONICS = 2
+RIDGE_LAMBDA = 1e-3
+RETRAIN_INTERVAL = 30.0
+
+# A device needs this many samples before its own model replaces the prior
+MIN_SAMPLES = 48
+PRIOR_CONFIDENCE = 0.6
+
+
+def _utc_offset_seconds():
+    offset = datetime.now().astimezone().utcoffset()
+    return offset.total_seconds() if offset else 0.0
+
+
+def build_features(timestamps, utc_offset=0.0):
+    """Feature matrix for epoch timestamps, one row per timestamp
+
+    Columns are an intercept, daily and weekly Fourier harmonics and a
+    yearly (month/season) harmonic pair, all computed in one vectorized pass.
+    """
+    t = np.asarray(timestamps, dtype=np.float64) + utc_offset
+    hours = t / HOUR_SECONDS
+    day_phase = (2.0 * np.pi / 24.0) * hours
+    # Epoch day 0 was a Thursday; shift so the weekly phase starts on Monday
+    week_phase = (2.0 * np.pi / 168.0) * (hours + 72.0)
+    year_phase = (2.0 * np.pi / (365.25 * 24.0)) * hours
+
+    columns = [np.ones_like(t)]
+    for k in range(1, DAY_HARMONICS + 1):
+        columns.append(np.sin(k * day_phase))
+        columns.append(np.cos(k * day_phase))
+    for k in range(1, WEEK_HARMONICS + 1):
+        columns.append(np.sin(k * week_phase))
+        columns.append(np.cos(k * week_phase))
+    columns.append(np.sin(year_phase))
+    columns.append(np.cos(year_phase))
+    return np.stack(columns, axis=1)
+
+
+FEATURE_COUNT = 1 + 2 * DAY_HARMONICS + 2 * WEEK_HARMONICS + 2
+
+
+class _DeviceModel:
+    """Sufficient statistics and the cached fit for one device"""
+
+    __slots__ = ('xtx', 'xty', 'yty', 'count', 'weights', 'rmse', 'mean', 'dirty')
+
+    def __init__(self):
+        self.xtx = np.zeros((FEATURE_COUNT, FEATURE_COUNT))
+        self.xty = np.zeros(FEATURE_COUNT)
+        self.yty = 0.0
+        self.count = 0
+        self.weights = None
+        self.rmse = 0.0
+        self.mean = 0.0
+        self.dirty = False
+
+    @property
+    def confidence(self):
+        if self.weights is None:
+            return PRIOR_CONFIDENCE
+        scale = max(abs(self.mean), 1e-6)
+        return float(np.clip(1.0 - self.rmse / (scale + self.rmse), 0.5, 0.99))
+
+
+def fit_models(models):
+    """Closed-form ridge solve for many models in one batched call"""
+    xtx = np.stack([model.xtx for model in models])
+    xty = np.stack([model.xty for model in models])
+    counts = np.array([model.count for model in models], dtype=np.float64)
+    yty = np.array([model.yty for model in models])
+
+    penalty = np.eye(FEATURE_COUNT)
+    penalty[0, 0] = 0.0  # Never shrink the intercept
+    weights = np.linalg.solve(xtx + RIDGE_LAMBDA * counts[:, None, None] * penalty,
+                              xty[:, :, None])[:, :, 0]
+    sse = yty - 2.0 * np.einsum('ki,ki->k', weights, xty) \
+        + np.einsum('ki,kij,kj->k', weights, xtx, weights)
+    rmse = np.sqrt(np.maximum(sse, 0.0) / counts)
+
+    for model, w, error, total, count in zip(models, weights, rmse.tolist(),
+                                             xty[:, 0].tolist(), counts.tolist()):
+        model.weights = w
+        model.rmse = error
+        model.mean = total / count
+        model.dirty = False
+
+
+class EnergyPredictor:
+    """Forecasts hourly energy use per device and for the whole fleet
+
+    Each device keeps the running sums ``X'X``, ``X'y`` and ``y'y`` of a
+    linear model over seasonal features, so new telemetry is folded in
+    without revisiting history and refitting is a small linear solve.
+    Fitted weights are cached; the fleet forecast is the sum of the device
+    weight vectors, so inference costs one matrix-vector product regardless
+    of how many devices are modelled.
+    """
+
+    def __init__(self, registry, retrain_interval=RETRAIN_INTERVAL):
+        self.registry = registry
+        self.retrain_interval = retrain_interval
+        self.utc_offset = _utc_offset_seconds()
+        self._models = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._fleet_cache = None
+        self._model_version = 0
+        self._worker = None
+        self._stop = threading.Event()
+        self._listeners = []
+        self.last_trained = None
+
+    def add_listener(self, callback):
+        """Call ``callback()`` whenever a training pass changes the forecasts"""
+        self._listeners.append(callback)
+
+    # ------------------------------------------------------------------
+    # Training
+    # ------------------------------------------------------------------
+
+    def observe(self, readings):
+        """Queue ``(device_id, timestamp, power)`` readings for the next training pass"""
+        with self._lock:
+            self._pending.append(readings)
+
+    def fit_history(self, device_id, timestamps, powers):
+        """Fold a device's stored history into its model"""
+        self._accumulate(np.zeros(len(timestamps), dtype=np.intp), [device_id],
+                         np.asarray(timestamps, dtype=np.float64),
+                         np.asarray(powers, dtype=np.float64))
+
+    def train_from_store(self, store, device_ids=None, since=0.0):
+        """Load stored readings for every registered device"""
+        if device_ids is None:
+            device_ids = [device['device_id'] for device in self.registry.to_list()]
+        for device_id in device_ids:
+            rows = store.readings(device_id, since)
+            if rows:
+                data = np.asarray(rows, dtype=np.float64)
+                self.fit_history(device_id, data[:, 0], data[:, 1])
+        self.refresh()
+
+    def _accumulate(self, index, keys, timestamps, powers):
+        """Add one batch to the per-device statistics (vectorized per batch)"""
+        features = build_features(timestamps, self.utc_offset)
+        size = len(keys)
+        xtx = np.empty((size, FEATURE_COUNT, FEATURE_COUNT))
+        xty = np.empty((size, FEATURE_COUNT))
+        # One weighted bincount per upper-triangle entry groups the products
+        # by device without materializing an (n, d, d) outer-product array
+        for i in range(FEATURE_COUNT):
+            column = features[:, i]
+            xty[:, i] = np.bincount(index, weights=column * powers, minlength=size)
+            for j in range(i, FEATURE_COUNT):
+                xtx[:, i, j] = xtx[:, j, i] = np.bincount(
+                    index, weights=column * features[:, j], minlength=size)
+        yty = np.bincount(index, weights=powers * powers, minlength=size)
+        counts = np.bincount(index, minlength=size)
+        with self._lock:
+            for i, key in enumerate(keys):
+                model = self._models.get(key)
+                if model is None:
+                    model = self._models[key] = _DeviceModel()
+                model.xtx += xtx[i]
+                model.xty += xty[i]
+                model.yty += float(yty[i])
+                model.count += int(counts[i])
+                model.dirty = True
+
+    def refresh(self):
+        """Fold queued telemetry into the statistics and refit changed models"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            readings = [reading for batch in pending for reading in batch]
+            ids, timestamps, powers = zip(*readings)
+            positions = {}
+            index = np.fromiter((positions.setdefault(i, len(positions)) for i in ids),
+                                dtype=np.intp, count=len(ids))
+            self._accumulate(index, list(positions), np.asarray(timestamps, dtype=np.float64),
+                             np.asarray(powers, dtype=np.float64))
+            # New readings also moved current_power, which feeds the priors
+            self._fleet_cache = None
+
+        with self._lock:
+            stale = [model for model in self._models.values()
+                     if model.dirty and model.count >= MIN_SAMPLES]
+            refitted = len(stale)
+            if stale:
+                fit_models(stale)
+                self._model_version += 1
+                self._fleet_cache = None
+        self.last_trained = time.time()
+        if pending or refitted:
+            for callback in self._listeners:
+                callback()
+        return refitted
+
+    # ------------------------------------------------------------------
+    # Background worker
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Retrain every ``retrain_interval`` seconds on a daemon thread"""
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name='energy-predictor', daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.retrain_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ Prediction model retraining failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    # ------------------------------------------------------------------
+    # Inference
+    # ------------------------------------------------------------------
+
+    def _fleet_model(self):
+        """Summed weights of trained active devices plus a flat prior for the rest"""
+        key = (self.registry.version, self._model_version)
+        cached = self._fleet_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        weights = np.zeros(FEATURE_COUNT)
+        prior = 0.0
+        variance = 0.0
+        total_mean = 0.0
+        ids, _types, _locations, power = self.registry.columns(active_only=True)
+        with self._lock:
+            for device_id, current_power in zip(ids, power):
+                model = self._models.get(device_id)
+                if model is not None and model.weights is not None:
+                    weights += model.weights
+                    variance += model.rmse ** 2
+                    total_mean += abs(model.mean)
+                else:
+                    prior += current_power
+                    total_mean += current_power
+        weights[0] += prior
+        rmse = float(np.sqrt(variance))
+        if total_mean > 0:
+            trained_share = 1.0 - prior / total_mean
+            fitted_conf = 1.0 - rmse / (total_mean + rmse)
+            confidence = trained_share * fitted_conf + (1.0 - trained_share) * PRIOR_CONFIDENCE
+        else:
+            confidence = PRIOR_CONFIDENCE
+        result = (weights, float(np.clip(confidence, 0.5, 0.99)))
+        self._fleet_cache = (key, result)
+        return result
+
+    def _device_model(self, device_id):
+        device = self.registry.get(device_id)
+        if device is None:
+            raise KeyError(device_id)
+        with self._lock:
+            model = self._models.get(device_id)
+            if model is not None and model.weights is not None:
+                return model.weights.copy(), model.confidence
+        weights = np.zeros(FEATURE_COUNT)
+        weights[0] = device['current_power'] if device['is_active'] else 0.0
+        return weights, PRIOR_CONFIDENCE
+
+    def predict(self, hours=24, device_id=None, now=None):
+        """Hourly forecast as the /predictions response payload"""
+        if not 1 <= hours <= MAX_HORIZON_HOURS:
+            raise ValueError(f"hours must be between 1 and {MAX_HORIZON_HOURS}")
+        if self._worker is None and self._pending:
+            self.refresh()
+
+        if device_id is None:
+            weights, confidence = self._fleet_model()
+        else:
+            weights, confidence = self._device_model(device_id)
+
+        now = time.time() if now is None else now
+        start = now - now % HOUR_SECONDS
+        timestamps = start + HOUR_SECONDS * np.arange(hours)
+        # Mean kW over each hour equals that hour's kWh
+        usage = np.maximum(build_features(timestamps + HOUR_SECONDS / 2, self.utc_offset) @ weights,
+                           0.0)
+        # Confidence decays slowly with distance into the horizon
+        confidences = confidence * (1.0 - 0.001 * np.arange(hours))
+        usage_rounded = np.round(usage, 2).tolist()
+        confidence_rounded = np.round(confidences, 2).tolist()
+
+        predictions = [{
+            'timestamp': datetime.fromtimestamp(ts).isoformat(),
+            'predicted_usage': u,
+            'confidence': c
+        } for ts, u, c in zip(timestamps.tolist(), usage_rounded, confidence_rounded)]
+
+        return {
+            "predictions": predictions,
+            "total_predicted_usage": round(float(usage.sum()), 2),
+            "average_confidence": round(float(confidences.mean()), 2),
+            "device_id": device_id,
+            "hours": hours
+        }
+
+    def status(self):
+        """Summary of what the models have learned so far"""
+        with self._lock:
+            trained = sum(1 for model in self._models.values() if model.weights is not None)
+            samples = sum(model.count for model in self._models.values())
+        return {
+            "trained_devices": trained,
+            "samples": samples,
+            "last_trained": datetime.fromtimestamp(self.last_trained).isoformat()
+            if self.last_trained else None
+        }
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Request profiling for the AI Energy Optimizer
+Opt-in per-route sampling with cProfile (pstats output) or a stack sampler (collapsed stacks)
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_MODES = ('cprofile', 'stack')
+DEFAULT_SAMPLE_RATE = 0.1
+STACK_INTERVAL = 0.005
+MAX_STACK_DEPTH = 64
+PSTATS_SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RequestProfiler:
+    """Profiles a random fraction of requests, aggregated per route
+
+    Disabled, ``call`` costs one attribute check before running the
+    handler. Enabled, each request on a selected route is sampled with
+    probability ``sample_rate``:
+
+    - ``cprofile`` mode runs the request under its own ``cProfile.Profile``
+      and merges the result into a per-route ``pstats.Stats``
+    - ``stack`` mode registers the request's thread with a sampler thread
+      that records the thread's call stack every ``interval`` seconds; the
+      counts are reported as collapsed stacks for flame graph tools
+
+    cProfile hooks only the calling thread, so concurrent requests on other
+    threads are unaffected.
+    """
+
+    def __init__(self, interval=STACK_INTERVAL):
+        self.enabled = False
+        self.mode = 'cprofile'
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.routes = None
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._stacks = {}
+        self._active = {}
+        self._sampler = None
+        self.sampled_requests = Counter()
+        self.started = None
+
+    def configure(self, enabled=None, mode=None, sample_rate=None, routes=None, reset=False):
+        """Change settings; ``routes`` is a list of route patterns, or None for all"""
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+            if not 0.0 < sample_rate <= 1.0:
+                raise ValueError("sample_rate must be in (0, 1]")
+        with self._lock:
+            if reset or (mode is not None and mode != self.mode):
+                self._stats = {}
+                self._stacks = {}
+                self.sampled_requests = Counter()
+            if mode is not None:
+                self.mode = mode
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            if routes is not None:
+                self.routes = set(routes) or None
+            if enabled is not None:
+                if enabled and not self.enabled:
+                    self.started = time.time()
+                self.enabled = bool(enabled)
+        if self.enabled and self.mode == 'stack':
+            self._start_sampler()
+        return self.status()
+
+    def toggle(self):
+        """Flip profiling on or off (the SIGUSR2 handler)"""
+        return self.configure(enabled=not self.enabled)
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "mode": self.mode,
+            "sample_rate": self.sample_rate,
+            "routes": sorted(self.routes) if self.routes else None,
+            "sampled_requests": dict(self.sampled_requests),
+            "since": self.started
+        }
+
+    # ------------------------------------------------------------------
+    # Request path
+    # ------------------------------------------------------------------
+
+    def call(self, route, handler, *args, **kwargs):
+        """Run ``handler``, profiling it when this request is sampled"""
+        if not self.enabled or (self.routes is not None and route not in self.routes) \
+                or random.random() >= self.sample_rate:
+            return handler(*args, **kwargs)
+        if self.mode == 'stack':
+            return self._call_sampled(route, handler, args, kwargs)
+        return self._call_cprofile(route, handler, args, kwargs)
+
+    def _call_cprofile(self, route, handler, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler owns this thread; serve the request unprofiled
+            return handler(*args, **kwargs)
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                stats = self._stats.get(route)
+                if stats is None:
+                    self._stats[route] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+                self.sampled_requests[route] += 1
+
+    def _call_sampled(self, route, handler, args, kwargs):
+        thread_id = threading.get_ident()
+        self._active[thread_id] = route
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            del self._active[thread_id]
+            with self._lock:
+                self.sampled_requests[route] += 1
+
+    # ------------------------------------------------------------------
+    # Stack sampler
+    # ------------------------------------------------------------------
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is not None and self._sampler.is_alive():
+                return
+            self._sampler = threading.Thread(target=self._sample_loop, name='profile-sampler',
+                                             daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        while self.enabled and self.mode == 'stack':
+            time.sleep(self.interval)
+            if self._active:
+                self.sample()
+
+    def sample(self):
+        """Record the current stack of every thread in a sampled request"""
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, route in list(self._active.items()):
+                frame = frames.get(thread_id)
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if labels:
+                    stacks = self._stacks.setdefault(route, Counter())
+                    stacks[';'.join(reversed(labels))] += 1
+
+    # ------------------------------------------------------------------
+    # Reports
+    # ------------------------------------------------------------------
+
+    def collapsed(self, route=None):
+        """``route;frame;frame count`` lines, the input format of flamegraph.pl"""
+        with self._lock:
+            lines = [f"{name};{stack} {count}"
+                     for name, stacks in sorted(self._stacks.items()) if route in (None, name)
+                     for stack, count in stacks.most_common()]
+        return '\n'.join(lines) + ('\n' if lines else '')
+
+    def pstats_report(self, route=None, sort='cumulative', limit=40):
+        """pstats text for one route, or for all routes merged"""
+        if sort not in PSTATS_SORT_KEYS:
+            raise ValueError(f"sort must be one of {', '.join(PSTATS_SORT_KEYS)}")
+        out = io.StringIO()
+        with self._lock:
+            selected = [stats for name, stats in sorted(self._stats.items()) if route in (None, name)]
+            if not selected:
+                return ''
+            merged = pstats.Stats(stream=out)
+            merged.add(*selected)
+            merged.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, path, route=None):
+        """Write merged cProfile data to ``path`` for snakeviz, gprof2dot and friends"""
+        with self._lock:
+            selected = [stats for name, stats in self._stats.items() if route in (None, name)]
+            if not selected:
+                return False
+            merged = pstats.Stats()
+            merged.add(*selected)
+            merged.dump_stats(path)
+        return True
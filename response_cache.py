@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Response cache for the AI Energy Optimizer
+Pre-serialized response bodies with TTL, LRU eviction and tag invalidation
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+DEFAULT_TTL = 30.0
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def cache_key(path, query=''):
+    """Normalized key for an endpoint and its query string"""
+    if not query:
+        return path
+    return f"{path}?{urlencode(sorted(parse_qsl(query, keep_blank_values=True)))}"
+
+
+def make_etag(body):
+    """Strong validator derived from the response bytes"""
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """True when an If-None-Match header value covers ``etag``"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+
+class CachedResponse:
+    """A serialized response and its validator"""
+
+    __slots__ = ('key', 'body', 'etag', 'content_type', 'expires', 'tags', 'size')
+
+    def __init__(self, key, body, content_type, expires, tags):
+        self.key = key
+        self.body = body
+        self.etag = make_etag(body)
+        self.content_type = content_type
+        self.expires = expires
+        self.tags = tags
+        self.size = len(body) + len(key) + ENTRY_OVERHEAD_BYTES
+
+
+class ResponseCache:
+    """LRU cache of response bytes bounded by a memory budget
+
+    Entries expire after ``ttl`` seconds and are dropped early when one of
+    their tags is invalidated, e.g. ``devices`` after a device mutation.
+    Each invalidation bumps the tag's generation, so a response computed
+    before it can be refused by ``put`` instead of caching stale data.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def _drop(self, entry):
+        """Remove an entry (caller holds the lock)"""
+        del self._entries[entry.key]
+        self.current_bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(entry.key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        """Fresh entry for ``key`` or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                self._drop(entry)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generations(self):
+        """Snapshot of the tag generations, taken before computing a response"""
+        with self._lock:
+            return dict(self._generations)
+
+    def put(self, key, body, content_type='application/json', tags=(), ttl=None, generations=None):
+        """Store ``body`` under ``key`` and return the new entry
+
+        With a ``generations`` snapshot the entry is only stored when none of
+        its tags has been invalidated since; the caller may still send it.
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        entry = CachedResponse(key, body, content_type, expires, tuple(tags))
+        if entry.size > self.max_bytes:
+            return entry  # Too large to cache; still usable by the caller
+        with self._lock:
+            if generations is not None and any(self._generations.get(tag, 0) != generations.get(tag, 0)
+                                               for tag in entry.tags):
+                self.stale_puts += 1
+                return entry
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._drop(previous)
+            self._entries[key] = entry
+            self.current_bytes += entry.size
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.current_bytes > self.max_bytes:
+                _, oldest = next(iter(self._entries.items()))
+                self._drop(oldest)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of ``tags``"""
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in list(self._tags.get(tag, ())):
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._drop(entry)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_puts": self.stale_puts
+        }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Request routing for the AI Energy Optimizer
+Route table with path parameters and a single-write HTTP response builder
+"""
+
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+from urllib.parse import unquote
+
+_REASONS = {status.value: status.phrase for status in HTTPStatus}
+
+
+class _Node:
+    """One path segment in the route trie"""
+
+    __slots__ = ('children', 'param', 'param_name', 'rest', 'rest_name', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_name = None
+        self.rest = None
+        self.rest_name = None
+        self.handlers = {}
+
+
+class Router:
+    """Maps (method, path) to handler functions
+
+    Patterns are literal paths or contain ``{name}`` segments, e.g.
+    ``/devices/{device_id}``; a final ``{name:path}`` segment captures the
+    rest of the path, slashes included. Literal paths resolve with one dict
+    lookup; parameterized ones walk a segment trie where literal segments
+    win over parameters. Handlers are registered with the ``get``/``post``
+    decorators.
+    """
+
+    def __init__(self):
+        self._static = {}
+        self._root = _Node()
+        self._patterns = {}
+
+    def add(self, method, pattern, handler):
+        method = method.upper()
+        self._patterns.setdefault(handler, pattern)
+        if '{' not in pattern:
+            self._static.setdefault(pattern, {})[method] = handler
+            return handler
+        node = self._root
+        segments = pattern.strip('/').split('/')
+        for index, segment in enumerate(segments):
+            if segment.startswith('{') and segment.endswith(':path}'):
+                if index != len(segments) - 1:
+                    raise ValueError(f"'{segment}' must be the last segment of '{pattern}'")
+                if node.rest is None:
+                    node.rest = _Node()
+                    node.rest_name = segment[1:-len(':path}')]
+                node = node.rest
+            elif segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+                if node.param is None:
+                    node.param = _Node()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise ValueError(f"conflicting parameter names '{node.param_name}' and '{name}'")
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.handlers[method] = handler
+        return handler
+
+    def route(self, method, pattern):
+        """Decorator registering a handler for ``method`` and ``pattern``"""
+        return lambda handler: self.add(method, pattern, handler)
+
+    def get(self, pattern):
+        return self.route('GET', pattern)
+
+    def post(self, pattern):
+        return self.route('POST', pattern)
+
+    def _lookup(self, path):
+        """Handlers by method and path parameters for ``path``, or ``(None, None)``"""
+        handlers = self._static.get(path)
+        if handlers is not None:
+            return handlers, {}
+        node = self._root
+        params = {}
+        segments = path.strip('/').split('/')
+        for index, segment in enumerate(segments):
+            child = node.children.get(segment)
+            if child is not None:
+                node = child
+            elif node.param is not None and segment:
+                params[node.param_name] = unquote(segment)
+                node = node.param
+            elif node.rest is not None:
+                params[node.rest_name] = unquote('/'.join(segments[index:]))
+                node = node.rest
+                break
+            else:
+                return None, None
+        else:
+            if not node.handlers and node.rest is not None:
+                params[node.rest_name] = ''
+                node = node.rest
+        return (node.handlers, params) if node.handlers else (None, None)
+
+    def match(self, method, path):
+        """Resolve a request to ``(handler, params, allowed_methods)``
+
+        ``handler`` is None when nothing matches; ``allowed_methods`` is then
+        empty for an unknown path (404) or lists the methods the path does
+        support (405).
+        """
+        handlers, params = self._lookup(path)
+        if handlers is None:
+            return None, None, ()
+        handler = handlers.get(method.upper())
+        if handler is None:
+            return None, None, tuple(sorted(handlers))
+        return handler, params, ()
+
+    def pattern(self, handler):
+        """The pattern ``handler`` was registered under, e.g. for metric labels"""
+        return self._patterns.get(handler)
+
+    def allowed_methods(self, path):
+        handlers, _ = self._lookup(path)
+        return tuple(sorted(handlers)) if handlers else ()
+
+
+_date_cache = (0, '')
+
+
+def http_date():
+    """IMF-fixdate for the current second, formatted once per second"""
+    global _date_cache
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache = (now, formatdate(now, usegmt=True))
+    return _date_cache[1]
+
+
+def response_head(version, status, server, headers):
+    """Status line and headers as one bytes object, ready to prefix the body"""
+    lines = [f"{version} {status} {_REASONS.get(status, '')}\r\n"
+             f"Server: {server}\r\nDate: {http_date()}\r\n"]
+    for name, value in headers:
+        lines.append(f"{name}: {value}\r\n")
+    lines.append("\r\n")
+    return ''.join(lines).encode('latin-1', 'strict')
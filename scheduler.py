@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Load-shifting scheduler for the AI Energy Optimizer
+Assigns deferrable device runs to time slots to cut peak demand and energy cost
+"""
+
+import heapq
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+
+MAX_HORIZON_HOURS = 168
+DEFAULT_HORIZON_HOURS = 24
+DEFAULT_SLOT_MINUTES = 60
+DEFAULT_PEAK_WEIGHT = 0.05
+MAX_PEAK_WEIGHT = 10.0
+DEFAULT_RUN_HOURS = 2.0
+MAX_JOBS = 50000
+
+# Exhaustive search is used when the instance is at most this large
+EXACT_MAX_JOBS = 8
+EXACT_MAX_COMBINATIONS = 200000
+
+# Default time-of-use tariff in $/kWh
+TARIFF = {
+    'peak': 0.30,        # Weekdays 17:00-21:00
+    'shoulder': 0.18,    # Weekdays 07:00-17:00
+    'off_peak': 0.10,    # Nights and weekends
+}
+
+
+def tariff_curve(start, slots, slot_hours, tariff=None):
+    """Price per kWh for each slot starting at epoch ``start``
+
+    ``tariff`` is either a dict overriding the time-of-use rates above, or a
+    list of hourly prices (24 values repeat daily; longer lists are used as
+    given from the start of the horizon).
+    """
+    offsets = np.arange(slots) * slot_hours
+    if isinstance(tariff, (list, tuple)):
+        prices = np.asarray(tariff, dtype=np.float64)
+        if prices.size == 0:
+            raise ValueError("tariff must not be empty")
+        hour_index = np.floor(offsets).astype(np.intp)
+        if prices.size == 24:
+            first = datetime.fromtimestamp(start).hour
+            return prices[(hour_index + first) % 24]
+        if prices.size < math.ceil(slots * slot_hours):
+            raise ValueError("tariff must have 24 values or one per hour of the horizon")
+        return prices[hour_index]
+
+    rates = dict(TARIFF)
+    rates.update(tariff or {})
+    moments = [datetime.fromtimestamp(start + offset * 3600) for offset in offsets.tolist()]
+    hours = np.array([m.hour for m in moments])
+    weekday = np.array([m.weekday() < 5 for m in moments])
+    prices = np.full(slots, float(rates['off_peak']))
+    prices[weekday & (hours >= 7) & (hours < 17)] = float(rates['shoulder'])
+    prices[weekday & (hours >= 17) & (hours < 21)] = float(rates['peak'])
+    return prices
+
+
+class Job:
+    """A deferrable run: ``power`` kW for ``duration`` slots inside a window"""
+
+    __slots__ = ('job_id', 'device_id', 'power', 'duration', 'earliest', 'latest',
+                 'priority', 'start')
+
+    def __init__(self, job_id, device_id, power, duration, earliest, latest, priority=0):
+        self.job_id = job_id
+        self.device_id = device_id
+        self.power = power
+        self.duration = duration
+        self.earliest = earliest
+        self.latest = latest  # Last allowed start slot
+        self.priority = priority
+        self.start = None
+
+    @property
+    def slack(self):
+        return self.latest - self.earliest
+
+
+def _finite(value, what):
+    """``value`` as a float; NaN and infinities raise ValueError naming ``what``"""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{what} must be a finite number")
+    return number
+
+
+def parse_jobs(items, slots, slot_hours):
+    """Build Jobs from request dicts with hour offsets relative to the horizon start"""
+    if len(items) > MAX_JOBS:
+        raise ValueError(f"at most {MAX_JOBS} jobs per request")
+    jobs = []
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"job {n} must be an object")
+        power = _finite(item.get('power', item.get('current_power', 0.0)), f"job {n}: power")
+        if power < 0:
+            raise ValueError(f"job {n}: power must not be negative")
+        duration = _finite(item.get('duration', DEFAULT_RUN_HOURS), f"job {n}: duration")
+        duration = max(1, math.ceil(duration / slot_hours))
+        earliest = max(0, int(_finite(item.get('earliest', 0), f"job {n}: earliest") / slot_hours))
+        deadline = item.get('deadline')
+        if deadline is None:
+            end = slots
+        else:
+            end = min(slots, int(_finite(deadline, f"job {n}: deadline") / slot_hours))
+        jobs.append(Job(
+            str(item.get('job_id', item.get('device_id', f'job_{n}'))),
+            item.get('device_id'),
+            power,
+            duration,
+            earliest,
+            end - duration,
+            int(item.get('priority', 0)),
+        ))
+    return jobs
+
+
+def _window_costs(job, weights):
+    """Marginal objective of every feasible start slot for ``job``
+
+    ``weights[t]`` is the marginal cost of one more kW in slot t. Window sums
+    come from one cumulative sum, so each job costs O(slots).
+    """
+    sums = np.concatenate(([0.0], np.cumsum(weights)))
+    starts = np.arange(job.earliest, job.latest + 1)
+    return starts, (sums[starts + job.duration] - sums[starts]) * job.power
+
+
+def _marginal_weights(prices, load, slot_hours, peak_weight, power):
+    # Objective: energy cost + peak_weight * sum(load^2). Adding ``power`` to
+    # slot t raises the quadratic term by 2*power*load[t] + power^2.
+    return prices * slot_hours + peak_weight * (2.0 * load + power)
+
+
+def _place_greedy(jobs, prices, load, slot_hours, peak_weight):
+    """Place jobs one at a time, least flexible and largest first"""
+    queue = [(-job.priority, job.slack, -job.power * job.duration, n)
+             for n, job in enumerate(jobs)]
+    heapq.heapify(queue)
+    while queue:
+        *_, n = heapq.heappop(queue)
+        job = jobs[n]
+        weights = _marginal_weights(prices, load, slot_hours, peak_weight, job.power)
+        starts, costs = _window_costs(job, weights)
+        best = int(starts[np.argmin(costs)])
+        job.start = best
+        load[best:best + job.duration] += job.power
+
+
+def _place_exact(jobs, prices, load, slot_hours, peak_weight):
+    """Exhaustive branch-and-bound over every combination of start slots"""
+    best_cost = math.inf
+    best_starts = None
+    starts = [0] * len(jobs)
+
+    def lower_bound(index, current):
+        # Extra load only raises marginal costs, so each remaining job's best
+        # placement against the current load bounds the final cost from below
+        bound = 0.0
+        for job in jobs[index:]:
+            weights = _marginal_weights(prices, current, slot_hours, peak_weight, job.power)
+            bound += float(_window_costs(job, weights)[1].min())
+        return bound
+
+    def search(index, current, cost):
+        nonlocal best_cost, best_starts
+        if index == len(jobs):
+            if cost < best_cost:
+                best_cost, best_starts = cost, list(starts)
+            return
+        if cost + lower_bound(index, current) >= best_cost:
+            return
+        job = jobs[index]
+        weights = _marginal_weights(prices, current, slot_hours, peak_weight, job.power)
+        candidates, costs = _window_costs(job, weights)
+        for order in np.argsort(costs):
+            start = int(candidates[order])
+            starts[index] = start
+            current[start:start + job.duration] += job.power
+            search(index + 1, current, cost + float(costs[order]))
+            current[start:start + job.duration] -= job.power
+
+    search(0, load.copy(), 0.0)
+    for job, start in zip(jobs, best_starts):
+        job.start = start
+        load[start:start + job.duration] += job.power
+
+
+def _objective(prices, load, jobs_load, slot_hours, peak_weight):
+    return float(prices @ jobs_load * slot_hours + peak_weight * np.sum(load * load))
+
+
+def schedule_jobs(jobs, base_load, prices, slot_hours, peak_weight=DEFAULT_PEAK_WEIGHT,
+                  solver='auto'):
+    """Assign a start slot to every feasible job
+
+    ``base_load`` is the forecast non-deferrable load in kW per slot.
+    Returns ``(scheduled, unscheduled, load, solver_used)``.
+    """
+    scheduled = [job for job in jobs if job.latest >= job.earliest]
+    unscheduled = [job for job in jobs if job.latest < job.earliest]
+    load = np.array(base_load, dtype=np.float64)
+
+    combinations = 1
+    for job in scheduled:
+        combinations *= job.slack + 1
+        if combinations > EXACT_MAX_COMBINATIONS:
+            break
+    small = len(scheduled) <= EXACT_MAX_JOBS and combinations <= EXACT_MAX_COMBINATIONS
+
+    if solver == 'exact' and not small:
+        raise ValueError(f"exact solver supports at most {EXACT_MAX_JOBS} jobs and "
+                         f"{EXACT_MAX_COMBINATIONS} start combinations")
+    if solver not in ('auto', 'greedy', 'exact'):
+        raise ValueError("solver must be 'auto', 'greedy' or 'exact'")
+
+    if solver == 'exact' or (solver == 'auto' and small and scheduled):
+        _place_exact(scheduled, prices, load, slot_hours, peak_weight)
+        used = 'exact'
+    else:
+        _place_greedy(scheduled, prices, load, slot_hours, peak_weight)
+        used = 'greedy'
+    return scheduled, unscheduled, load, used
+
+
+def build_schedule(request, base_load_hourly, start=None, default_jobs=None):
+    """Plan the /schedule request and return the response payload
+
+    ``base_load_hourly`` is the forecast kW for each hour of the horizon.
+    ``default_jobs`` is used when the request does not list any jobs.
+    """
+    started = time.perf_counter()
+    horizon = int(request.get('horizon_hours', DEFAULT_HORIZON_HOURS))
+    if not 1 <= horizon <= MAX_HORIZON_HOURS:
+        raise ValueError(f"horizon_hours must be between 1 and {MAX_HORIZON_HOURS}")
+    slot_minutes = int(request.get('slot_minutes', DEFAULT_SLOT_MINUTES))
+    if slot_minutes not in (5, 10, 15, 20, 30, 60):
+        raise ValueError("slot_minutes must be one of 5, 10, 15, 20, 30 or 60")
+    slot_hours = slot_minutes / 60.0
+    slots = int(horizon / slot_hours)
+    peak_weight = _finite(request.get('peak_weight', DEFAULT_PEAK_WEIGHT), "peak_weight")
+    if not 0 <= peak_weight <= MAX_PEAK_WEIGHT:
+        raise ValueError(f"peak_weight must be between 0 and {MAX_PEAK_WEIGHT:g}")
+
+    now = time.time() if start is None else start
+    start = now - now % (slot_minutes * 60)
+    prices = tariff_curve(start, slots, slot_hours, request.get('tariff'))
+
+    hourly = np.asarray(base_load_hourly, dtype=np.float64)[:horizon]
+    per_hour = int(round(1 / slot_hours))
+    base_load = np.repeat(hourly, per_hour)[:slots]
+    if base_load.size < slots:
+        mode = 'edge' if base_load.size else 'constant'
+        base_load = np.pad(base_load, (0, slots - base_load.size), mode=mode)
+
+    items = request.get('jobs')
+    if items is None:
+        items = default_jobs or []
+    if not isinstance(items, list):
+        raise ValueError("jobs must be a list")
+    jobs = parse_jobs(items, slots, slot_hours)
+    scheduled, unscheduled, load, solver = schedule_jobs(
+        jobs, base_load, prices, slot_hours, peak_weight, request.get('solver', 'auto'))
+
+    # Baseline: every job runs as soon as its window opens
+    baseline_jobs = np.zeros(slots)
+    planned_jobs = np.zeros(slots)
+    plan = []
+    for job in scheduled:
+        baseline_jobs[job.earliest:job.earliest + job.duration] += job.power
+        planned_jobs[job.start:job.start + job.duration] += job.power
+        window = prices[job.start:job.start + job.duration]
+        plan.append({
+            'job_id': job.job_id,
+            'device_id': job.device_id,
+            'start': datetime.fromtimestamp(start + job.start * slot_minutes * 60).isoformat(),
+            'end': datetime.fromtimestamp(
+                start + (job.start + job.duration) * slot_minutes * 60).isoformat(),
+            'start_slot': job.start,
+            'power': job.power,
+            'cost': round(float(window.sum()) * job.power * slot_hours, 4)
+        })
+    plan.sort(key=lambda entry: (entry['start_slot'], entry['job_id']))
+
+    baseline_load = base_load + baseline_jobs
+    summary = {
+        'solver': solver,
+        'jobs': len(jobs),
+        'scheduled': len(scheduled),
+        'slots': slots,
+        'slot_minutes': slot_minutes,
+        'total_cost': round(float(prices @ planned_jobs) * slot_hours, 2),
+        'baseline_cost': round(float(prices @ baseline_jobs) * slot_hours, 2),
+        'peak_load': round(float(load.max()) if slots else 0.0, 2),
+        'baseline_peak_load': round(float(baseline_load.max()) if slots else 0.0, 2),
+        'objective': round(_objective(prices, load, planned_jobs, slot_hours, peak_weight), 2),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    response = {
+        'plan': plan,
+        'unscheduled': [{'job_id': job.job_id, 'reason': 'window shorter than duration'}
+                        for job in unscheduled],
+        'summary': summary
+    }
+    if request.get('include_profile'):
+        response['load_profile'] = np.round(load, 3).tolist()
+        response['prices'] = prices.tolist()
+    return response
+
+
+def default_jobs_for(devices, run_hours=DEFAULT_RUN_HOURS, window_hours=DEFAULT_HORIZON_HOURS):
+    """One deferrable run per active appliance, as the delay_operation action implies"""
+    return [{
+        'job_id': device['device_id'],
+        'device_id': device['device_id'],
+        'power': device['current_power'],
+        'duration': run_hours,
+        'earliest': 0,
+        'deadline': window_hours
+    } for device in devices]
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Response serialization for the AI Energy Optimizer
+JSON straight to bytes with the fastest installed library, MessagePack by Accept header
+and reusable fragments for unchanged device records
+"""
+
+import json
+import struct
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPE = 'application/msgpack'
+MSGPACK_ALIASES = ('application/x-msgpack', 'application/vnd.msgpack')
+MAX_FRAGMENTS = 200000
+
+
+# ----------------------------------------------------------------------
+# JSON
+# ----------------------------------------------------------------------
+
+def _select_json():
+    """``(name, dumps, loads)`` for the fastest JSON library available"""
+    if orjson is not None:
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        return 'orjson', lambda obj: orjson.dumps(obj, option=options), orjson.loads
+    if ujson is not None:
+        return 'ujson', lambda obj: ujson.dumps(obj, ensure_ascii=False).encode(), ujson.loads
+    encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+    return 'json', lambda obj: encoder.encode(obj).encode(), json.loads
+
+
+JSON_BACKEND, dumps, loads = _select_json()
+
+
+# ----------------------------------------------------------------------
+# MessagePack
+# ----------------------------------------------------------------------
+
+def _array_header(length):
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return struct.pack('>BH', 0xdc, length)
+    return struct.pack('>BI', 0xdd, length)
+
+
+def _map_header(length):
+    if length < 16:
+        return bytes((0x80 | length,))
+    if length < 0x10000:
+        return struct.pack('>BH', 0xde, length)
+    return struct.pack('>BI', 0xdf, length)
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj < 2 ** 64:
+            out += struct.pack('>BQ', 0xcf, obj)
+        elif -2 ** 63 <= obj < 0:
+            out += struct.pack('>Bq', 0xd3, obj)
+        else:
+            raise OverflowError("integer out of MessagePack range")
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        length = len(data)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length < 0x100:
+            out += struct.pack('>BB', 0xd9, length)
+        elif length < 0x10000:
+            out += struct.pack('>BH', 0xda, length)
+        else:
+            out += struct.pack('>BI', 0xdb, length)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        length = len(obj)
+        if length < 0x100:
+            out += struct.pack('>BB', 0xc4, length)
+        elif length < 0x10000:
+            out += struct.pack('>BH', 0xc5, length)
+        else:
+            out += struct.pack('>BI', 0xc6, length)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        out += _array_header(len(obj))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        out += _map_header(len(obj))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    elif hasattr(obj, 'tolist'):
+        # numpy scalars and arrays
+        _pack(obj.tolist(), out)
+    else:
+        raise TypeError(f"cannot serialize {type(obj).__name__} to MessagePack")
+
+
+def pack_msgpack(obj):
+    """MessagePack bytes for JSON-like data"""
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True, default=lambda o: o.tolist())
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _unpack(data, offset):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code & 0xe0 == 0xa0:
+        end = offset + (code & 0x1f)
+        return data[offset:end].decode('utf-8'), end
+    if code & 0xf0 == 0x90:
+        return _unpack_array(data, offset, code & 0x0f)
+    if code & 0xf0 == 0x80:
+        return _unpack_map(data, offset, code & 0x0f)
+    if code in (0xc0, 0xc2, 0xc3):
+        return {0xc0: None, 0xc2: False, 0xc3: True}[code], offset
+    fixed = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+             0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}
+    if code in fixed:
+        fmt = fixed[code]
+        return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+    sized = {0xd9: '>B', 0xda: '>H', 0xdb: '>I', 0xc4: '>B', 0xc5: '>H', 0xc6: '>I',
+             0xdc: '>H', 0xdd: '>I', 0xde: '>H', 0xdf: '>I'}
+    if code not in sized:
+        raise ValueError(f"unsupported MessagePack type 0x{code:02x}")
+    fmt = sized[code]
+    length = struct.unpack_from(fmt, data, offset)[0]
+    offset += struct.calcsize(fmt)
+    if code in (0xdc, 0xdd):
+        return _unpack_array(data, offset, length)
+    if code in (0xde, 0xdf):
+        return _unpack_map(data, offset, length)
+    end = offset + length
+    value = bytes(data[offset:end])
+    return (value.decode('utf-8') if code in (0xd9, 0xda, 0xdb) else value), end
+
+
+def _unpack_array(data, offset, length):
+    items = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data, offset, length):
+    result = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset)
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+
+
+def unpack_msgpack(data):
+    """Decode MessagePack produced by ``pack_msgpack``"""
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    value, offset = _unpack(data, 0)
+    if offset != len(data):
+        raise ValueError("trailing bytes after MessagePack value")
+    return value
+
+
+# ----------------------------------------------------------------------
+# Encoders
+# ----------------------------------------------------------------------
+
+class JSONEncoder:
+    """JSON bodies; ``array`` and ``mapping`` splice already-encoded values"""
+
+    content_type = JSON_TYPE
+    # orjson encodes a whole list faster than fragments can be looked up
+    cache_fragments = JSON_BACKEND != 'orjson'
+
+    def dumps(self, obj):
+        return dumps(obj)
+
+    def array(self, items):
+        return b'[' + b','.join(items) + b']'
+
+    def mapping(self, entries):
+        """Object from ``(key, encoded_value)`` pairs"""
+        return b'{' + b','.join(dumps(key) + b':' + value for key, value in entries) + b'}'
+
+
+class MsgPackEncoder:
+    """MessagePack bodies with the same splicing interface as JSONEncoder"""
+
+    content_type = MSGPACK_TYPE
+    cache_fragments = msgpack is None
+
+    def dumps(self, obj):
+        return pack_msgpack(obj)
+
+    def array(self, items):
+        return _array_header(len(items)) + b''.join(items)
+
+    def mapping(self, entries):
+        return _map_header(len(entries)) + b''.join(pack_msgpack(key) + value
+                                                     for key, value in entries)
+
+
+JSON = JSONEncoder()
+ENCODERS = {JSON_TYPE: JSON, MSGPACK_TYPE: MsgPackEncoder()}
+for _alias in MSGPACK_ALIASES:
+    ENCODERS[_alias] = ENCODERS[MSGPACK_TYPE]
+
+
+def register_encoder(encoder, *content_types):
+    """Serve ``encoder`` for its ``content_type`` (and any aliases) when clients ask for it"""
+    for content_type in (encoder.content_type,) + content_types:
+        ENCODERS[content_type] = encoder
+
+
+def negotiate(accept):
+    """Encoder for an Accept header value; JSON unless another type is preferred"""
+    best, best_q = JSON, 0.0
+    for item in (accept or '').split(','):
+        media_type, _, params = item.strip().partition(';')
+        encoder = ENCODERS.get(media_type.strip().lower())
+        if encoder is None:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = encoder, q
+    return best
+
+
+# ----------------------------------------------------------------------
+# Fragment cache
+# ----------------------------------------------------------------------
+
+class FragmentCache:
+    """Encoded device records reused until the record changes
+
+    Entries are keyed by encoder, device id and projected fields, and
+    stamped with the record's values; a record whose values differ from the
+    stamp (new power reading, toggle, rename) is re-encoded. The cache is
+    emptied when it reaches ``max_entries`` so memory stays bounded.
+
+    Encoders backed by a C library set ``cache_fragments = False``: they
+    encode the whole list in one call faster than fragments can be found.
+    """
+
+    def __init__(self, max_entries=MAX_FRAGMENTS):
+        self.max_entries = max_entries
+        self._fragments = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode_list(self, encoder, records, fields=None):
+        """Encoded array of ``records`` (device dicts), spliced from cached fragments"""
+        if not encoder.cache_fragments:
+            return encoder.dumps(records)
+        fragments = self._fragments
+        items = []
+        missing = []
+        for record in records:
+            key = (encoder.content_type, record['device_id'], fields)
+            stamp = tuple(record.values())
+            cached = fragments.get(key)
+            if cached is not None and cached[0] == stamp:
+                items.append(cached[1])
+            else:
+                body = encoder.dumps(record)
+                items.append(body)
+                missing.append((key, (stamp, body)))
+        if missing:
+            with self._lock:
+                if len(fragments) + len(missing) > self.max_entries:
+                    fragments.clear()
+                fragments.update(missing)
+        self.hits += len(items) - len(missing)
+        self.misses += len(missing)
+        return encoder.array(items)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def __len__(self):
+        return len(self._fragments)
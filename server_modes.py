@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Serving engines for the AI Energy Optimizer
+Threaded, pre-forked, asyncio and site-sharded front ends that all drive the same request handler
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, ThreadingHTTPServer
+
+SERVER_MODES = ('threaded', 'prefork', 'asyncio', 'single', 'sharded')
+DEFAULT_MODE = 'threaded'
+
+# Seconds an idle keep-alive connection is held open before it is closed
+KEEPALIVE_TIMEOUT = 15
+LISTEN_BACKLOG = 256
+
+
+class ThreadedEnergyServer(ThreadingHTTPServer):
+    """Thread-per-connection server so slow clients never block /health probes"""
+
+    daemon_threads = True
+    block_on_close = False
+    request_queue_size = LISTEN_BACKLOG
+
+
+class PreforkEnergyServer:
+    """Pre-forked worker processes accepting from one shared listening socket"""
+
+    def __init__(self, server_address, handler_class, workers=None, worker_init=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        # Runs in each child after fork, for state that must not be inherited
+        # (database connections, background threads)
+        self.worker_init = worker_init
+        # Bind once in the parent; every forked child inherits the socket and
+        # the kernel spreads accepted connections across the worker processes
+        self._httpd = ThreadedEnergyServer(server_address, handler_class)
+        self.server_address = self._httpd.server_address
+        self._children = set()
+        self._stopping = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+            code = 0
+            try:
+                if self.worker_init is not None:
+                    self.worker_init()
+                self._httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"❌ Worker {os.getpid()} crashed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        self._children.add(pid)
+        return pid
+
+    def serve_forever(self):
+        """Fork the workers and respawn any that exit until stopped"""
+        for _ in range(self.workers):
+            self._spawn()
+        try:
+            while self._children:
+                try:
+                    pid, _status = os.wait()
+                except ChildProcessError:
+                    break  # shutdown() already reaped the workers
+                self._children.discard(pid)
+                if not self._stopping:
+                    time.sleep(0.1)  # Avoid a tight respawn loop on crashes
+                    self._spawn()
+        except KeyboardInterrupt:
+            self.shutdown()
+            raise
+
+    def shutdown(self):
+        """Stop respawning and terminate every worker"""
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self._children.discard(pid)
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self._children.discard(pid)
+
+    def server_close(self):
+        self._httpd.server_close()
+
+
+class _Connection:
+    """A client socket whose buffered reader survives between requests"""
+
+    __slots__ = ('sock', 'address', 'rfile', 'keep_alive', 'idle_handle')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.rfile = sock.makefile('rb')
+        self.keep_alive = True
+        self.idle_handle = None
+
+    def has_buffered_input(self):
+        """True when a pipelined request is already waiting to be parsed"""
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            self.rfile.close()
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class _ParkedRequestMixin:
+    """Handle exactly one request per instantiation on a persistent connection"""
+
+    def setup(self):
+        conn = self.request
+        self._parked_connection = conn
+        self.request = conn.sock
+        super().setup()
+        # Keep the connection's reader so pipelined bytes are never dropped
+        self.rfile.close()
+        self.rfile = conn.rfile
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        self._parked_connection.keep_alive = not self.close_connection
+
+    def finish(self):
+        if not self.wfile.closed:
+            try:
+                self.wfile.flush()
+            except OSError:
+                self._parked_connection.keep_alive = False
+        self.wfile.close()
+
+
+class AsyncioEnergyServer:
+    """Event-loop front end: idle keep-alive connections wait on the loop and
+    only connections with a request in progress occupy a worker thread"""
+
+    def __init__(self, server_address, handler_class, workers=None,
+                 idle_timeout=KEEPALIVE_TIMEOUT):
+        self.RequestHandlerClass = type(
+            'Parked' + handler_class.__name__, (_ParkedRequestMixin, handler_class), {}
+        )
+        self.socket = socket.create_server(server_address, backlog=LISTEN_BACKLOG)
+        self.server_address = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.idle_timeout = idle_timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or min(64, (os.cpu_count() or 1) * 8),
+            thread_name_prefix='energy-worker',
+        )
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+        self._closing = False
+        self._parked = set()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.socket.setblocking(False)
+        accept_task = asyncio.create_task(self._accept_loop())
+        self._ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            self._closing = True
+            accept_task.cancel()
+            for conn in list(self._parked):
+                self._unpark(conn)
+                conn.close()
+            self._executor.shutdown(wait=False)
+
+    async def _accept_loop(self):
+        while True:
+            sock, address = await self._loop.sock_accept(self.socket)
+            sock.setblocking(True)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._park(_Connection(sock, address))
+
+    def _park(self, conn):
+        """Wait on the event loop, without a thread, for the next request"""
+        if self._closing:
+            conn.close()
+            return
+        self._parked.add(conn)
+        conn.idle_handle = self._loop.call_later(self.idle_timeout, self._expire, conn)
+        self._loop.add_reader(conn.sock.fileno(), self._on_readable, conn)
+
+    def _unpark(self, conn):
+        self._parked.discard(conn)
+        if conn.idle_handle is not None:
+            conn.idle_handle.cancel()
+            conn.idle_handle = None
+        self._loop.remove_reader(conn.sock.fileno())
+
+    def _expire(self, conn):
+        self._unpark(conn)
+        conn.close()
+
+    def _on_readable(self, conn):
+        self._unpark(conn)
+        self._loop.run_in_executor(self._executor, self._serve_connection, conn)
+
+    def _serve_connection(self, conn):
+        """Run requests on a worker thread until the connection goes idle"""
+        try:
+            while True:
+                self.RequestHandlerClass(conn, conn.address, self)
+                if not conn.keep_alive or self._closing:
+                    break
+                if not conn.has_buffered_input():
+                    self._loop.call_soon_threadsafe(self._park, conn)
+                    return
+        except Exception as e:
+            print(f"⚠️ Connection from {conn.address[0]} failed: {e}", file=sys.stderr)
+        conn.close()
+
+    def shutdown(self):
+        """Stop the event loop; safe to call from any thread"""
+        self._ready.wait()
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def server_close(self):
+        self.socket.close()
+
+
+def create_server(mode, server_address, handler_class, workers=None, worker_init=None):
+    """Build the serving engine selected by ``mode``
+
+    ``worker_init`` is called once in every process that will serve requests:
+    immediately for in-process modes, after fork for pre-fork workers and shards.
+    """
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown server mode '{mode}', expected one of {', '.join(SERVER_MODES)}")
+
+    if mode in ('prefork', 'sharded') and not hasattr(os, 'fork'):
+        print(f"⚠️ {mode.capitalize()} mode needs os.fork(); falling back to threaded mode")
+        mode = 'threaded'
+
+    if mode == 'prefork':
+        return PreforkEnergyServer(server_address, handler_class, workers, worker_init)
+    if mode == 'sharded':
+        # Imported here: sharding builds on this module
+        from sharding import ShardedEnergyServer
+        return ShardedEnergyServer(server_address, handler_class, workers, worker_init)
+    if worker_init is not None:
+        worker_init()
+    if mode == 'single':
+        return HTTPServer(server_address, handler_class)
+    if mode == 'threaded':
+        return ThreadedEnergyServer(server_address, handler_class)
+    return AsyncioEnergyServer(server_address, handler_class, workers)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Site-sharded serving for the AI Energy Optimizer
+One worker process per shard owns a hash partition of the sites, and a small asyncio
+coordinator forwards each request to the shard that owns its site
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from server_modes import KEEPALIVE_TIMEOUT, LISTEN_BACKLOG, ThreadedEnergyServer
+from sites import SITE_HEADER, shard_for, site_for_request
+from telemetry import parse_content_length
+
+MAX_HEAD_BYTES = 64 * 1024
+RELAY_BLOCK_BYTES = 64 * 1024
+REAP_INTERVAL = 0.2
+# Upstream connections idle longer than this are replaced rather than reused,
+# so a worker closing its side at KEEPALIVE_TIMEOUT never races a new request
+UPSTREAM_MAX_IDLE = KEEPALIVE_TIMEOUT / 2
+
+# Request headers the coordinator rewrites instead of forwarding
+_DROPPED_HEADERS = ('expect', 'x-forwarded-for')
+_HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+
+
+class _BadRequest(ValueError):
+    pass
+
+
+def _parse_head(head):
+    """``(start_line, [(name, value)], {lower_name: value})`` for a request or response head"""
+    lines = head.decode('latin-1').split('\r\n')
+    start = lines[0]
+    fields = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, colon, value = line.partition(':')
+        if not colon or not name or name != name.strip():
+            raise _BadRequest(f"malformed header line {line[:40]!r}")
+        fields.append((name, value.strip()))
+    return start, fields, {name.lower(): value for name, value in fields}
+
+
+def _content_length(headers):
+    """Body length from Content-Length (0 without one); only plain digits are accepted"""
+    value = headers.get('content-length')
+    if value is None:
+        return 0
+    try:
+        return parse_content_length(value)
+    except ValueError:
+        raise _BadRequest("invalid Content-Length") from None
+
+
+def _check_framing(fields, headers):
+    """Reject request bodies whose length a shard could read differently"""
+    lengths = [value for name, value in fields if name.lower() == 'content-length']
+    if len(lengths) > 1:
+        raise _BadRequest("multiple Content-Length headers")
+    if lengths and 'transfer-encoding' in headers:
+        raise _BadRequest("both Transfer-Encoding and Content-Length")
+    _content_length(headers)
+
+
+async def _relay_exact(reader, writer, length):
+    while length:
+        data = await reader.read(min(length, RELAY_BLOCK_BYTES))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        writer.write(data)
+        length -= len(data)
+        await writer.drain()
+
+
+async def _relay_chunked(reader, writer):
+    """Copy a chunked body, framing included, up to and including its trailers"""
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        writer.write(line)
+        digits = line.split(b';', 1)[0].strip()
+        if not digits or not _HEX_DIGITS.issuperset(digits):
+            raise _BadRequest("invalid chunk size")
+        size = int(digits, 16)
+        if size == 0:
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                writer.write(line)
+                if line == b'\r\n':
+                    await writer.drain()
+                    return
+        await _relay_exact(reader, writer, size + 2)
+
+
+async def _relay_body(reader, writer, headers):
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        await _relay_chunked(reader, writer)
+    else:
+        length = _content_length(headers)
+        if length:
+            await _relay_exact(reader, writer, length)
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(RELAY_BLOCK_BYTES)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+class _Upstream:
+    __slots__ = ('reader', 'writer', 'last_used')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def usable(self):
+        return (not self.writer.is_closing() and not self.reader.at_eof()
+                and time.monotonic() - self.last_used < UPSTREAM_MAX_IDLE)
+
+
+class ShardedEnergyServer:
+    """Worker processes that each own the sites hashing to them, behind a coordinator
+
+    Every shard is a threaded server on its own loopback socket, so all of a
+    site's state (registry, models, caches, database) lives in exactly one
+    process and needs no cross-process locking. The parent runs an asyncio
+    coordinator on the public address: it reads each request head, finds the
+    site from the ``/sites/{site_id}/`` prefix or the ``X-Site-Id`` header
+    and forwards the request over a kept-alive connection to the owning
+    shard. Responses are relayed as they arrive; WebSocket upgrades and
+    event streams become a plain byte pipe. Shards that exit are respawned
+    on the same socket, so routing never changes.
+    """
+
+    def __init__(self, server_address, handler_class, workers=None, worker_init=None,
+                 idle_timeout=KEEPALIVE_TIMEOUT):
+        self.shards = max(1, workers or os.cpu_count() or 1)
+        self.handler_class = handler_class
+        # Runs in each shard after fork (database connections, background threads)
+        self.worker_init = worker_init
+        self.idle_timeout = idle_timeout
+        self.socket = socket.create_server(server_address, backlog=LISTEN_BACKLOG)
+        self.server_address = self.socket.getsockname()[:2]
+        # Bound before forking so a respawned shard takes over the same port
+        self._shard_sockets = [socket.create_server(('127.0.0.1', 0), backlog=LISTEN_BACKLOG)
+                               for _ in range(self.shards)]
+        self._shard_ports = [sock.getsockname()[1] for sock in self._shard_sockets]
+        self._children = {}
+        self._connections = set()
+        self._clients = set()
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+
+    # ------------------------------------------------------------------
+    # Shard processes
+    # ------------------------------------------------------------------
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self._run_shard(index)
+        self._children[pid] = index
+        return pid
+
+    def _run_shard(self, index):
+        signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+        # The coordinator's event loop may have replaced the Ctrl+C handler
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        code = 0
+        try:
+            # Drop the coordinator's sockets; a child holding a copy would keep
+            # client connections open after the coordinator closes them
+            self.socket.close()
+            for writer in list(self._connections):
+                transport_socket = writer.get_extra_info('socket')
+                if transport_socket is not None and transport_socket.fileno() >= 0:
+                    os.close(transport_socket.fileno())
+            for other, sock in enumerate(self._shard_sockets):
+                if other != index:
+                    sock.close()
+            sock = self._shard_sockets[index]
+            httpd = ThreadedEnergyServer(sock.getsockname(), self.handler_class,
+                                         bind_and_activate=False)
+            httpd.socket.close()
+            httpd.socket = sock
+            httpd.server_name = 'localhost'
+            httpd.server_port = self._shard_ports[index]
+            # Lets the handler refuse sites that belong to another shard
+            httpd.shard = (index, self.shards)
+            if self.worker_init is not None:
+                self.worker_init()
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(f"❌ Shard {index} (pid {os.getpid()}) crashed: {e}", file=sys.stderr)
+            code = 1
+        finally:
+            os._exit(code)
+
+    async def _reap_loop(self):
+        """Respawn shards that exit; polls its own children so other ones are left alone"""
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            for pid, index in list(self._children.items()):
+                try:
+                    done, _status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    del self._children[pid]
+                    print(f"⚠️ Shard {index} exited; respawning", file=sys.stderr)
+                    self._spawn(index)
+
+    def _stop_shards(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._children.clear()
+
+    # ------------------------------------------------------------------
+    # Coordinator
+    # ------------------------------------------------------------------
+
+    def serve_forever(self):
+        """Fork the shards, then coordinate until shut down"""
+        for index in range(self.shards):
+            self._spawn(index)
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stop_shards()
+            self._closed.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, sock=self.socket,
+                                            limit=MAX_HEAD_BYTES)
+        reaper = asyncio.create_task(self._reap_loop())
+        self._ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            reaper.cancel()
+            server.close()
+            for writer in list(self._connections):
+                writer.close()
+            # Let open pipes see their sockets close instead of cancelling them mid-read
+            if self._clients:
+                await asyncio.wait(self._clients, timeout=1)
+
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients.add(task)
+        self._connections.add(writer)
+        peer = writer.get_extra_info('peername')
+        client_host = peer[0] if peer else ''
+        upstreams = {}
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except asyncio.LimitOverrunError:
+                    self._send_error(writer, 431, "Request header fields too large")
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                try:
+                    keep_alive = await self._forward(head, reader, writer, upstreams, client_host)
+                except _BadRequest as e:
+                    self._send_error(writer, 400, str(e))
+                    break
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError,
+                ValueError):
+            pass
+        finally:
+            for upstream in upstreams.values():
+                self._close(upstream.writer)
+            self._close(writer)
+            self._clients.discard(task)
+
+    async def _forward(self, head, reader, writer, upstreams, client_host):
+        """Send one request to its shard and relay the response; False closes the connection"""
+        request_line, fields, headers = _parse_head(head)
+        parts = request_line.split(' ')
+        if len(parts) != 3:
+            raise _BadRequest("malformed request line")
+        method, target, version = parts
+        _check_framing(fields, headers)
+        site_id, _path = site_for_request(urlsplit(target).path, headers.get(SITE_HEADER.lower()))
+        index = shard_for(site_id, self.shards)
+
+        upstream = upstreams.get(index)
+        if upstream is None or not upstream.usable():
+            if upstream is not None:
+                self._close(upstream.writer)
+            try:
+                upstream = _Upstream(*await asyncio.open_connection(
+                    '127.0.0.1', self._shard_ports[index], limit=MAX_HEAD_BYTES))
+            except OSError:
+                upstreams.pop(index, None)
+                self._send_error(writer, 502, f"Shard {index} is unavailable")
+                return False
+            upstreams[index] = upstream
+            self._connections.add(upstream.writer)
+
+        forwarded = ', '.join(filter(None, (headers.get('x-forwarded-for'), client_host)))
+        out = [request_line]
+        out.extend(f"{name}: {value}" for name, value in fields
+                   if name.lower() not in _DROPPED_HEADERS)
+        out.append(f"X-Forwarded-For: {forwarded}")
+        upstream.writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1'))
+        if headers.get('expect', '').lower() == '100-continue':
+            # Answered here; the shard sees an ordinary request with its body
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        await _relay_body(reader, upstream.writer, headers)
+
+        while True:
+            try:
+                response_head = await upstream.reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                del upstreams[index]
+                self._close(upstream.writer)
+                self._send_error(writer, 502, f"Shard {index} closed the connection")
+                return False
+            status_line, _fields, response_headers = _parse_head(response_head)
+            status = int(status_line.split(' ', 2)[1])
+            writer.write(response_head)
+            if status == 101 or response_headers.get('content-type', '').startswith('text/event-stream'):
+                # Long-lived stream: hand both sockets to a byte pipe until either side closes
+                del upstreams[index]
+                await writer.drain()
+                await asyncio.gather(_pipe(reader, upstream.writer), _pipe(upstream.reader, writer))
+                self._connections.discard(upstream.writer)
+                return False
+            if status >= 200:
+                break
+
+        if method == 'HEAD' or status in (204, 304):
+            pass
+        elif 'chunked' in response_headers.get('transfer-encoding', '').lower() \
+                or 'content-length' in response_headers:
+            await _relay_body(upstream.reader, writer, response_headers)
+        else:
+            # Body delimited by the shard closing the connection
+            del upstreams[index]
+            await _pipe(upstream.reader, writer)
+            self._close(upstream.writer)
+            return False
+        await writer.drain()
+        upstream.last_used = time.monotonic()
+
+        closing = 'close' in response_headers.get('connection', '').lower()
+        if closing:
+            del upstreams[index]
+            self._close(upstream.writer)
+        return not closing and 'close' not in headers.get('connection', '').lower() \
+            and version == 'HTTP/1.1'
+
+    def _send_error(self, writer, status, message):
+        body = ('{"error": "%s"}' % message.replace('"', "'")).encode()
+        reason = {400: 'Bad Request', 431: 'Request Header Fields Too Large',
+                  502: 'Bad Gateway'}.get(status, '')
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+
+    def _close(self, writer):
+        self._connections.discard(writer)
+        writer.close()
+
+    def shutdown(self):
+        """Stop coordinating and terminate the shards; safe to call from any thread"""
+        self._ready.wait()
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self._closed.wait(timeout=10)
+
+    def server_close(self):
+        self.socket.close()
+        for sock in self._shard_sockets:
+            sock.close()
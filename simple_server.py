@@ -4,17 +4,47 @@ Simple AI Energy Optimizer Server
 Works with basic Python libraries to avoid dependency issues
 """
 
+import argparse
 import json
-import random
+import os
+import shutil
+import signal
+import socket
 import time
 from datetime import datetime, timedelta
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import threading
 import webbrowser
 
-# Global device storage
-DEVICES = [
+from admission import (DEFAULT_MAX_BODY_BYTES, DEFAULT_MAX_CONCURRENT, DEFAULT_MAX_QUEUE,
+                       DEFAULT_QUEUE_TIMEOUT, DEFAULT_READ_TIMEOUT, AdmissionController,
+                       BodyLimitError, Overloaded)
+from analytics import parse_time
+from commands import MAX_SUBMIT, CommandQueueFull
+from device_registry import BatchError, check_fields, decode_cursor, encode_cursor
+from metrics import PROMETHEUS_CONTENT_TYPE, AccessLog, MetricsRegistry
+from optimizer import optimize_fleet
+from predictor import MAX_HORIZON_HOURS
+from profiling import RequestProfiler
+from response_cache import cache_key, etag_matches
+from router import Router, response_head
+from scheduler import MAX_HORIZON_HOURS as MAX_SCHEDULE_HOURS, build_schedule, default_jobs_for
+from serialization import JSON, loads, negotiate
+from server_modes import DEFAULT_MODE, KEEPALIVE_TIMEOUT, SERVER_MODES, create_server
+from sites import (SITE_HEADER, SiteDirectory, SiteLimitError, shard_for, site_for_request,
+                   valid_site_id)
+from static_assets import StaticAssets
+from storage import DEFAULT_DB_PATH
+from stream_hub import websocket_accept
+from telemetry import (BodyReader, ChunkedReader, EXPORT_CONTENT_TYPES, PARSERS, accepts_gzip,
+                       format_for_content_type, gzip_chunks, ingest_stream, iter_export,
+                       parse_content_length)
+
+# Per-site state: every site has its own devices, telemetry, models and
+# caches. Requests choose a site with a /sites/{site_id}/ path prefix or the
+# X-Site-Id header; the rest go to the default site, which has the demo devices.
+SITES = SiteDirectory([
     {
         "device_id": "thermostat_001",
         "device_name": "Living Room Thermostat",
@@ -47,9 +77,127 @@ DEVICES = [
         "location": "kitchen",
         "is_active": True
     }
-]
+])
+
+# The default site's components, for single-site callers
+DEVICES = SITES.default.devices
+TELEMETRY = SITES.default.telemetry
+PREDICTOR = SITES.default.predictor
+ROLLUPS = SITES.default.rollups
+RESPONSE_CACHE = SITES.default.cache
+STREAM_HUB = SITES.default.stream_hub
+DEVICE_FRAGMENTS = SITES.default.fragments
+
+# Request counters and latency histograms behind /metrics, and the access
+# log, which request threads hand to a background writer
+METRICS = MetricsRegistry()
+ACCESS_LOG = AccessLog()
+
+def collect_runtime_metrics():
+    """Component gauges and counters summed over every site, read when /metrics is scraped"""
+    sites = SITES.all()
+    cache = {key: sum(stats[key] for stats in (site.cache.stats() for site in sites))
+             for key in ('hits', 'misses', 'entries', 'bytes', 'evictions')}
+    cache_lookups = cache['hits'] + cache['misses']
+    hub = {key: sum(stats[key] for stats in (site.stream_hub.stats() for site in sites))
+           for key in ('subscribers', 'events_published', 'dropped_slow_subscribers')}
+    fragment_hits = sum(site.fragments.hits for site in sites)
+    lookups = fragment_hits + sum(site.fragments.misses for site in sites)
+    stores = [site.store for site in sites if site.store is not None]
+    admission = ADMISSION.stats()
+    anomalies = [site.anomalies.stats() for site in sites]
+    commands = SITES.commands.stats()
+    samples = [
+        ('sites', 'gauge', 'Sites with state in this process', len(sites)),
+        ('devices', 'gauge', 'Registered devices', sum(len(site.devices) for site in sites)),
+        ('response_cache_hits_total', 'counter', 'Response cache hits', cache['hits']),
+        ('response_cache_misses_total', 'counter', 'Response cache misses', cache['misses']),
+        ('response_cache_hit_ratio', 'gauge', 'Response cache hits per lookup',
+         round(cache['hits'] / cache_lookups, 3) if cache_lookups else 0.0),
+        ('response_cache_entries', 'gauge', 'Cached responses', cache['entries']),
+        ('response_cache_bytes', 'gauge', 'Bytes held by the response cache', cache['bytes']),
+        ('response_cache_evictions_total', 'counter', 'Responses evicted for space or age',
+         cache['evictions']),
+        ('device_fragment_hit_ratio', 'gauge', 'Device records served from cached encodings',
+         round(fragment_hits / lookups, 3) if lookups else 0.0),
+        ('telemetry_readings_buffered_total', 'counter', 'Readings added to the telemetry buffer',
+         sum(site.telemetry.total_readings for site in sites)),
+        ('anomalies_active', 'gauge', 'Open anomaly alerts', sum(stats['active'] for stats in anomalies)),
+        ('anomalies_opened_total', 'counter', 'Anomaly alerts opened',
+         sum(stats['opened_total'] for stats in anomalies)),
+        ('commands_pending', 'gauge', 'Device commands waiting or in flight', commands['pending']),
+        ('commands_total', 'counter', 'Device commands finished by outcome',
+         [({'status': status}, count) for status, count in sorted(commands['totals'].items())
+          if status != 'retries']),
+        ('command_retries_total', 'counter', 'Device command deliveries retried',
+         commands['totals']['retries']),
+        ('stream_subscribers', 'gauge', 'Open /stream connections', hub['subscribers']),
+        ('stream_events_published_total', 'counter', 'Events published to /stream',
+         hub['events_published']),
+        ('stream_dropped_subscribers_total', 'counter', 'Subscribers dropped for falling behind',
+         hub['dropped_slow_subscribers']),
+        ('access_log_dropped_total', 'counter', 'Access log lines dropped under backlog',
+         ACCESS_LOG.dropped),
+        ('admission_active_requests', 'gauge', 'Requests holding an admission slot', admission['active']),
+        ('admission_queued_requests', 'gauge', 'Requests waiting for an admission slot',
+         admission['waiting']),
+        ('admission_rejected_total', 'counter', 'Requests shed by route and status',
+         [({'route': route, 'status': status}, count)
+          for route, state in sorted(admission['routes'].items())
+          for status, count in sorted(state['rejected'].items())]),
+    ]
+    if stores:
+        samples.append(('store_readings_written_total', 'counter', 'Readings committed to SQLite',
+                        sum(store.readings_written for store in stores)))
+        samples.append(('store_rows_dropped_total', 'counter', 'Rows dropped after failing to write to SQLite',
+                        sum(store.rows_dropped for store in stores)))
+    return samples
+
+METRICS.add_collector(collect_runtime_metrics)
+
+# Per-route concurrency limits, a bounded wait queue and body limits; /health
+# and /metrics bypass it
+ADMISSION = AdmissionController()
+
+# Off until switched on through POST /debug/profile or SIGUSR2
+PROFILER = RequestProfiler()
+LOCAL_ADDRESSES = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+# The default site's store; stays None when the server runs purely in memory
+STORE = None
 
-def generate_device_id(device_name):
+def configure_storage(path=DEFAULT_DB_PATH, warm=True):
+    """Open a SQLite store per site (``path`` for the default site), loading saved devices"""
+    global STORE
+    STORE = SITES.configure_storage(path, warm)
+    return STORE
+
+# Set while the models are trained from the database after startup; /health
+# answers 503 (not ready) until it clears
+WARMING = threading.Event()
+# Seconds spent in each startup phase, reported by /health
+STARTUP = {}
+
+def warm_up():
+    """Train forecasting models and load rollups from the database, then report ready"""
+    started = time.perf_counter()
+    try:
+        SITES.warm()
+    except Exception as e:
+        print(f"⚠️ Model warm-up failed: {e}")
+    finally:
+        STARTUP['warmup'] = time.perf_counter() - started
+        WARMING.clear()
+    print(f"🔥 Models warm in {STARTUP['warmup'] * 1000:.0f} ms (pid {os.getpid()}); /health reports ready")
+
+# Frontend files, loaded into memory once per process
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend')
+STATIC = StaticAssets(FRONTEND_DIR)
+
+# Route table; handlers register themselves with @ROUTER.get/@ROUTER.post
+ROUTER = Router()
+
+def generate_device_id(device_name, devices, taken=()):
     """Generate a unique device ID from device name"""
     import re
     # Convert to lowercase and replace spaces with underscores
@@ -60,306 +208,875 @@ def generate_device_id(device_name):
     device_id = device_id.strip('_')
     # Add timestamp to ensure uniqueness
     timestamp = str(int(time.time()))[-6:]
-    return f"{device_id}_{timestamp}"
+    candidate = f"{device_id}_{timestamp}"
+    # Same name within the same second: add a counter
+    suffix = 1
+    while candidate in devices or candidate in taken:
+        suffix += 1
+        candidate = f"{device_id}_{timestamp}_{suffix}"
+    return candidate
 
 class EnergyOptimizerHandler(BaseHTTPRequestHandler):
     """HTTP request handler for the AI Energy Optimizer"""
     
-    def do_GET(self):
-        """Handle GET requests"""
-        parsed_url = urlparse(self.path)
-        path = parsed_url.path
+    # HTTP/1.1 keeps connections alive so dashboard polling reuses sockets
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    
+    def _body_stream(self):
+        """File-like reader over the request body, chunked or sized, within the route's limits"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            stream = ChunkedReader(self.rfile)
+        else:
+            length = self.headers.get('Content-Length')
+            stream = BodyReader(self.rfile, parse_content_length(length) if length else 0)
+        return ADMISSION.limit_body(stream, self._route)
+    
+    def _read_body(self):
+        """Read the whole request body"""
+        return self._body_stream().read()
+    
+    def _discard_body(self):
+        """Drain an unused body so the kept-alive connection stays in sync; close instead if too large"""
+        try:
+            self._read_body()
+        except (BodyLimitError, ValueError):
+            self.close_connection = True
+    
+    def _send_bytes(self, body, content_type='application/json', status=200, headers=None):
+        """Send a complete response: status line, headers and body in one write"""
+        fields = [('Content-type', content_type), ('Content-Length', len(body)),
+                  ('Access-Control-Allow-Origin', '*')]
+        if headers:
+            fields.extend(headers.items())
+        if self.close_connection:
+            fields.append(('Connection', 'close'))
+        self.log_request(status, len(body))
+        head = response_head(self.protocol_version, status, self.version_string(), fields)
+        self.wfile.write(head + body)
+    
+    def _send_stream(self, chunks, content_type, headers=None):
+        """Send a response of unknown length with chunked transfer encoding"""
+        fields = [('Content-type', content_type), ('Transfer-Encoding', 'chunked'),
+                  ('Access-Control-Allow-Origin', '*')]
+        if headers:
+            fields.extend(headers.items())
+        self.log_request(200)
+        self.wfile.write(response_head(self.protocol_version, 200, self.version_string(), fields))
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        except Exception as e:
+            # Headers are gone; omitting the last chunk tells the client the body is incomplete
+            print(f"⚠️ Streaming response aborted: {e}")
+            self.close_connection = True
+            return
+        self.wfile.write(b'0\r\n\r\n')
+    
+    def _detach(self):
+        """Take the socket away from the server so it outlives this request"""
+        self.close_connection = True
+        self.wfile.flush()
+        return socket.socket(fileno=self.connection.detach())
+    
+    def _send_asset(self, asset):
+        """Send a static file: gzip variant when accepted, 304 when unchanged"""
+        use_gzip = asset.gzip_body is not None and accepts_gzip(self.headers.get('Accept-Encoding'))
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        headers = {'ETag': etag, 'Last-Modified': asset.last_modified,
+                   'Cache-Control': asset.cache_control}
+        if asset.compressible:
+            headers['Vary'] = 'Accept-Encoding'
+        if_none_match = self.headers.get('If-None-Match')
+        if etag_matches(if_none_match, etag) or (
+                if_none_match is None and asset.not_modified_since(self.headers.get('If-Modified-Since'))):
+            self._send_bytes(b'', asset.content_type, status=304, headers=headers)
+        elif use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            self._send_bytes(asset.gzip_body, asset.content_type, headers=headers)
+        elif asset.in_memory:
+            self._send_bytes(asset.body, asset.content_type, headers=headers)
+        else:
+            self._send_file(asset, headers)
+    
+    def _send_file(self, asset, headers):
+        """Stream a large file from disk, zero-copy where the socket supports it"""
+        fields = [('Content-type', asset.content_type), ('Content-Length', asset.size),
+                  ('Access-Control-Allow-Origin', '*'), *headers.items()]
+        self.log_request(200, asset.size)
+        self.wfile.write(response_head(self.protocol_version, 200, self.version_string(), fields))
+        with open(asset.file_path, 'rb') as f:
+            if hasattr(self.connection, 'sendfile'):
+                self.connection.sendfile(f, 0, asset.size)
+            else:
+                shutil.copyfileobj(f, self.wfile)
+    
+    def _send_cache_entry(self, entry):
+        """Send a cached response, or 304 when the client already has it"""
+        headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+        if etag_matches(self.headers.get('If-None-Match'), entry.etag):
+            self._send_bytes(b'', entry.content_type, status=304, headers=headers)
+        else:
+            self._send_bytes(entry.body, entry.content_type, headers=headers)
+    
+    def _encoder(self):
+        """Response encoder picked by the Accept header (JSON by default)"""
+        return negotiate(self.headers.get('Accept'))
+    
+    def _send_cached(self, key):
+        """Answer from the response cache; returns False on a miss"""
+        encoder = self._encoder()
+        if encoder is not JSON:
+            key = f"{key} {encoder.content_type}"
+        entry = self.site.cache.get(key)
+        if entry is None:
+            # Tag generations as of the miss; an invalidation while computing makes the result stale
+            self._cache_generations = self.site.cache.generations()
+            return False
+        self._send_cache_entry(entry)
+        return True
+    
+    def _send_and_cache(self, key, response, tags):
+        """Serialize ``response``, cache the bytes and send them"""
+        encoder = self._encoder()
+        if encoder is not JSON:
+            key = f"{key} {encoder.content_type}"
+        generations, self._cache_generations = getattr(self, '_cache_generations', None), None
+        entry = self.site.cache.put(key, encoder.dumps(response), content_type=encoder.content_type,
+                                    tags=tags, generations=generations)
+        self._send_cache_entry(entry)
+    
+    def _send_json(self, response, status=200, headers=None):
+        """Serialize ``response`` as JSON, or MessagePack when the client asks for it"""
+        encoder = self._encoder()
+        headers = dict(headers or (), Vary='Accept')
+        self._send_bytes(encoder.dumps(response), encoder.content_type, status=status,
+                         headers=headers)
+    
+    def _read_json_object(self):
+        """Decode the request body as a JSON object ({} when empty)"""
+        post_data = self._read_body()
+        data = loads(post_data) if post_data.strip() else {}
+        if not isinstance(data, dict):
+            raise ValueError("request body must be a JSON object")
+        return data
+    
+    def log_request(self, code='-', size='-'):
+        """Remember the status for the metrics, then log the request"""
+        self._status = int(code) if isinstance(code, int) else code
+        super().log_request(code, size)
+    
+    def log_message(self, format, *args):
+        """Queue an access log line instead of writing stderr on the request path"""
+        ACCESS_LOG.write("%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(),
+                                                format % args))
+    
+    def _dispatch(self):
+        """Route the request to its site and handler, or answer 404/405"""
+        self.url = urlparse(self.path)
+        site_id, path = site_for_request(self.url.path, self.headers.get(SITE_HEADER))
+        handler, params, allowed = ROUTER.match(self.command, path)
+        # Unknown paths share one series so scanners cannot grow the label set
+        route = ROUTER.pattern(handler) if handler is not None else 'unmatched'
+        self._route = route
+        self._status = None
+        stats = METRICS.request_started(self.command, route)
+        started = time.perf_counter()
+        # Reads inside a request get the read timeout; waits between requests keep the idle one
+        self._set_timeout(ADMISSION.read_timeout)
+        try:
+            if handler is None:
+                self._send_unmatched(allowed)
+            elif self._body_fits(route):
+                with ADMISSION.slot(route):
+                    if self._select_site(site_id):
+                        PROFILER.call(route, handler, self, parse_qs(self.url.query), **params)
+        except Overloaded as e:
+            self._shed(e.status, str(e), {'Retry-After': str(e.retry_after)})
+        except BodyLimitError as e:
+            self._shed(e.status, str(e))
+        finally:
+            self._set_timeout(self.timeout)
+            METRICS.request_finished(stats, self._status or 500, time.perf_counter() - started)
+    
+    def _set_timeout(self, seconds):
+        try:
+            self.connection.settimeout(seconds)
+        except OSError:
+            pass  # Detached by /stream
+    
+    def _body_fits(self, route):
+        """Answer 413 up front when the declared body is over the route's limit, 400 when unreadable"""
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return True
+        try:
+            length = parse_content_length(length)
+        except ValueError:
+            # The body's end is unknown, so the connection cannot be reused
+            self.close_connection = True
+            self._shed(400, "Invalid Content-Length")
+            return False
+        limit = ADMISSION.body_limit(route)
+        if length > limit:
+            self._shed(413, f"Request body exceeds {limit} bytes")
+            return False
+        return True
+    
+    def _shed(self, status, message, headers=None):
+        """Refuse the request without reading its body, then close the connection"""
+        if self.command == 'POST':
+            self.close_connection = True
+        self._send_json({"error": message}, status=status, headers=headers)
+    
+    def _select_site(self, site_id):
+        """Set ``self.site`` for the request; answers 400/404/421/503 and returns False when it cannot
+
+        Only writes create a site, so a scan of made-up site ids leaves no state behind.
+        """
+        error = None
+        if not valid_site_id(site_id):
+            status, error = 400, f"Invalid site id '{site_id[:64]}'"
+        else:
+            shard = getattr(self.server, 'shard', None)
+            if shard is not None and shard_for(site_id, shard[1]) != shard[0]:
+                status, error = 421, f"Site '{site_id}' is served by shard {shard_for(site_id, shard[1])}"
+            else:
+                try:
+                    self.site = SITES.get(site_id, create=self.command == 'POST')
+                except SiteLimitError as e:
+                    status, error = 503, str(e)
+                else:
+                    if self.site is None:
+                        status, error = 404, f"Site '{site_id}' not found"
+        if error is None:
+            return True
+        if self.command == 'POST':
+            self._discard_body()
+        self._send_json({"error": error}, status=status)
+        return False
+    
+    def _send_unmatched(self, allowed):
+        """404 for unknown paths, 405 for known paths with another method"""
+        if self.command == 'POST':
+            self._discard_body()
+        if allowed:
+            self._send_json({"error": "Method not allowed"}, status=405,
+                            headers={'Allow': ', '.join(allowed)})
+        else:
+            self._send_json({"error": "Endpoint not found"}, status=404)
+    
+    do_GET = do_POST = _dispatch
+    
+    @ROUTER.get('/')
+    def index(self, query):
+        response = {
+            "message": "AI Energy Optimizer API",
+            "status": "running",
+            "timestamp": datetime.now().isoformat()
+        }
+        self._send_json(response)
+    
+    @ROUTER.get('/health')
+    def health(self, query):
+        ready = not WARMING.is_set()
+        response = {
+            "status": "healthy" if ready else "warming",
+            "ready": ready,
+            "startup_ms": {phase: round(seconds * 1000, 1) for phase, seconds in STARTUP.items()},
+            "timestamp": datetime.now().isoformat()
+        }
+        # Readiness: load balancers hold traffic back until the models are trained
+        self._send_json(response, status=200 if ready else 503)
+    
+    @ROUTER.get('/metrics')
+    def metrics(self, query):
+        """Prometheus scrape endpoint"""
+        self._send_bytes(METRICS.render().encode(), PROMETHEUS_CONTENT_TYPE)
+    
+    def _client_host(self):
+        """The client's address, or the one a local proxy (the shard coordinator) forwarded"""
+        host = self.client_address[0]
+        forwarded = self.headers.get('X-Forwarded-For')
+        if forwarded and host in LOCAL_ADDRESSES:
+            return forwarded.rsplit(',', 1)[-1].strip()
+        return host
+    
+    def _require_local(self):
+        """Debug endpoints answer loopback clients only; sends 403 otherwise"""
+        if self._client_host() in LOCAL_ADDRESSES:
+            return True
+        self._send_json({"error": "Debug endpoints are only available from localhost"}, status=403)
+        return False
+    
+    @ROUTER.get('/debug/profile')
+    def debug_profile(self, query):
+        """Aggregated profiles: collapsed stacks, pstats text or the profiler status"""
+        if not self._require_local():
+            return
+        report = query.get('format', ['collapsed' if PROFILER.mode == 'stack' else 'pstats'])[0]
+        route = query.get('route', [None])[0]
+        try:
+            if report == 'status':
+                self._send_json(PROFILER.status())
+            elif report == 'collapsed':
+                self._send_bytes(PROFILER.collapsed(route).encode(), 'text/plain; charset=utf-8')
+            elif report == 'pstats':
+                text = PROFILER.pstats_report(route, sort=query.get('sort', ['cumulative'])[0],
+                                              limit=int(query.get('limit', ['40'])[0]))
+                self._send_bytes(text.encode(), 'text/plain; charset=utf-8')
+            else:
+                raise ValueError("format must be 'collapsed', 'pstats' or 'status'")
+        except ValueError as e:
+            self._send_json({"error": str(e)}, status=400)
+    
+    @ROUTER.post('/debug/profile')
+    def debug_profile_configure(self, query):
+        """Switch profiling on or off and choose mode, sample rate and routes"""
+        if not self._require_local():
+            self._discard_body()
+            return
+        try:
+            options = self._read_json_object()
+            status = PROFILER.configure(
+                enabled=options.get('enabled'),
+                mode=options.get('mode'),
+                sample_rate=options.get('sample_rate'),
+                routes=options.get('routes'),
+                reset=bool(options.get('reset')))
+        except (TypeError, ValueError) as e:
+            self._send_json({"error": f"Invalid profiler settings: {e}"}, status=400)
+            return
+        self._send_json(status)
+    
+    @ROUTER.get('/predictions')
+    def predictions(self, query):
+        key = cache_key(self.url.path, self.url.query)
+        if self._send_cached(key):
+            return
         
-        if path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = {
-                "message": "AI Energy Optimizer API",
-                "status": "running",
-                "timestamp": datetime.now().isoformat()
-            }
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = {
-                "status": "healthy",
-                "timestamp": datetime.now().isoformat()
-            }
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/predictions':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            # Generate energy predictions
-            predictions = []
-            current_time = datetime.now()
-            
-            for i in range(24):
-                future_time = current_time + timedelta(hours=i)
-                predicted_usage = 2.5 + random.uniform(-0.5, 0.5)
-                confidence = 0.85 + random.uniform(-0.05, 0.05)
-                
-                predictions.append({
-                    'timestamp': future_time.isoformat(),
-                    'predicted_usage': round(predicted_usage, 2),
-                    'confidence': round(confidence, 2)
-                })
-            
-            total_usage = sum(p['predicted_usage'] for p in predictions)
-            avg_confidence = sum(p['confidence'] for p in predictions) / len(predictions)
-            
-            response = {
-                "predictions": predictions,
-                "total_predicted_usage": round(total_usage, 2),
-                "average_confidence": round(avg_confidence, 2)
-            }
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/devices/sample':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = {"devices": DEVICES}
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/analytics/summary':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            analytics = {
-                "average_daily_usage": round(random.uniform(50, 80), 2),
-                "peak_usage": round(random.uniform(4, 6), 2),
-                "min_usage": round(random.uniform(1, 2), 2),
-                "peak_hours_count": random.randint(4, 8),
-                "efficiency_score": round(random.uniform(70, 90), 1),
-                "prediction_confidence": round(random.uniform(0.8, 0.95), 2)
-            }
-            
-            self.wfile.write(json.dumps(analytics).encode())
-            
-        elif path == '/frontend/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            # Read the frontend HTML file
-            try:
-                with open('frontend/index.html', 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                self.wfile.write(html_content.encode('utf-8'))
-            except FileNotFoundError:
-                self.wfile.write(b"Frontend file not found")
+        device_id = query.get('device_id', [None])[0]
+        try:
+            hours = int(query.get('hours', ['24'])[0])
+            response = self.site.predictor.predict(hours, device_id)
+        except ValueError:
+            self._send_json({"error": f"hours must be an integer between 1 and {MAX_HORIZON_HOURS}"},
+                            status=400)
+            return
+        except KeyError:
+            self._send_json({"error": f"Device '{device_id}' not found"}, status=404)
+            return
+        
+        self._send_and_cache(key, response, tags=('devices', 'models'))
+    
+    @ROUTER.get('/devices/sample')
+    def devices_sample(self, query):
+        def param(name):
+            return query.get(name, [None])[0]
+        
+        is_active = param('is_active')
+        fields = param('fields')
+        try:
+            cursor = param('cursor')
+            devices, position = self.site.devices.page(
+                device_type=param('device_type'),
+                location=param('location'),
+                is_active=None if is_active is None else is_active.lower() in ('1', 'true', 'yes'),
+                sort=param('sort') or 'device_id',
+                cursor=decode_cursor(cursor) if cursor else None,
+                limit=int(param('limit') or 100),
+                fields=fields.split(',') if fields else None)
+        except ValueError as e:
+            self._send_json({"error": f"Invalid device query: {e}"}, status=400)
+            return
+        
+        # Unchanged device records are spliced in from their cached encoding
+        encoder = self._encoder()
+        body = encoder.mapping([
+            ("devices", self.site.fragments.encode_list(encoder, devices, fields)),
+            ("count", encoder.dumps(len(devices))),
+            ("next_cursor", encoder.dumps(encode_cursor(position) if position is not None else None))
+        ])
+        self._send_bytes(body, encoder.content_type, headers={'Vary': 'Accept'})
+    
+    @ROUTER.get('/devices/{device_id}')
+    def device_detail(self, query, device_id):
+        device = self.site.devices.get(device_id)
+        if device is None:
+            self._send_json({"error": f"Device '{device_id}' not found"}, status=404)
+            return
+        self._send_json({"device": device})
+    
+    @ROUTER.get('/commands/{command_id}')
+    def command_status(self, query, command_id):
+        # Ids are global to the process; a site only sees its own commands
+        if self.site.commands.site_of(command_id) != self.site.site_id:
+            self._send_json({"error": f"Command '{command_id}' not found"}, status=404)
+            return
+        self._send_json({"command": self.site.commands.get(command_id)})
+    
+    @ROUTER.get('/analytics/summary')
+    def analytics_summary(self, query):
+        key = cache_key(self.url.path, self.url.query)
+        if self._send_cached(key):
+            return
+        
+        start = query.get('start', [None])[0]
+        end = query.get('end', [None])[0]
+        try:
+            analytics = self.site.rollups.summary(
+                start=parse_time(start) if start else None,
+                end=parse_time(end) if end else None,
+                location=query.get('location', [None])[0],
+                device_type=query.get('device_type', [None])[0])
+        except ValueError as e:
+            self._send_json({"error": f"Invalid time range: {e}"}, status=400)
+            return
+        analytics["prediction_confidence"] = self.site.predictor.predict(24)["average_confidence"]
+        
+        self._send_and_cache(key, analytics, tags=('devices', 'telemetry', 'models'))
+    
+    @ROUTER.get('/anomalies')
+    def anomalies(self, query):
+        key = cache_key(self.url.path, self.url.query)
+        if self._send_cached(key):
+            return
+        
+        def param(name):
+            return query.get(name, [None])[0]
+        
+        try:
+            alerts = self.site.anomalies.alerts(
+                status=param('status') or 'active',
+                device_id=param('device_id'),
+                device_type=param('device_type'),
+                location=param('location'),
+                limit=int(param('limit') or 100))
+        except ValueError as e:
+            self._send_json({"error": f"Invalid anomaly query: {e}"}, status=400)
+            return
+        
+        stats = self.site.anomalies.stats()
+        self._send_and_cache(key, {"anomalies": alerts, "count": len(alerts), "active": stats["active"]},
+                             tags=('devices', 'telemetry'))
+    
+    @ROUTER.get('/telemetry/export')
+    def telemetry_export(self, query):
+        export_format = query.get('format', ['ndjson'])[0]
+        if export_format not in EXPORT_CONTENT_TYPES:
+            self._send_json({"error": "format must be 'ndjson' or 'csv'"}, status=400)
+            return
+        try:
+            start = parse_time(query['start'][0]) if 'start' in query else 0.0
+            end = parse_time(query['end'][0]) if 'end' in query else float('inf')
+        except ValueError as e:
+            self._send_json({"error": f"Invalid time range: {e}"}, status=400)
+            return
+        # Without device_id, export every registered device
+        device_ids = query.get('device_id') or [device['device_id'] for device in self.site.devices.to_list()]
+        
+        chunks = iter_export(self.site.export_pages(device_ids, start, end), export_format)
+        headers = {
+            'Content-Disposition': f'attachment; filename="telemetry.{export_format}"',
+            'Vary': 'Accept-Encoding'
+        }
+        if accepts_gzip(self.headers.get('Accept-Encoding')):
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        self._send_stream(chunks, EXPORT_CONTENT_TYPES[export_format], headers)
+    
+    @ROUTER.get('/stream')
+    def stream(self, query):
+        topics = query['topics'][0].split(',') if 'topics' in query else None
+        if self.headers.get('Upgrade', '').lower() == 'websocket':
+            key = self.headers.get('Sec-WebSocket-Key')
+            if not key:
+                self._send_json({"error": "Missing Sec-WebSocket-Key"}, status=400)
+                return
+            status = 101
+            fields = [('Upgrade', 'websocket'), ('Connection', 'Upgrade'),
+                      ('Sec-WebSocket-Accept', websocket_accept(key))]
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = {"error": "Endpoint not found"}
-            self.wfile.write(json.dumps(response).encode())
-    
-    def do_POST(self):
-        """Handle POST requests"""
-        parsed_url = urlparse(self.path)
-        path = parsed_url.path
+            status = 200
+            fields = [('Content-type', 'text/event-stream'), ('Cache-Control', 'no-cache'),
+                      ('Access-Control-Allow-Origin', '*'), ('X-Accel-Buffering', 'no')]
+        self.log_request(status)
+        self.wfile.write(response_head(self.protocol_version, status, self.version_string(), fields))
+        # The hub's thread owns the connection from here on; no thread is held per subscriber
+        devices = self.site.devices
+        self.site.stream_hub.subscribe(self._detach(), websocket=status == 101, topics=topics,
+                                       last_event_id=self.headers.get('Last-Event-ID'),
+                                       snapshot=lambda: {"devices": devices.to_list()})
+    
+    @ROUTER.get('/frontend/{asset_path:path}')
+    def frontend(self, query, asset_path):
+        asset = STATIC.get(asset_path)
+        if asset is None:
+            self._send_bytes(b"Frontend file not found", 'text/html', status=404)
+            return
+        self._send_asset(asset)
+    
+    @ROUTER.post('/optimize')
+    def optimize(self, query):
+        try:
+            options = self._read_json_object()
+            # Devices drawing well above their baseline are recommended first
+            response = optimize_fleet(self.site.devices, options, boosts=self.site.anomalies.boosts())
+        except (ValueError, TypeError) as e:
+            self._send_json({"error": f"Invalid optimization request: {e}"}, status=400)
+            return
         
-        if path == '/optimize':
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            # Generate optimization recommendations
-            recommendations = []
-            current_usage = 3.0
-            
-            device_types = ['thermostat', 'lighting', 'hvac', 'appliances']
-            actions = {
-                'thermostat': ['lower_temp', 'schedule_optimization', 'eco_mode'],
-                'lighting': ['dim_lights', 'motion_sensors', 'led_upgrade'],
-                'hvac': ['zone_control', 'maintenance', 'smart_scheduling'],
-                'appliances': ['delay_operation', 'eco_mode', 'power_management']
-            }
-            
-            for device_type in device_types:
-                for action in actions[device_type]:
-                    savings = random.uniform(0.1, 0.5)
-                    recommendations.append({
-                        'device_id': f"{device_type}_001",
-                        'recommended_action': action,
-                        'expected_savings': round(savings, 2),
-                        'priority': 'high' if savings > 0.3 else 'medium'
-                    })
-            
-            total_savings = sum(r['expected_savings'] for r in recommendations)
-            savings_percentage = (total_savings / current_usage) * 100
-            
-            response = {
-                "recommendations": recommendations,
-                "total_potential_savings": round(total_savings, 2),
-                "savings_percentage": round(savings_percentage, 1),
-                "current_usage": round(current_usage, 2)
-            }
-            
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/devices/add':
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            device_data = json.loads(post_data.decode('utf-8'))
-            
-            # Generate unique device ID
-            device_id = generate_device_id(device_data.get('device_name', 'new_device'))
-            
-            # Create new device
-            new_device = {
-                "device_id": device_id,
+        if options.get('apply'):
+            # Recommended actions go out as device commands in the background
+            pending = []
+            for recommendation in response['recommendations']:
+                device = self.site.devices.get(recommendation['device_id'])
+                if device is not None:
+                    pending.append((device, recommendation['recommended_action'],
+                                    {"expected_savings": recommendation['expected_savings']}))
+            try:
+                response['commands'] = self.site.commands.submit_many(self.site.site_id, pending)
+            except CommandQueueFull as e:
+                self._send_json({"error": str(e)}, status=503, headers={'Retry-After': '1'})
+                return
+        
+        self._send_json(response)
+    
+    @ROUTER.post('/schedule')
+    def schedule(self, query):
+        try:
+            request = self._read_json_object()
+            horizon = int(request.get('horizon_hours', 24))
+            if request.get('use_forecast', True) and 1 <= horizon <= MAX_SCHEDULE_HOURS:
+                forecast = self.site.predictor.predict(horizon)['predictions']
+                base_load = [p['predicted_usage'] for p in forecast]
+            else:
+                base_load = [0.0] * max(horizon, 0)
+            # Without explicit jobs, every active appliance gets one deferrable run
+            appliances = self.site.devices.find(device_type='appliances', is_active=True)
+            response = build_schedule(request, base_load,
+                                      default_jobs=default_jobs_for(appliances, window_hours=horizon))
+        except (ValueError, TypeError) as e:
+            self._send_json({"error": f"Invalid schedule request: {e}"}, status=400)
+            return
+        
+        self._send_json(response)
+    
+    @ROUTER.post('/telemetry/ingest')
+    def telemetry_ingest(self, query):
+        # Parse the body as it arrives instead of buffering it whole
+        body_format = format_for_content_type(self.headers.get('Content-Type'))
+        parser = PARSERS[body_format]
+        try:
+            site = self.site
+            result = ingest_stream(parser(self._body_stream()), site.devices, site.telemetry, site.store)
+        except ValueError as e:
+            # Broken chunk framing leaves the connection unusable
+            self.close_connection = True
+            self._send_json({"success": False, "message": str(e)}, status=400)
+            return
+        
+        response = {
+            "success": result["rejected"] == 0,
+            "format": body_format,
+            **result
+        }
+        METRICS.inc('ingest_readings_total', result['accepted'], "Telemetry readings ingested by outcome",
+                    outcome='accepted')
+        METRICS.inc('ingest_readings_total', result['rejected'], "Telemetry readings ingested by outcome",
+                    outcome='rejected')
+        self._send_json(response)
+    
+    @ROUTER.post('/devices/add')
+    def devices_add(self, query):
+        # Read request body; fields are checked the same way as /devices/batch adds
+        try:
+            device_data = self._read_json_object()
+            new_device = check_fields({
                 "device_name": device_data.get('device_name', 'New Device'),
                 "device_type": device_data.get('device_type', 'other'),
-                "current_power": float(device_data.get('power_rating', 1.0)),
+                "current_power": device_data.get('power_rating', 1.0),
                 "location": device_data.get('location', 'unknown'),
-                "is_active": device_data.get('is_active', True)
-            }
-            
-            # Add to global storage
-            DEVICES.append(new_device)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
+                "is_active": bool(device_data.get('is_active', True))
+            })
+        except ValueError as e:
+            self._send_json({"success": False, "message": f"Invalid device: {e}"}, status=400)
+            return
+        
+        # Generate unique device ID
+        devices = self.site.devices
+        new_device['device_id'] = generate_device_id(device_data.get('device_name', 'new_device'), devices)
+        
+        # Add to the site's registry, re-deriving the id if a concurrent add took it
+        while True:
+            try:
+                new_device = devices.add(new_device)
+                break
+            except ValueError:
+                new_device['device_id'] = generate_device_id(new_device['device_name'], devices)
+        
+        response = {
+            "success": True,
+            "message": "Device added successfully",
+            "device": new_device
+        }
+        
+        self._send_json(response)
+    
+    @ROUTER.post('/devices/delete')
+    def devices_delete(self, query):
+        # Read request body
+        post_data = self._read_body()
+        delete_data = json.loads(post_data.decode('utf-8'))
+        
+        device_id = delete_data.get('device_id')
+        
+        # Find and remove device
+        if self.site.devices.remove(device_id):
             response = {
                 "success": True,
-                "message": "Device added successfully",
-                "device": new_device
+                "message": "Device deleted successfully"
             }
-            
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/devices/delete':
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            delete_data = json.loads(post_data.decode('utf-8'))
-            
-            device_id = delete_data.get('device_id')
-            
-            # Find and remove device
-            original_length = len(DEVICES)
-            DEVICES[:] = [device for device in DEVICES if device['device_id'] != device_id]
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            if len(DEVICES) < original_length:
-                response = {
-                    "success": True,
-                    "message": "Device deleted successfully"
-                }
-            else:
-                response = {
-                    "success": False,
-                    "message": "Device not found"
-                }
-            
-            self.wfile.write(json.dumps(response).encode())
-            
-        elif path == '/devices/toggle':
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            toggle_data = json.loads(post_data.decode('utf-8'))
-            
-            device_id = toggle_data.get('device_id')
-            
-            # Find and toggle device
-            for device in DEVICES:
-                if device['device_id'] == device_id:
-                    device['is_active'] = not device['is_active']
-                    break
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
+        else:
+            response = {
+                "success": False,
+                "message": "Device not found"
+            }
+        
+        self._send_json(response)
+    
+    @ROUTER.post('/devices/toggle')
+    def devices_toggle(self, query):
+        # Read request body
+        post_data = self._read_body()
+        toggle_data = json.loads(post_data.decode('utf-8'))
+        
+        device_id = toggle_data.get('device_id')
+        
+        # Find and toggle device
+        device = self.site.devices.toggle(device_id)
+        
+        if device is not None:
             response = {
                 "success": True,
-                "message": "Device toggled successfully"
+                "message": "Device toggled successfully",
+                "device": device
             }
-            
-            self.wfile.write(json.dumps(response).encode())
+            # The device itself is told in the background
+            try:
+                response["command"] = self.site.commands.submit(self.site.site_id, device, 'toggle')
+            except CommandQueueFull as e:
+                response["command"] = None
+                response["command_error"] = str(e)
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = {"error": "Endpoint not found"}
-            self.wfile.write(json.dumps(response).encode())
+            response = {
+                "success": False,
+                "message": "Device not found"
+            }
+        
+        self._send_json(response)
+    
+    @ROUTER.post('/devices/batch')
+    def devices_batch(self, query):
+        """Apply a list of add/delete/toggle/update operations all-or-nothing"""
+        try:
+            operations = self._read_json_object().get('operations')
+            if not isinstance(operations, list):
+                raise ValueError("'operations' must be a list")
+        except ValueError as e:
+            self._send_json({"success": False, "message": f"Invalid batch: {e}"}, status=400)
+            return
+        
+        generated = set()
+        for operation in operations:
+            # Adds take the same fields as /devices/add
+            if isinstance(operation, dict) and operation.get('op') == 'add':
+                device = operation.get('device')
+                if isinstance(device, dict):
+                    device = dict(device)
+                    if 'power_rating' in device and 'current_power' not in device:
+                        device['current_power'] = device.pop('power_rating')
+                    if not operation.get('device_id') and not device.get('device_id'):
+                        device['device_id'] = generate_device_id(
+                            str(device.get('device_name', 'new_device')), self.site.devices, generated)
+                        generated.add(device['device_id'])
+                    operation['device'] = device
+        
+        try:
+            results = self.site.devices.apply_batch(operations)
+        except BatchError as e:
+            self._send_json({"success": False, "message": str(e), "errors": e.errors}, status=400)
+            return
+        
+        response = {"success": True, "applied": len(results), "results": results}
+        toggled = [result for result in results if result['op'] == 'toggle']
+        if toggled:
+            try:
+                commands = self.site.commands.submit_many(
+                    self.site.site_id, [(result['device'], 'toggle', None) for result in toggled])
+                for result, command in zip(toggled, commands):
+                    result['command_id'] = command['command_id']
+            except CommandQueueFull as e:
+                response['command_error'] = str(e)
+        self._send_json(response)
+    
+    @ROUTER.post('/commands')
+    def commands_submit(self, query):
+        """Queue commands for devices; they are delivered in the background"""
+        errors = []
+        pending = []
+        try:
+            commands = self._read_json_object().get('commands')
+            if not isinstance(commands, list) or not 1 <= len(commands) <= MAX_SUBMIT:
+                raise ValueError(f"'commands' must be a list of 1 to {MAX_SUBMIT} commands")
+        except ValueError as e:
+            self._send_json({"success": False, "message": f"Invalid commands: {e}"}, status=400)
+            return
+        
+        for index, command in enumerate(commands):
+            if not isinstance(command, dict):
+                errors.append({"index": index, "message": "command must be an object"})
+                continue
+            device = self.site.devices.get(str(command.get('device_id')))
+            action = command.get('action')
+            params = command.get('params') or {}
+            if device is None:
+                errors.append({"index": index, "message": f"Device '{command.get('device_id')}' not found"})
+            elif not isinstance(action, str) or not action:
+                errors.append({"index": index, "message": "action must be a non-empty string"})
+            elif not isinstance(params, dict):
+                errors.append({"index": index, "message": "params must be an object"})
+            else:
+                pending.append((device, action, params))
+        if errors:
+            self._send_json({"success": False, "errors": errors,
+                             "message": f"{len(errors)} command(s) rejected; nothing was queued"}, status=400)
+            return
+        
+        try:
+            submitted = self.site.commands.submit_many(self.site.site_id, pending)
+        except CommandQueueFull as e:
+            self._send_json({"success": False, "message": str(e)}, status=503, headers={'Retry-After': '1'})
+            return
+        self._send_json({"success": True, "commands": submitted}, status=202)
     
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        path = site_for_request(urlparse(self.path).path)[1]
+        allowed = ROUTER.allowed_methods(path) or ('GET', 'POST')
+        self._send_bytes(b'', headers={
+            'Access-Control-Allow-Methods': ', '.join(allowed + ('OPTIONS',)),
+            'Access-Control-Allow-Headers': f'Content-Type, {SITE_HEADER}'
+        })
 
-def open_browser():
+def open_browser(port=8000):
     """Open the frontend in a web browser"""
     time.sleep(3)  # Wait for server to start
     try:
-        webbrowser.open('http://localhost:8000/frontend/index.html')
+        webbrowser.open(f'http://localhost:{port}/frontend/index.html')
         print("🌐 Frontend opened in browser")
     except Exception as e:
         print(f"⚠️ Could not open browser automatically: {e}")
-        print("Please open: http://localhost:8000/frontend/index.html")
+        print(f"Please open: http://localhost:{port}/frontend/index.html")
 
-def main():
+def parse_args(argv=None):
+    """Parse command line options, falling back to ENERGY_SERVER_* variables"""
+    parser = argparse.ArgumentParser(description="AI Energy Optimizer - Simple Server")
+    parser.add_argument('--mode', choices=SERVER_MODES,
+                        default=os.environ.get('ENERGY_SERVER_MODE', DEFAULT_MODE),
+                        help="serving engine (default: %(default)s)")
+    parser.add_argument('--host', default=os.environ.get('ENERGY_SERVER_HOST', ''))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('ENERGY_SERVER_PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('ENERGY_SERVER_WORKERS', 0)),
+                        help="worker processes (prefork), shard processes (sharded) or threads (asyncio); "
+                             "0 picks from CPU count")
+    parser.add_argument('--db', default=os.environ.get('ENERGY_DB_PATH', DEFAULT_DB_PATH),
+                        help="SQLite database file (default: %(default)s)")
+    parser.add_argument('--no-db', action='store_true', help="keep all state in memory")
+    parser.add_argument('--no-browser', action='store_true', help="do not open the dashboard")
+    parser.add_argument('--no-access-log', action='store_true',
+                        help="skip per-request access log lines (metrics are still kept)")
+    admission = parser.add_argument_group('admission control')
+    admission.add_argument('--max-concurrent', type=int,
+                           default=int(os.environ.get('ENERGY_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT)),
+                           help="requests running at once per process (default: %(default)s)")
+    admission.add_argument('--max-queue', type=int,
+                           default=int(os.environ.get('ENERGY_MAX_QUEUE', DEFAULT_MAX_QUEUE)),
+                           help="requests waiting for a slot before 503s (default: %(default)s)")
+    admission.add_argument('--queue-timeout', type=float,
+                           default=float(os.environ.get('ENERGY_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT)),
+                           help="seconds a request may wait for a slot (default: %(default)s)")
+    admission.add_argument('--route-limit', action='append', default=[], metavar='ROUTE=N',
+                           help="concurrent requests for one route pattern, e.g. /optimize=8")
+    admission.add_argument('--max-body-bytes', type=int,
+                           default=int(os.environ.get('ENERGY_MAX_BODY_BYTES', DEFAULT_MAX_BODY_BYTES)),
+                           help="largest request body for routes without their own limit")
+    admission.add_argument('--read-timeout', type=float,
+                           default=float(os.environ.get('ENERGY_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+                           help="seconds a socket read may block inside a request")
+    admission.add_argument('--idle-timeout', type=float,
+                           default=float(os.environ.get('ENERGY_IDLE_TIMEOUT', KEEPALIVE_TIMEOUT)),
+                           help="seconds an idle keep-alive connection is kept open")
+    args = parser.parse_args(argv)
+    try:
+        args.route_limits = {route: int(limit) for route, _, limit in
+                             (item.rpartition('=') for item in args.route_limit)}
+    except ValueError:
+        parser.error("--route-limit takes ROUTE=N, e.g. /optimize=8")
+    return args
+
+def main(argv=None):
     """Main function to start the server"""
+    args = parse_args(argv)
+    ACCESS_LOG.enabled = not args.no_access_log
+    ADMISSION.configure(max_concurrent=args.max_concurrent, max_queue=args.max_queue,
+                        queue_timeout=args.queue_timeout, route_limits=args.route_limits,
+                        read_timeout=args.read_timeout, max_body_bytes=args.max_body_bytes)
+    EnergyOptimizerHandler.timeout = args.idle_timeout
+    if hasattr(signal, 'SIGUSR2'):
+        # Installed before any fork, so prefork workers toggle their own profiler
+        signal.signal(signal.SIGUSR2, lambda signum, frame: print(
+            f"🔬 Profiling {'on' if PROFILER.toggle()['enabled'] else 'off'} (pid {os.getpid()})"))
+    
     print("=" * 60)
     print("🔋 AI Energy Optimizer - Simple Server")
     print("=" * 60)
     print()
     
     # Start browser thread
-    browser_thread = threading.Thread(target=open_browser)
-    browser_thread.daemon = True
-    browser_thread.start()
+    if not args.no_browser:
+        browser_thread = threading.Thread(target=open_browser, args=(args.port,))
+        browser_thread.daemon = True
+        browser_thread.start()
     
     # Start server
-    server_address = ('', 8000)
-    httpd = HTTPServer(server_address, EnergyOptimizerHandler)
+    server_address = (args.host, args.port)
+    # Runs per serving process: SQLite handles and threads must not cross a fork
+    def worker_init():
+        if not args.no_db:
+            started = time.perf_counter()
+            WARMING.set()
+            configure_storage(args.db, warm=False)
+            STARTUP['storage'] = time.perf_counter() - started
+            print(f"💾 Database: {args.db} ({len(DEVICES)} devices loaded)")
+            # Devices are served right away; models train while /health says warming
+            threading.Thread(target=warm_up, name='model-warmup', daemon=True).start()
+        SITES.start()
+    
+    started = time.perf_counter()
+    httpd = create_server(args.mode, server_address, EnergyOptimizerHandler,
+                          args.workers or None, worker_init)
+    STARTUP['bind'] = time.perf_counter() - started - STARTUP.get('storage', 0.0)
+    if hasattr(httpd, 'idle_timeout'):
+        httpd.idle_timeout = args.idle_timeout
+    print("⏱️ Startup: " + ", ".join(f"{phase} {seconds * 1000:.0f} ms"
+                                     for phase, seconds in STARTUP.items()))
     
-    print("🚀 Starting AI Energy Optimizer Server...")
-    print("📍 Server running on: http://localhost:8000")
-    print("🌐 Frontend: http://localhost:8000/frontend/index.html")
-    print("📊 API Health: http://localhost:8000/health")
+    print(f"🚀 Starting AI Energy Optimizer Server ({args.mode} mode)...")
+    print(f"📍 Server running on: http://localhost:{args.port}")
+    print(f"🌐 Frontend: http://localhost:{args.port}/frontend/index.html")
+    print(f"📊 API Health: http://localhost:{args.port}/health")
     print()
     print("Press Ctrl+C to stop the server")
     print()
@@ -368,7 +1085,10 @@ def main():
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user")
+    finally:
         httpd.server_close()
+        SITES.close()
+        ACCESS_LOG.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Synthetic fleet and telemetry simulator for the AI Energy Optimizer
+Seedable fleets of thousands to millions of devices with daily and weekly load curves,
+replayed against a running server at a target rate or saved as a columnar .npz file
+"""
+
+import argparse
+import http.client
+import json
+import math
+import queue
+import sys
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from bench_storage import percentile
+from telemetry import BINARY_MAGIC
+
+DEFAULT_DEVICES = 1000
+DEFAULT_HOURS = 24
+DEFAULT_STEP_SECONDS = 300
+DEFAULT_RATE = 20000
+DEFAULT_BATCH = 5000
+DEFAULT_CONNECTIONS = 4
+DEVICE_ID_PREFIX = 'sim_'
+ACTIVE_SHARE = 0.95
+HOURS_PER_WEEK = 168
+
+# Readings are generated for this many devices at a time to bound memory
+DEVICE_CHUNK = 65536
+
+# Per type: share of the fleet, rated power range in kW (sampled log-uniformly),
+# base load, (hour, width, weight) daily peaks and the weekend multiplier
+DEVICE_PROFILES = {
+    'thermostat': {"share": 0.15, "power": (0.5, 3.0), "base": 0.25,
+                   "peaks": ((7, 1.5, 0.6), (19, 2.5, 0.7)), "weekend": 1.05},
+    'lighting': {"share": 0.30, "power": (0.05, 1.0), "base": 0.05,
+                 "peaks": ((7, 1.0, 0.35), (20, 2.5, 0.95)), "weekend": 1.15},
+    'hvac': {"share": 0.15, "power": (2.0, 6.0), "base": 0.30,
+             "peaks": ((7, 1.5, 0.3), (15, 3.0, 0.7)), "weekend": 1.1},
+    'appliances': {"share": 0.25, "power": (0.3, 3.0), "base": 0.10,
+                   "peaks": ((12, 2.5, 0.3), (19, 2.0, 0.8)), "weekend": 1.3},
+    'other': {"share": 0.15, "power": (0.05, 0.5), "base": 0.60,
+              "peaks": ((18, 4.0, 0.2),), "weekend": 1.0},
+}
+DEVICE_TYPES = tuple(DEVICE_PROFILES)
+LOCATIONS = ('living_room', 'kitchen', 'basement', 'bedroom', 'office', 'garage', 'laundry')
+
+
+def weekly_profiles(profiles=DEVICE_PROFILES):
+    """``(types, 168)`` array of relative load per hour of the week, peak 1.0
+
+    Hour 0 is Monday midnight. Peaks wrap around midnight, so a late
+    evening peak carries into the early hours of the next day.
+    """
+    hours = np.arange(HOURS_PER_WEEK)
+    hour_of_day = hours % 24
+    weekend = hours >= 5 * 24
+    table = np.empty((len(profiles), HOURS_PER_WEEK))
+    for row, profile in enumerate(profiles.values()):
+        curve = np.full(HOURS_PER_WEEK, profile['base'])
+        for center, width, weight in profile['peaks']:
+            distance = np.abs(hour_of_day - center)
+            distance = np.minimum(distance, 24 - distance)
+            curve += weight * np.exp(-0.5 * (distance / width) ** 2)
+        curve[weekend] *= profile['weekend']
+        table[row] = curve / curve.max()
+    return table
+
+
+WEEKLY_PROFILES = weekly_profiles()
+
+
+def week_origin(timestamp):
+    """Unix time of the local Monday midnight at or before ``timestamp``"""
+    day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day - timedelta(days=day.weekday())).timestamp()
+
+
+def device_id(index, width=7):
+    return f"{DEVICE_ID_PREFIX}{index:0{width}d}"
+
+
+def _mix64(x):
+    """SplitMix64 finalizer over a uint64 array (wraps modulo 2**64)"""
+    x ^= x >> 30
+    x *= 0xBF58476D1CE4E5B9
+    x ^= x >> 27
+    x *= 0x94D049BB133111EB
+    x ^= x >> 31
+    return x
+
+
+def gaussian_noise(seed, timestamps, first, count):
+    """``(len(timestamps), count)`` float32 standard normals for devices ``[first, first + count)``
+
+    Counter based: each value is a hash of the seed, the device index and
+    the timestamp, so it does not depend on how a range is split into calls.
+    """
+    seed_key = _mix64(np.array([seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+    time_key = _mix64(np.asarray(timestamps, dtype=np.float64).view(np.uint64) ^ seed_key)
+    bits = time_key[:, None] + np.arange(first, first + count, dtype=np.uint64) * 0x9E3779B97F4A7C15
+    bits = _mix64(bits)
+    # Box-Muller on two 24-bit uniforms, the first kept away from zero
+    u1 = ((bits >> 40) + 1).astype(np.float32) / np.float32(1 << 24)
+    u2 = (bits & 0xFFFFFF).astype(np.float32) / np.float32(1 << 24)
+    return np.sqrt(-2 * np.log(u1)) * np.cos(np.float32(2 * np.pi) * u2)
+
+
+# ----------------------------------------------------------------------
+# Fleet
+# ----------------------------------------------------------------------
+
+class Fleet:
+    """A synthetic fleet held as columns, one array entry per device
+
+    Everything is drawn from ``seed``, so the same size and seed always
+    give the same devices, and ``power()`` gives the same reading for a
+    device and timestamp however the devices and times are batched. Device ids are ``sim_0000000`` style, zero padded
+    to a fixed width so readings can be encoded without a Python loop.
+    """
+
+    def __init__(self, size=DEFAULT_DEVICES, seed=0):
+        if size < 1:
+            raise ValueError("fleet size must be at least 1")
+        self.size = int(size)
+        self.seed = int(seed)
+        self.id_width = max(7, len(str(self.size - 1)))
+        rng = np.random.default_rng((self.seed, 0))
+
+        shares = np.array([profile['share'] for profile in DEVICE_PROFILES.values()])
+        self.device_type = rng.choice(len(DEVICE_TYPES), self.size, p=shares / shares.sum()).astype(np.int8)
+        self.location = rng.integers(0, len(LOCATIONS), self.size, dtype=np.int8)
+
+        low = np.log([profile['power'][0] for profile in DEVICE_PROFILES.values()])
+        high = np.log([profile['power'][1] for profile in DEVICE_PROFILES.values()])
+        position = rng.random(self.size)
+        self.rated_power = np.exp(low[self.device_type] + position * (high - low)[self.device_type]).astype(np.float32)
+
+        # Households keep different hours: shift each curve by up to 1.5h either way
+        self.phase = rng.uniform(-1.5, 1.5, self.size).astype(np.float32)
+        self.noise = rng.uniform(0.02, 0.15, self.size).astype(np.float32)
+        self.is_active = rng.random(self.size) < ACTIVE_SHARE
+
+    def device_ids(self, start=0, stop=None):
+        stop = self.size if stop is None else min(stop, self.size)
+        return [device_id(i, self.id_width) for i in range(start, stop)]
+
+    def devices(self, start=0, stop=None, timestamp=None):
+        """Device dicts for ``/devices/batch``, with the power at ``timestamp`` (now)"""
+        stop = self.size if stop is None else min(stop, self.size)
+        timestamp = time.time() if timestamp is None else timestamp
+        power = self.power(np.array([timestamp]), start, stop)[0]
+        types = self.device_type[start:stop]
+        locations = self.location[start:stop]
+        active = self.is_active[start:stop]
+        return [{
+            "device_id": device_id(start + i, self.id_width),
+            "device_name": f"{LOCATIONS[locations[i]].replace('_', ' ').title()} "
+                           f"{DEVICE_TYPES[types[i]].title()} {start + i}",
+            "device_type": DEVICE_TYPES[types[i]],
+            "current_power": round(float(power[i]), 3),
+            "location": LOCATIONS[locations[i]],
+            "is_active": bool(active[i])
+        } for i in range(stop - start)]
+
+    def power(self, timestamps, start=0, stop=None):
+        """``(len(timestamps), devices)`` float32 kW for devices ``[start, stop)``
+
+        Each device follows its type's weekly curve, shifted by its own
+        phase and scaled by its rated power, with multiplicative noise.
+        Inactive devices draw nothing.
+        """
+        stop = self.size if stop is None else min(stop, self.size)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        origins = np.fromiter((week_origin(t) for t in timestamps.tolist()), np.float64, len(timestamps))
+        hours = (timestamps - origins)[:, None] / 3600.0 + self.phase[start:stop]
+        hours %= HOURS_PER_WEEK
+        lower = hours.astype(np.int32)
+        fraction = (hours - lower).astype(np.float32)
+        types = self.device_type[start:stop]
+        profile = WEEKLY_PROFILES.astype(np.float32)
+        curve = (profile[types, lower] * (1 - fraction)
+                 + profile[types, (lower + 1) % HOURS_PER_WEEK] * fraction)
+
+        jitter = gaussian_noise(self.seed, timestamps, start, curve.shape[1]) * self.noise[start:stop]
+        power = self.rated_power[start:stop] * curve * (1 + jitter)
+        power *= self.is_active[start:stop]
+        return np.maximum(power, 0, out=power)
+
+    def iter_blocks(self, start_time, steps, step_seconds=DEFAULT_STEP_SECONDS, chunk=DEVICE_CHUNK):
+        """Yield ``(timestamps, first_device, power)`` blocks covering the whole fleet
+
+        Blocks are ordered by time step and then device, so replaying them in
+        order looks like a fleet reporting every ``step_seconds``.
+        """
+        timestamps = start_time + np.arange(steps, dtype=np.float64) * step_seconds
+        for step in range(steps):
+            for first in range(0, self.size, chunk):
+                yield timestamps[step:step + 1], first, self.power(timestamps[step:step + 1], first, first + chunk)
+
+    def iter_readings(self, start_time, steps, step_seconds=DEFAULT_STEP_SECONDS, chunk=DEFAULT_BATCH):
+        """``iter_blocks`` as lists of ``(device_id, timestamp, power)`` tuples for ``ingest_stream``"""
+        for timestamps, first, power in self.iter_blocks(start_time, steps, step_seconds, chunk):
+            timestamp = float(timestamps[0])
+            yield [(device_id, timestamp, value) for device_id, value
+                   in zip(self.device_ids(first, first + power.shape[1]), power[0].tolist())]
+
+    def encode_binary(self, timestamps, first, power):
+        """One block as a binary /telemetry/ingest body, built with NumPy rather than per reading"""
+        steps, count = power.shape
+        width = len(DEVICE_ID_PREFIX) + self.id_width
+        record = np.dtype([('length', 'u1'), ('device_id', f'S{width}'), ('timestamp', '<f8'), ('power', '<f4')])
+        records = np.empty((steps, count), dtype=record)
+        records['length'] = width
+        records['device_id'] = np.char.add(DEVICE_ID_PREFIX.encode(), np.char.zfill(
+            np.arange(first, first + count).astype(bytes), self.id_width))
+        records['timestamp'] = np.asarray(timestamps, dtype=np.float64)[:, None]
+        records['power'] = power
+        return BINARY_MAGIC + records.tobytes()
+
+
+# ----------------------------------------------------------------------
+# Columnar files
+# ----------------------------------------------------------------------
+
+def save_npz(path, fleet, start_time, steps, step_seconds=DEFAULT_STEP_SECONDS):
+    """Write the fleet and ``steps`` readings per device as compressed columns
+
+    ``power`` is a ``(steps, devices)`` float32 matrix; device ``i`` is row
+    ``i`` of the device columns. Returns the number of readings written.
+    The matrix is streamed into the archive one time step at a time, in
+    ``DEVICE_CHUNK`` blocks, so memory stays flat however large the fleet.
+    """
+    timestamps = start_time + np.arange(steps, dtype=np.float64) * step_seconds
+    columns = dict(
+        seed=np.int64(fleet.seed),
+        id_prefix=np.array(DEVICE_ID_PREFIX),
+        id_width=np.int64(fleet.id_width),
+        device_types=np.array(DEVICE_TYPES),
+        locations=np.array(LOCATIONS),
+        device_type=fleet.device_type,
+        location=fleet.location,
+        rated_power=fleet.rated_power,
+        is_active=fleet.is_active,
+        timestamps=timestamps
+    )
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for name, value in columns.items():
+            with archive.open(f'{name}.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asanyarray(value), allow_pickle=False)
+        with archive.open('power.npy', 'w', force_zip64=True) as member:
+            np.lib.format.write_array_header_1_0(member, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype('<f4')),
+                'fortran_order': False,
+                'shape': (steps, fleet.size)
+            })
+            for step in range(steps):
+                for first in range(0, fleet.size, DEVICE_CHUNK):
+                    block = fleet.power(timestamps[step:step + 1], first, first + DEVICE_CHUNK)
+                    member.write(block.astype('<f4', copy=False).tobytes())
+    return steps * fleet.size
+
+
+def load_npz(path):
+    """Columns written by ``save_npz`` as a dict of arrays"""
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def iter_npz_readings(columns, chunk=DEFAULT_BATCH):
+    """Yield lists of ``(device_id, timestamp, power)`` tuples from ``load_npz`` columns"""
+    prefix = str(columns['id_prefix'])
+    width = int(columns['id_width'])
+    count = columns['power'].shape[1]
+    ids = [f"{prefix}{i:0{width}d}" for i in range(count)]
+    for timestamp, row in zip(columns['timestamps'].tolist(), columns['power']):
+        values = row.tolist()
+        for first in range(0, count, chunk):
+            yield [(ids[i], timestamp, values[i]) for i in range(first, min(first + chunk, count))]
+
+
+# ----------------------------------------------------------------------
+# Replay
+# ----------------------------------------------------------------------
+
+def _request(conn, method, path, body, content_type, site):
+    headers = {'Content-Type': content_type}
+    if site:
+        headers['X-Site-Id'] = site
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def register_fleet(host, port, fleet, site=None, chunk=DEFAULT_BATCH):
+    """Add every device through ``/devices/batch``; returns the number added"""
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    added = 0
+    try:
+        for first in range(0, fleet.size, chunk):
+            operations = [{"op": "add", "device_id": device["device_id"], "device": device}
+                          for device in fleet.devices(first, first + chunk)]
+            status, body = _request(conn, 'POST', '/devices/batch', json.dumps({"operations": operations}),
+                                    'application/json', site)
+            if status != 200:
+                raise RuntimeError(f"/devices/batch returned {status}: {body[:200].decode('utf-8', 'replace')}")
+            added += len(operations)
+    finally:
+        conn.close()
+    return added
+
+
+def replay(host, port, fleet, rate=DEFAULT_RATE, start_time=None, steps=None, duration=None,
+           step_seconds=DEFAULT_STEP_SECONDS, batch=DEFAULT_BATCH, connections=DEFAULT_CONNECTIONS,
+           site=None, register=True):
+    """Send the fleet's readings to ``/telemetry/ingest`` at ``rate`` readings per second
+
+    Readings go out as binary batches of ``batch`` over ``connections``
+    keep-alive connections, starting at ``start_time`` (default: ``steps``
+    steps before now) and stopping after ``steps`` steps or ``duration``
+    seconds, whichever comes first. Returns a report dict.
+    """
+    if steps is None:
+        steps = max(1, math.ceil(duration * rate / fleet.size)) if duration else 1
+    if start_time is None:
+        start_time = time.time() - steps * step_seconds
+    registered = register_fleet(host, port, fleet, site) if register else 0
+
+    bodies = queue.Queue(maxsize=connections * 2)
+    lock = threading.Lock()
+    totals = {"requests": 0, "accepted": 0, "rejected": 0, "errors": 0}
+    statuses = {}
+    latencies = []
+
+    def send():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            while True:
+                body = bodies.get()
+                if body is None:
+                    return
+                started = time.perf_counter()
+                try:
+                    status, raw = _request(conn, 'POST', '/telemetry/ingest', body,
+                                           'application/octet-stream', site)
+                    result = json.loads(raw) if status == 200 else {}
+                except (OSError, http.client.HTTPException, ValueError):
+                    conn.close()
+                    status, result = 'error', {}
+                elapsed = time.perf_counter() - started
+                with lock:
+                    totals["requests"] += 1
+                    totals["accepted"] += result.get("accepted", 0)
+                    totals["rejected"] += result.get("rejected", 0)
+                    totals["errors"] += status != 200
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    latencies.append(elapsed)
+        finally:
+            conn.close()
+
+    senders = [threading.Thread(target=send, name=f'replay-{i}', daemon=True) for i in range(connections)]
+    for sender in senders:
+        sender.start()
+
+    sent = 0
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+    try:
+        for timestamps, first, power in fleet.iter_blocks(start_time, steps, step_seconds, chunk=batch):
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            # Pace against the schedule, not the previous send, so stalls are caught up
+            delay = started + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            bodies.put(fleet.encode_binary(timestamps, first, power))
+            sent += power.size
+    finally:
+        for _ in senders:
+            bodies.put(None)
+        for sender in senders:
+            sender.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "devices": fleet.size,
+        "registered": registered,
+        "readings_sent": sent,
+        **totals,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "target_rate": rate,
+        "achieved_rate": round(sent / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {name: round(percentile(latencies, q) * 1000, 2)
+                       for name, q in (("p50", 50), ("p95", 95), ("p99", 99))} if latencies else {}
+    }
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic fleet and replay or save its telemetry")
+    parser.add_argument('--devices', type=int, default=DEFAULT_DEVICES, help="Fleet size")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed; the same seed gives the same fleet")
+    parser.add_argument('--hours', type=float, default=DEFAULT_HOURS, help="Simulated hours of readings")
+    parser.add_argument('--step', type=int, default=DEFAULT_STEP_SECONDS,
+                        help="Seconds between readings of one device")
+    parser.add_argument('--start', type=float, help="Unix time of the first reading (default: --hours ago)")
+    parser.add_argument('--output', help="Write the fleet and readings to this .npz file")
+    parser.add_argument('--replay', metavar='HOST:PORT', help="Replay the readings against a running server")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="Target readings per second")
+    parser.add_argument('--duration', type=float, help="Stop replaying after this many seconds")
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH, help="Readings per ingest request")
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS, help="Concurrent connections")
+    parser.add_argument('--site', help="Replay into this site (sent as X-Site-Id)")
+    parser.add_argument('--no-register', action='store_true',
+                        help="Skip adding the devices through /devices/batch first")
+    args = parser.parse_args(argv)
+    if not args.output and not args.replay:
+        parser.error("nothing to do: give --output and/or --replay")
+    if args.replay and not args.replay.rpartition(':')[2].isdigit():
+        parser.error("--replay takes HOST:PORT")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    steps = max(1, int(args.hours * 3600 // args.step))
+    start_time = args.start if args.start is not None else time.time() - steps * args.step
+
+    started = time.perf_counter()
+    fleet = Fleet(args.devices, args.seed)
+    print(f"🏭 Generated {fleet.size:,} devices in {time.perf_counter() - started:.2f}s", file=sys.stderr)
+
+    if args.output:
+        started = time.perf_counter()
+        written = save_npz(args.output, fleet, start_time, steps, args.step)
+        print(f"💾 Wrote {written:,} readings to {args.output} in {time.perf_counter() - started:.2f}s",
+              file=sys.stderr)
+
+    if args.replay:
+        host, _, port = args.replay.rpartition(':')
+        report = replay(host or '127.0.0.1', int(port), fleet, rate=args.rate, start_time=start_time,
+                        steps=steps, duration=args.duration, step_seconds=args.step, batch=args.batch,
+                        connections=args.connections, site=args.site, register=not args.no_register)
+        print(json.dumps(report, indent=2))
+        return 1 if report["errors"] else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
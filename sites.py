@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Per-site state for the AI Energy Optimizer
+Device registry, telemetry, models, caches and storage partitioned by site, and the
+hash that assigns each site to one shard process
+"""
+
+import os
+import re
+import threading
+import zlib
+
+from analytics import RollupStore
+from anomaly import AnomalyDetector
+from commands import CommandDispatcher
+from device_registry import DeviceRegistry, iter_changes
+from predictor import RETRAIN_INTERVAL, EnergyPredictor
+from response_cache import ResponseCache
+from serialization import FragmentCache
+from storage import DEFAULT_DB_PATH, EnergyStore
+from stream_hub import StreamHub
+from telemetry import TelemetryBuffer
+
+DEFAULT_SITE = 'default'
+SITE_HEADER = 'X-Site-Id'
+SITE_PREFIX = '/sites/'
+MAX_SITES = 1024
+
+_SITE_ID = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]{0,63}\Z')
+
+
+class SiteLimitError(RuntimeError):
+    """Raised when a new site would exceed the directory's ``max_sites``"""
+
+
+def valid_site_id(site_id):
+    return bool(site_id) and _SITE_ID.match(site_id) is not None
+
+
+def split_site_path(path):
+    """``('home-42', '/devices/sample')`` for ``/sites/home-42/devices/sample``
+
+    Paths without the prefix come back as ``(None, path)``. The site id is
+    returned unvalidated so callers can reject it with a useful message.
+    """
+    if not path.startswith(SITE_PREFIX):
+        return None, path
+    site_id, slash, rest = path[len(SITE_PREFIX):].partition('/')
+    return site_id, slash + rest or '/'
+
+
+def site_for_request(path, header=None):
+    """``(site_id, path)`` for a request: URL prefix first, then the header, then the default"""
+    site_id, path = split_site_path(path)
+    if site_id is None:
+        site_id = header.strip() if header else DEFAULT_SITE
+    return site_id, path
+
+
+def shard_for(site_id, shards):
+    """Index of the shard that owns ``site_id``
+
+    CRC32 rather than ``hash()``: string hashing is randomized per process
+    and every process must agree on the owner.
+    """
+    return zlib.crc32(site_id.encode()) % shards if shards > 1 else 0
+
+
+def site_db_path(path, site_id):
+    """Database file for a site; the default site keeps ``path`` itself"""
+    if site_id == DEFAULT_SITE:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{site_id}{ext or '.db'}"
+
+
+class SiteState:
+    """Everything one site owns, wired together the way the server expects
+
+    Each site gets its own registry, telemetry buffer, forecasting models,
+    rollups, response cache, stream hub and database, so requests for
+    different sites never share a lock or a cache entry.
+    """
+
+    def __init__(self, site_id, devices=(), commands=None):
+        self.site_id = site_id
+        self.devices = DeviceRegistry(devices)
+
+        # Recent power readings per device, fed by /telemetry/ingest
+        self.telemetry = TelemetryBuffer()
+
+        # Forecasting models and usage rollups, updated on ingest
+        self.predictor = EnergyPredictor(self.devices)
+        self.telemetry.add_listener(self.predictor.observe)
+        self.rollups = RollupStore(self.devices)
+        self.telemetry.add_listener(self.rollups.observe)
+        self.anomalies = AnomalyDetector(self.devices)
+        self.telemetry.add_listener(self.anomalies.observe)
+
+        # Serialized responses, dropped as soon as what they depend on changes
+        self.cache = ResponseCache()
+        self.devices.add_listener(lambda event, devices: self.cache.invalidate('devices'))
+        self.telemetry.add_listener(lambda readings: self.cache.invalidate('telemetry'))
+        # Forecasts absorb telemetry when the models retrain, not on every batch
+        self.predictor.add_listener(lambda: self.cache.invalidate('models'))
+
+        # Live /stream subscribers for this site only
+        self.stream_hub = StreamHub()
+        self.devices.add_listener(lambda event, devices: self.stream_hub.publish(
+            'devices', {"event": event, "devices": devices}))
+        self.predictor.add_listener(lambda: self.stream_hub.publish('models', {"event": "retrained"}))
+        self.telemetry.add_listener(self.publish_telemetry)
+        self.anomalies.add_listener(lambda event, alert: self.stream_hub.publish(
+            'anomalies', {"event": event, "alert": alert}))
+
+        # Encoded device records reused by /devices/sample while they are unchanged
+        self.fragments = FragmentCache()
+
+        # Outbound device commands; a SiteDirectory shares one dispatcher between its sites
+        self.commands = commands if commands is not None else CommandDispatcher()
+        self.devices.add_listener(self._cancel_commands)
+
+        # Persistent store; stays None when the site runs purely in memory
+        self.store = None
+
+    def publish_telemetry(self, readings):
+        """Coalesce the newest reading per device for /stream subscribers"""
+        if self.stream_hub.subscriber_count:
+            self.stream_hub.merge('telemetry', {device_id: [timestamp, power]
+                                                for device_id, timestamp, power in readings})
+
+    def _cancel_commands(self, event, devices):
+        """Deleted devices are sent nothing more"""
+        for change, device in iter_changes(event, devices):
+            if change == 'deleted':
+                self.commands.cancel_device(self.site_id, device['device_id'])
+
+    def configure_storage(self, path=DEFAULT_DB_PATH, warm=True):
+        """Open the SQLite store, load saved devices and persist future changes
+
+        With ``warm=False`` the models and rollups are left for ``warm()``,
+        so devices can be served before the slower training finishes.
+        """
+        self.store = EnergyStore(path)
+        saved = self.store.load_devices()
+        if saved:
+            for device in self.devices.to_list():
+                self.devices.remove(device['device_id'])
+            for device in saved:
+                self.devices.add(device)
+        else:
+            # First run: seed the database with the site's starting devices
+            for device in self.devices.to_list():
+                self.store.save_device(device)
+        self.store.attach(self.devices)
+        if warm:
+            self.warm()
+        return self.store
+
+    def warm(self):
+        """Train the forecasting models and load the rollups from the database"""
+        if self.store is not None:
+            self.predictor.train_from_store(self.store)
+            self.rollups.load_from_store(self.store)
+
+    def export_pages(self, device_ids, start, end):
+        """Yield ``(device_id, rows)`` pages of readings in ``[start, end)``
+
+        Reads page by page from the database, or from the in-memory buffer when
+        the site runs without one.
+        """
+        if self.store is not None:
+            self.store.flush(timeout=5)  # Include readings still queued for the writer
+        for device_id in device_ids:
+            if self.store is not None:
+                pages = self.store.iter_reading_pages(device_id, start, end)
+            else:
+                pages = [[point for point in self.telemetry.series(device_id, since=start)
+                          if point[0] < end]]
+            for rows in pages:
+                if rows:
+                    yield device_id, rows
+
+    def close(self):
+        self.stream_hub.close()
+        if self.store is not None:
+            self.store.close()
+
+
+class SiteDirectory:
+    """Sites of one process, created on first request
+
+    The default site starts with ``default_devices``; every other site
+    starts empty and is filled through the device endpoints (or its own
+    database). Site ids are validated by the caller.
+    """
+
+    def __init__(self, default_devices=(), max_sites=MAX_SITES, retrain_interval=RETRAIN_INTERVAL):
+        self.max_sites = max_sites
+        self.retrain_interval = retrain_interval
+        self.db_path = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        # One dispatcher, so sites share its threads rather than each starting their own
+        self.commands = CommandDispatcher()
+        self.default = SiteState(DEFAULT_SITE, default_devices, self.commands)
+        self._sites = {DEFAULT_SITE: self.default}
+
+    def get(self, site_id, create=True):
+        """The site's state, created on first use; raises SiteLimitError when full"""
+        site = self._sites.get(site_id)
+        if site is not None or not create:
+            return site
+        with self._lock:
+            site = self._sites.get(site_id)
+            if site is None:
+                if len(self._sites) >= self.max_sites:
+                    raise SiteLimitError(f"site limit of {self.max_sites} reached")
+                site = SiteState(site_id, commands=self.commands)
+                if self.db_path is not None:
+                    site.configure_storage(site_db_path(self.db_path, site_id))
+                self._sites[site_id] = site
+        return site
+
+    def all(self):
+        return list(self._sites.values())
+
+    def __len__(self):
+        return len(self._sites)
+
+    def configure_storage(self, path=DEFAULT_DB_PATH, warm=True):
+        """Give every site, current and future, its own database next to ``path``"""
+        self.db_path = path
+        for site in self.all():
+            if site.store is None:
+                site.configure_storage(site_db_path(path, site.site_id), warm)
+        return self.default.store
+
+    def warm(self):
+        for site in self.all():
+            site.warm()
+
+    # ------------------------------------------------------------------
+    # Background retraining
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Retrain every site's models on one daemon thread, not one per site"""
+        self.commands.start()
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name='site-retrain', daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.retrain_interval):
+            for site in self.all():
+                try:
+                    site.predictor.refresh()
+                except Exception as e:
+                    print(f"⚠️ Prediction model retraining failed for site '{site.site_id}': {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        self.commands.close()
+        for site in self.all():
+            site.close()
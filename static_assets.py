@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Static asset serving for the AI Energy Optimizer
+Frontend files held in memory with precompressed gzip variants and validators
+"""
+
+import gzip
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+
+from response_cache import make_etag
+
+# Files up to this size live in memory; larger ones are streamed with sendfile
+MAX_MEMORY_FILE_BYTES = 1024 * 1024
+MIN_COMPRESS_BYTES = 512
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                      'image/svg+xml')
+HTML_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=3600'
+INDEX_FILE = 'index.html'
+
+
+class StaticAsset:
+    """One file's bytes (or location), gzip variant and response headers"""
+
+    __slots__ = ('file_path', 'content_type', 'size', 'mtime', 'body', 'gzip_body', 'etag',
+                 'gzip_etag', 'last_modified', 'cache_control', 'compressible')
+
+    def __init__(self, file_path, max_memory_bytes=MAX_MEMORY_FILE_BYTES):
+        stat = os.stat(file_path)
+        self.file_path = file_path
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self.compressible = content_type.startswith(COMPRESSIBLE_TYPES)
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.cache_control = HTML_CACHE_CONTROL if content_type.startswith('text/html') \
+            else ASSET_CACHE_CONTROL
+
+        self.body = None
+        self.gzip_body = None
+        self.gzip_etag = None
+        if self.size <= max_memory_bytes:
+            with open(file_path, 'rb') as f:
+                self.body = f.read()
+            self.etag = make_etag(self.body)
+            if self.compressible and self.size >= MIN_COMPRESS_BYTES:
+                # mtime=0 keeps the compressed bytes identical across restarts
+                compressed = gzip.compress(self.body, compresslevel=9, mtime=0)
+                if len(compressed) < self.size:
+                    self.gzip_body = compressed
+                    self.gzip_etag = self.etag[:-1] + '-gz"'
+        else:
+            self.etag = f'"{self.size:x}-{stat.st_mtime_ns:x}"'
+
+    @property
+    def in_memory(self):
+        return self.body is not None
+
+    def not_modified_since(self, if_modified_since):
+        """True when an If-Modified-Since value is at or after our mtime"""
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+        except (TypeError, ValueError):
+            return False
+
+
+class StaticAssets:
+    """Every file under ``root`` keyed by its path relative to ``root``
+
+    Files are read once at load time, so requests never touch the disk for
+    small files and lookups cannot escape ``root``: only paths found while
+    walking it are ever served.
+    """
+
+    def __init__(self, root, max_memory_bytes=MAX_MEMORY_FILE_BYTES):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self._assets = {}
+        self.load()
+
+    def load(self):
+        """(Re)read the directory tree; a missing directory serves nothing"""
+        assets = {}
+        for directory, _dirs, files in os.walk(self.root):
+            for name in files:
+                file_path = os.path.join(directory, name)
+                relative = os.path.relpath(file_path, self.root).replace(os.sep, '/')
+                assets[relative] = StaticAsset(file_path, self.max_memory_bytes)
+        self._assets = assets
+        return len(assets)
+
+    def get(self, relative_path):
+        """Asset for a request path below the mount point, or None"""
+        relative_path = relative_path.strip('/')
+        asset = self._assets.get(relative_path) if relative_path else None
+        if asset is None:
+            # Directories serve their index file
+            asset = self._assets.get(f"{relative_path}/{INDEX_FILE}".lstrip('/'))
+        return asset
+
+    def __len__(self):
+        return len(self._assets)
+
+    def memory_bytes(self):
+        return sum(len(asset.body or b'') + len(asset.gzip_body or b'')
+                   for asset in self._assets.values())
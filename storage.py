@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Persistent storage for the AI Energy Optimizer
+SQLite (WAL mode) backend for devices and time-stamped power readings
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_DB_PATH = 'energy_data.db'
+EXPORT_PAGE_SIZE = 5000
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS devices (
+        device_id TEXT PRIMARY KEY,
+        device_name TEXT NOT NULL,
+        device_type TEXT NOT NULL,
+        current_power REAL NOT NULL,
+        location TEXT NOT NULL,
+        is_active INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS readings (
+        device_id TEXT NOT NULL,
+        ts REAL NOT NULL,
+        power REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_readings_device_ts ON readings (device_id, ts)",
+)
+
+# Statements are kept as module constants so every connection's statement
+# cache hands back the same compiled statement on each call
+UPSERT_DEVICE = """INSERT INTO devices (device_id, device_name, device_type, current_power, location, is_active)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (device_id) DO UPDATE SET
+        device_name = excluded.device_name,
+        device_type = excluded.device_type,
+        current_power = excluded.current_power,
+        location = excluded.location,
+        is_active = excluded.is_active"""
+DELETE_DEVICE = "DELETE FROM devices WHERE device_id = ?"
+SELECT_DEVICES = """SELECT device_id, device_name, device_type, current_power, location, is_active
+    FROM devices ORDER BY rowid"""
+INSERT_READING = "INSERT INTO readings (device_id, ts, power) VALUES (?, ?, ?)"
+SELECT_READINGS = """SELECT ts, power FROM readings
+    WHERE device_id = ? AND ts >= ? AND ts < ? ORDER BY ts LIMIT ?"""
+# Keyset pagination: resume after the last (ts, rowid) of the previous page
+SELECT_READINGS_PAGE = """SELECT rowid, ts, power FROM readings
+    WHERE device_id = ? AND (ts, rowid) > (?, ?) AND ts < ? ORDER BY ts, rowid LIMIT ?"""
+SELECT_LATEST_READING = """SELECT ts, power FROM readings
+    WHERE device_id = ? ORDER BY ts DESC LIMIT 1"""
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+
+def _connect(path, read_only=False):
+    """Open a connection tuned for the store's access pattern"""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                           isolation_level=None, cached_statements=64)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+class ConnectionPool:
+    """Fixed set of read connections shared by the handler threads"""
+
+    def __init__(self, path, size=4):
+        self._connections = queue.LifoQueue()
+        self._all = []
+        for _ in range(size):
+            conn = _connect(path, read_only=True)
+            self._all.append(conn)
+            self._connections.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        for conn in self._all:
+            conn.close()
+
+
+class _Flush:
+    """Marker placed on the write queue by ``EnergyStore.flush``"""
+
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class EnergyStore:
+    """Devices and power readings persisted to SQLite
+
+    All writes go through one background writer thread. Readings are queued
+    and committed in groups of up to ``batch_size`` rows, or whatever has
+    arrived within ``flush_interval`` seconds, so high-rate telemetry costs
+    one transaction per group instead of one per reading. A group that fails
+    is written again row by row, and only the failing rows are dropped
+    (counted in ``rows_dropped``). Reads use a small
+    pool of read-only connections, which WAL mode lets run alongside the
+    writer.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, pool_size=4, batch_size=5000,
+                 flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._writer = _connect(path)
+        for statement in SCHEMA:
+            self._writer.execute(statement)
+        self._pool = ConnectionPool(path, pool_size)
+        self._queue = queue.Queue()
+        self._closed = False
+        self.readings_written = 0
+        self.rows_dropped = 0
+        self._thread = threading.Thread(target=self._write_loop, name='energy-store-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    # Writer thread
+    # ------------------------------------------------------------------
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            rows = 0 if isinstance(item, _Flush) else len(item[1])
+            # Group whatever else arrives before the deadline into one commit
+            while rows < self.batch_size and not isinstance(item, _Flush):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._commit(batch)
+                    return
+                batch.append(item)
+                if not isinstance(item, _Flush):
+                    rows += len(item[1])
+            self._commit(batch)
+
+    def _commit(self, batch):
+        flushes = [item for item in batch if isinstance(item, _Flush)]
+        writes = [item for item in batch if not isinstance(item, _Flush)]
+        try:
+            try:
+                self._write(writes)
+            except sqlite3.Error as e:
+                # One bad row must not cost the rest of the group
+                print(f"⚠️ Group commit of {len(writes)} operations failed ({e}); retrying row by row")
+                self._write(writes, per_row=True)
+        except sqlite3.Error as e:
+            print(f"❌ Failed to write {len(writes)} queued operations: {e}")
+        finally:
+            for flush in flushes:
+                flush.done.set()
+
+    def _write(self, writes, per_row=False):
+        """Apply ``(statement, rows)`` writes in one transaction
+
+        With ``per_row`` each row is its own statement and rows that fail are
+        skipped; the transaction only fails if SQLite abandons it.
+        """
+        conn = self._writer
+        written = 0
+        dropped = 0
+        try:
+            conn.execute("BEGIN")
+            for statement, rows in writes:
+                if per_row:
+                    applied = 0
+                    for row in rows:
+                        try:
+                            conn.execute(statement, row)
+                            applied += 1
+                        except sqlite3.Error:
+                            if not conn.in_transaction:
+                                raise
+                            dropped += 1
+                else:
+                    conn.executemany(statement, rows)
+                    applied = len(rows)
+                if statement == INSERT_READING:
+                    written += applied
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        self.readings_written += written
+        if dropped:
+            self.rows_dropped += dropped
+            print(f"⚠️ Dropped {dropped} rows that could not be written")
+
+    def _enqueue(self, statement, rows):
+        if self._closed:
+            raise RuntimeError("EnergyStore is closed")
+        self._queue.put((statement, rows))
+
+    # ------------------------------------------------------------------
+    # Writes (asynchronous, ordered)
+    # ------------------------------------------------------------------
+
+    def save_device(self, device):
+        """Insert or update a device"""
+        self._enqueue(UPSERT_DEVICE, [(
+            device['device_id'],
+            device['device_name'],
+            device['device_type'],
+            float(device['current_power']),
+            device['location'],
+            int(bool(device['is_active'])),
+        )])
+
+    def delete_device(self, device_id):
+        """Remove a device; its reading history is kept"""
+        self._enqueue(DELETE_DEVICE, [(device_id,)])
+
+    def record_readings(self, readings):
+        """Queue ``(device_id, timestamp, power)`` rows for the next group commit"""
+        rows = list(readings)
+        if rows:
+            self._enqueue(INSERT_READING, rows)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed"""
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def load_devices(self):
+        """All stored devices as dicts, in insertion order"""
+        with self._pool.connection() as conn:
+            rows = conn.execute(SELECT_DEVICES).fetchall()
+        return [{
+            "device_id": device_id,
+            "device_name": device_name,
+            "device_type": device_type,
+            "current_power": current_power,
+            "location": location,
+            "is_active": bool(is_active)
+        } for device_id, device_name, device_type, current_power, location, is_active in rows]
+
+    def readings(self, device_id, start=0.0, end=float('inf'), limit=-1):
+        """``(timestamp, power)`` rows for one device in ``[start, end)``"""
+        with self._pool.connection() as conn:
+            return conn.execute(SELECT_READINGS, (device_id, start, end, limit)).fetchall()
+
+    def iter_reading_pages(self, device_id, start=0.0, end=float('inf'), page_size=EXPORT_PAGE_SIZE):
+        """Yield lists of ``(timestamp, power)`` rows in ``[start, end)`` in time order
+
+        Each page is a separate short query, so an export of any length
+        holds at most one page in memory and never pins a read connection.
+        """
+        last_ts, last_rowid = start, -1
+        while True:
+            with self._pool.connection() as conn:
+                rows = conn.execute(SELECT_READINGS_PAGE,
+                                    (device_id, last_ts, last_rowid, end, page_size)).fetchall()
+            if rows:
+                last_rowid, last_ts, _ = rows[-1]
+                yield [(ts, power) for _, ts, power in rows]
+            if len(rows) < page_size:
+                return
+
+    def latest_reading(self, device_id):
+        """Most recent ``(timestamp, power)`` for a device, or None"""
+        with self._pool.connection() as conn:
+            return conn.execute(SELECT_LATEST_READING, (device_id,)).fetchone()
+
+    # ------------------------------------------------------------------
+    # Registry integration
+    # ------------------------------------------------------------------
+
+    def attach(self, registry):
+        """Persist every device change made through ``registry``"""
+        def on_change(event, devices):
+            if event == 'batch':
+                changes = [(change['event'], change['device']) for change in devices]
+            else:
+                changes = [(event, device) for device in devices]
+            for change, device in changes:
+                if change == 'deleted':
+                    self.delete_device(device['device_id'])
+                else:
+                    self.save_device(device)
+        registry.add_listener(on_change)
+
+    def close(self):
+        """Commit queued writes and close every connection"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        self._pool.close()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Live update streaming for the AI Energy Optimizer
+Fan-out hub pushing change events to Server-Sent Events and WebSocket subscribers
+"""
+
+import base64
+import hashlib
+import json
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+HEARTBEAT_INTERVAL = 15.0
+COALESCE_INTERVAL = 1.0
+MAX_BUFFER_BYTES = 1024 * 1024
+HISTORY_EVENTS = 256
+RECV_BYTES = 4096
+MAX_CLIENT_FRAME_BYTES = 64 * 1024
+SSE_RETRY_MS = 3000
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_TEXT, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x8, 0x9, 0xA
+
+SSE_HEARTBEAT = b': keepalive\n\n'
+
+
+def websocket_accept(key):
+    """Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key"""
+    digest = hashlib.sha1((key.strip() + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def websocket_frame(payload, opcode=WS_TEXT):
+    """Single unmasked server-to-client frame"""
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+
+def parse_websocket_frames(buffer):
+    """Split complete client frames off ``buffer``
+
+    Returns ``(frames, consumed)`` where frames are ``(opcode, payload)``
+    pairs. Raises ValueError for frames the hub refuses (unmasked or larger
+    than MAX_CLIENT_FRAME_BYTES).
+    """
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= 2:
+        first, second = buffer[offset], buffer[offset + 1]
+        if not second & 0x80:
+            raise ValueError("client frames must be masked")
+        size = second & 0x7F
+        header = 2
+        if size == 126:
+            if len(buffer) - offset < 4:
+                break
+            size = struct.unpack_from('!H', buffer, offset + 2)[0]
+            header = 4
+        elif size == 127:
+            if len(buffer) - offset < 10:
+                break
+            size = struct.unpack_from('!Q', buffer, offset + 2)[0]
+            header = 10
+        if size > MAX_CLIENT_FRAME_BYTES:
+            raise ValueError("client frame too large")
+        end = offset + header + 4 + size
+        if len(buffer) < end:
+            break
+        mask = buffer[offset + header:offset + header + 4]
+        data = buffer[offset + header + 4:end]
+        payload = bytes(b ^ mask[i & 3] for i, b in enumerate(data))
+        frames.append((first & 0x0F, payload))
+        offset = end
+    return frames, offset
+
+
+class _Subscriber:
+    """One detached client socket and its pending output"""
+
+    __slots__ = ('sock', 'websocket', 'topics', 'out', 'inbox', 'ready', 'registered', 'writing',
+                 'closed')
+
+    def __init__(self, sock, websocket, topics):
+        self.sock = sock
+        self.websocket = websocket
+        self.topics = topics
+        self.out = bytearray()
+        self.inbox = bytearray()
+        self.ready = False
+        self.registered = False
+        self.writing = False
+        self.closed = False
+
+    def wants(self, topic):
+        return self.topics is None or topic in self.topics
+
+
+class StreamHub:
+    """Pushes events to many long-lived connections from a single thread
+
+    Handlers hand over their socket with ``subscribe`` and return; one
+    selector thread then owns every subscriber socket. ``publish`` encodes
+    an event once per wire format and appends it to each interested
+    subscriber's buffer, so fan-out costs one serialization plus a buffer
+    append per subscriber. High-rate topics go through ``merge``, which
+    keeps only the newest value per key until the next coalescing tick.
+    Subscribers that fall more than ``max_buffer_bytes`` behind are dropped
+    rather than allowed to grow memory without bound.
+    """
+
+    def __init__(self, heartbeat_interval=HEARTBEAT_INTERVAL, coalesce_interval=COALESCE_INTERVAL,
+                 max_buffer_bytes=MAX_BUFFER_BYTES, history=HISTORY_EVENTS):
+        self.heartbeat_interval = heartbeat_interval
+        self.coalesce_interval = coalesce_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._new = []
+        self._dirty = set()
+        self._merged = {}
+        self._history = deque(maxlen=history)
+        self._last_id = 0
+        self._selector = None
+        self._thread = None
+        self._wake_reader = None
+        self._wake_writer = None
+        self._wake_pending = False
+        self._stopping = False
+        self.published = 0
+        self.dropped = 0
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _ensure_started(self):
+        """Start the writer thread on first use (after any fork)"""
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name='stream-hub', daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        """Nudge the writer thread (caller holds the lock)"""
+        if not self._wake_pending and self._wake_writer is not None:
+            self._wake_pending = True
+            try:
+                self._wake_writer.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    # ------------------------------------------------------------------
+    # Publishing
+    # ------------------------------------------------------------------
+
+    def _encode(self, event_id, topic, data):
+        """The event as an SSE message and as a WebSocket frame"""
+        body = json.dumps(data)
+        sse = f"id: {event_id}\nevent: {topic}\ndata: {body}\n\n".encode()
+        ws = websocket_frame(f'{{"id": {event_id}, "event": "{topic}", "data": {body}}}'.encode())
+        return sse, ws
+
+    def subscribe(self, sock, websocket=False, topics=None, last_event_id=None, snapshot=None):
+        """Take ownership of a connected socket whose response head was sent
+
+        A client resuming with ``last_event_id`` gets the events it missed
+        when they are still in the history; otherwise ``snapshot()`` (if
+        given) supplies a full ``snapshot`` event to apply later deltas to.
+        """
+        sock.setblocking(False)
+        subscriber = _Subscriber(sock, websocket, frozenset(topics) if topics else None)
+        with self._lock:
+            self._ensure_started()
+            # Registered before the snapshot is taken so no delta can fall
+            # between the two; deltas carry full records and re-apply safely
+            self._subscribers.add(subscriber)
+            self._new.append(subscriber)
+            missed = self._missed_since(last_event_id, subscriber)
+            current_id = self._last_id
+
+        if missed is None and snapshot is not None:
+            sse, ws = self._encode(current_id, 'snapshot', snapshot())
+            missed = [ws if websocket else sse]
+        preface = b'' if websocket else f"retry: {SSE_RETRY_MS}\n\n".encode()
+        with self._lock:
+            subscriber.out[:0] = preface + b''.join(missed or ())
+            subscriber.ready = True
+            self._dirty.add(subscriber)
+            self._wake()
+        return subscriber
+
+    def _missed_since(self, last_event_id, subscriber):
+        """Frames after ``last_event_id`` from history, or None if unavailable"""
+        try:
+            last_id = int(last_event_id)
+        except (TypeError, ValueError):
+            return None
+        if last_id == self._last_id:
+            return []
+        if not self._history or last_id < self._history[0][0] - 1 or last_id > self._last_id:
+            return None
+        return [ws if subscriber.websocket else sse
+                for event_id, topic, sse, ws in self._history
+                if event_id > last_id and subscriber.wants(topic)]
+
+    def publish(self, topic, data):
+        """Send ``data`` to every subscriber of ``topic``"""
+        with self._lock:
+            self._last_id += 1
+            if not self._subscribers:
+                # Nobody to replay to: a gap in history forces a snapshot on resume
+                self._history.clear()
+                return
+            event_id = self._last_id
+            sse, ws = self._encode(event_id, topic, data)
+            self._history.append((event_id, topic, sse, ws))
+            self.published += 1
+            for subscriber in self._subscribers:
+                if subscriber.closed or not subscriber.wants(topic):
+                    continue
+                subscriber.out += ws if subscriber.websocket else sse
+                if len(subscriber.out) > self.max_buffer_bytes:
+                    subscriber.closed = True
+                    self.dropped += 1
+                self._dirty.add(subscriber)
+            self._wake()
+
+    def merge(self, topic, updates):
+        """Coalesce ``updates`` (key -> newest value) into the next ``topic`` event"""
+        with self._lock:
+            if self._subscribers:
+                self._merged.setdefault(topic, {}).update(updates)
+
+    # ------------------------------------------------------------------
+    # Writer thread
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        now = time.monotonic()
+        next_heartbeat = now + self.heartbeat_interval
+        next_merge = now + self.coalesce_interval
+        while not self._stopping:
+            timeout = max(0.0, min(next_heartbeat, next_merge) - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_reader:
+                    try:
+                        while self._wake_reader.recv(RECV_BYTES):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                subscriber = key.data
+                if mask & selectors.EVENT_READ:
+                    self._read(subscriber)
+                if mask & selectors.EVENT_WRITE and not subscriber.closed:
+                    self._flush(subscriber)
+
+            now = time.monotonic()
+            if now >= next_merge:
+                next_merge = now + self.coalesce_interval
+                with self._lock:
+                    merged, self._merged = self._merged, {}
+                for topic, updates in merged.items():
+                    self.publish(topic, updates)
+            if now >= next_heartbeat:
+                next_heartbeat = now + self.heartbeat_interval
+                with self._lock:
+                    for subscriber in self._subscribers:
+                        subscriber.out += websocket_frame(b'', WS_PING) if subscriber.websocket \
+                            else SSE_HEARTBEAT
+                        self._dirty.add(subscriber)
+
+            with self._lock:
+                new, self._new = self._new, []
+                dirty, self._dirty = self._dirty, set()
+                self._wake_pending = False
+            for subscriber in new:
+                if not subscriber.closed:
+                    self._selector.register(subscriber.sock, selectors.EVENT_READ, subscriber)
+                    subscriber.registered = True
+            for subscriber in dirty:
+                if subscriber.closed:
+                    self._drop(subscriber)
+                else:
+                    self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        """Send as much buffered output as the socket accepts without blocking"""
+        if not subscriber.ready:
+            return  # Its snapshot is still being prepended
+        with self._lock:
+            try:
+                sent = subscriber.sock.send(subscriber.out) if subscriber.out else 0
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                subscriber.closed = True
+                sent = 0
+            del subscriber.out[:sent]
+            pending = bool(subscriber.out)
+        if subscriber.closed:
+            self._drop(subscriber)
+        elif subscriber.registered and pending != subscriber.writing:
+            subscriber.writing = pending
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+            self._selector.modify(subscriber.sock, events, subscriber)
+
+    def _read(self, subscriber):
+        """Handle client input: EOF closes; WebSocket control frames are answered"""
+        try:
+            data = subscriber.sock.recv(RECV_BYTES)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(subscriber)
+            return
+        if not subscriber.websocket:
+            return  # SSE clients have nothing to say
+        subscriber.inbox += data
+        try:
+            frames, consumed = parse_websocket_frames(subscriber.inbox)
+        except ValueError:
+            self._drop(subscriber)
+            return
+        del subscriber.inbox[:consumed]
+        for opcode, payload in frames:
+            if opcode == WS_CLOSE:
+                try:
+                    subscriber.sock.send(websocket_frame(payload[:2], WS_CLOSE))
+                except OSError:
+                    pass
+                self._drop(subscriber)
+                return
+            if opcode == WS_PING:
+                with self._lock:
+                    subscriber.out += websocket_frame(payload, WS_PONG)
+                self._flush(subscriber)
+
+    def _drop(self, subscriber):
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.discard(subscriber)
+            subscriber.closed = True
+        if subscriber.registered:
+            self._selector.unregister(subscriber.sock)
+            subscriber.registered = False
+        try:
+            subscriber.sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """Disconnect every subscriber and stop the writer thread"""
+        with self._lock:
+            self._stopping = True
+            self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for subscriber in subscribers:
+            try:
+                subscriber.sock.close()
+            except OSError:
+                pass
+        if self._selector is not None:
+            self._selector.close()
+            self._wake_reader.close()
+            self._wake_writer.close()
+            self._thread = None
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "events_published": self.published,
+            "last_event_id": self._last_id,
+            "dropped_slow_subscribers": self.dropped
+        }
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Telemetry ingest and export for the AI Energy Optimizer
+Streaming parsers for NDJSON, CSV and binary reading batches, the
+in-memory time-series buffer they feed and streaming export encoders
+"""
+
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+MAX_LINE_BYTES = 64 * 1024
+READ_BLOCK_BYTES = 64 * 1024
+INGEST_BATCH_SIZE = 2000
+MAX_REPORTED_ERRORS = 20
+_HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+# Readings stamped further than this past the server's clock are rejected
+MAX_CLOCK_SKEW = 300.0
+
+# Binary batch layout: magic, then records of
+#   u8 id length | device id (utf-8) | f64 timestamp | f32 power  (little-endian)
+BINARY_MAGIC = b'ETLM\x01'
+BINARY_VALUES = struct.Struct('<df')
+
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+GZIP_LEVEL = 6
+
+FORMAT_CONTENT_TYPES = {
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'application/json': 'ndjson',
+    'text/csv': 'csv',
+    'application/octet-stream': 'binary',
+    'application/x-energy-telemetry': 'binary',
+}
+
+
+def parse_content_length(value):
+    """Body length from a Content-Length value; anything but plain digits raises ValueError"""
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError("Invalid Content-Length")
+    return int(value)
+
+
+class BodyReader:
+    """Reads at most ``length`` bytes of a request body from ``rfile``"""
+
+    def __init__(self, rfile, length):
+        self._raw = rfile
+        self._remaining = length
+
+    def read(self, n=-1):
+        if self._remaining <= 0:
+            return b''
+        if n < 0 or n > self._remaining:
+            n = self._remaining
+        data = self._raw.read(n)
+        self._remaining -= len(data)
+        if len(data) < n:
+            self._remaining = 0
+        return data
+
+    def readline(self, limit=-1):
+        if self._remaining <= 0:
+            return b''
+        if limit < 0 or limit > self._remaining:
+            limit = self._remaining
+        line = self._raw.readline(limit)
+        self._remaining -= len(line)
+        if not line:
+            self._remaining = 0
+        return line
+
+
+class ChunkedReader:
+    """Decodes an HTTP/1.1 ``Transfer-Encoding: chunked`` body as it is read"""
+
+    def __init__(self, rfile):
+        self._raw = rfile
+        self._remaining = 0
+        self._eof = False
+
+    def _next_chunk(self):
+        line = self._raw.readline(MAX_LINE_BYTES)
+        if not line.endswith(b'\n'):
+            raise ValueError("Truncated chunk header")
+        digits = line.split(b';', 1)[0].strip()
+        if not digits or not _HEX_DIGITS.issuperset(digits):
+            raise ValueError(f"Invalid chunk size {line[:32]!r}")
+        size = int(digits, 16)
+        if size == 0:
+            # Skip optional trailers up to the terminating blank line
+            while True:
+                trailer = self._raw.readline(MAX_LINE_BYTES)
+                if trailer in (b'\r\n', b'\n', b''):
+                    break
+            self._eof = True
+        self._remaining = size
+
+    def _consume(self, data):
+        self._remaining -= len(data)
+        if self._remaining == 0 and self._raw.read(2) != b'\r\n':
+            raise ValueError("Chunk data not followed by CRLF")
+
+    def read(self, n=-1):
+        parts = []
+        while not self._eof and n != 0:
+            if self._remaining == 0:
+                self._next_chunk()
+                continue
+            take = self._remaining if n < 0 else min(n, self._remaining)
+            data = self._raw.read(take)
+            if len(data) < take:
+                raise ValueError("Truncated chunk data")
+            self._consume(data)
+            parts.append(data)
+            if n > 0:
+                n -= take
+        return b''.join(parts)
+
+    def readline(self, limit=-1):
+        parts = []
+        total = 0
+        while not self._eof:
+            if self._remaining == 0:
+                self._next_chunk()
+                continue
+            take = self._remaining if limit < 0 else min(self._remaining, limit - total)
+            line = self._raw.readline(take)
+            if not line:
+                raise ValueError("Truncated chunk data")
+            self._consume(line)
+            parts.append(line)
+            total += len(line)
+            if line.endswith(b'\n') or (limit >= 0 and total >= limit):
+                break
+        return b''.join(parts)
+
+
+class Rejected:
+    """A record that could not be parsed or applied"""
+
+    __slots__ = ('record', 'reason')
+
+    def __init__(self, record, reason):
+        self.record = record
+        self.reason = reason
+
+    def to_dict(self):
+        return {"record": self.record, "reason": self.reason}
+
+
+def parse_timestamp(value, default):
+    """Epoch seconds from a number or ISO-8601 string"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+
+def _finite(device_id, timestamp, power):
+    """The reading as a tuple; NaN or infinite values would poison the rollups and the store"""
+    if not (math.isfinite(timestamp) and math.isfinite(power)):
+        raise ValueError("power and timestamp must be finite numbers")
+    return device_id, timestamp, power
+
+
+def _iter_lines(stream):
+    number = 0
+    while True:
+        line = stream.readline(MAX_LINE_BYTES)
+        if not line:
+            return
+        number += 1
+        if len(line) >= MAX_LINE_BYTES and not line.endswith(b'\n'):
+            # Discard the rest of an oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(MAX_LINE_BYTES)
+            yield number, None
+            continue
+        line = line.strip()
+        if line:
+            yield number, line
+
+
+def iter_ndjson(stream, now=None):
+    """Yield readings (or Rejected) from newline-delimited JSON objects"""
+    now = now or time.time()
+    for number, line in _iter_lines(stream):
+        if line is None:
+            yield Rejected(number, "line too long")
+            continue
+        try:
+            item = json.loads(line)
+            power = item.get('power', item.get('current_power'))
+            yield _finite(str(item['device_id']), parse_timestamp(item.get('timestamp'), now),
+                          float(power))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            yield Rejected(number, f"invalid record: {e}")
+
+
+def iter_csv(stream, now=None):
+    """Yield readings (or Rejected) from ``device_id,timestamp,power`` lines"""
+    now = now or time.time()
+    for number, line in _iter_lines(stream):
+        if line is None:
+            yield Rejected(number, "line too long")
+            continue
+        fields = line.decode('utf-8', 'replace').split(',')
+        if number == 1 and fields[0].strip() == 'device_id':
+            continue
+        try:
+            if len(fields) == 2:
+                device_id, timestamp, power = fields[0], None, fields[1]
+            else:
+                device_id, timestamp, power = fields[0], fields[1], fields[2]
+            timestamp = timestamp.strip() if timestamp else None
+            if timestamp:
+                try:
+                    timestamp = float(timestamp)
+                except ValueError:
+                    pass
+            yield _finite(device_id.strip(), parse_timestamp(timestamp or None, now), float(power))
+        except (ValueError, IndexError) as e:
+            yield Rejected(number, f"invalid record: {e}")
+
+
+def iter_binary(stream, now=None):
+    """Yield readings from the compact binary batch format"""
+    header = stream.read(len(BINARY_MAGIC))
+    if header != BINARY_MAGIC:
+        # Drain the body so the connection stays usable
+        while stream.read(READ_BLOCK_BYTES):
+            pass
+        yield Rejected(0, "missing binary batch header")
+        return
+
+    unpack_values = BINARY_VALUES.unpack_from
+    value_size = BINARY_VALUES.size
+    buffer = b''
+    offset = 0
+    number = 0
+    while True:
+        block = stream.read(READ_BLOCK_BYTES)
+        if block:
+            buffer = buffer[offset:] + block
+            offset = 0
+        end = len(buffer)
+        while offset < end:
+            id_length = buffer[offset]
+            record_end = offset + 1 + id_length + value_size
+            if record_end > end:
+                break
+            number += 1
+            try:
+                device_id = buffer[offset + 1:offset + 1 + id_length].decode('utf-8')
+            except UnicodeDecodeError:
+                yield Rejected(number, "device id is not valid UTF-8")
+            else:
+                timestamp, power = unpack_values(buffer, offset + 1 + id_length)
+                if math.isfinite(timestamp) and math.isfinite(power):
+                    yield (device_id, timestamp, power)
+                else:
+                    yield Rejected(number, "power and timestamp must be finite numbers")
+            offset = record_end
+        if not block:
+            if offset < end:
+                yield Rejected(number + 1, "truncated record")
+            return
+
+
+def encode_binary(readings):
+    """Encode ``(device_id, timestamp, power)`` tuples in the binary batch format"""
+    parts = [BINARY_MAGIC]
+    pack_values = BINARY_VALUES.pack
+    for device_id, timestamp, power in readings:
+        raw_id = device_id.encode('utf-8')
+        parts.append(bytes((len(raw_id),)) + raw_id + pack_values(timestamp, power))
+    return b''.join(parts)
+
+
+PARSERS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+    'binary': iter_binary,
+}
+
+
+def format_for_content_type(content_type):
+    """Map a Content-Type header to a parser name (NDJSON when unknown)"""
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    return FORMAT_CONTENT_TYPES.get(media_type, 'ndjson')
+
+
+def iter_export(pages, export_format='ndjson'):
+    """Encode ``(device_id, [(timestamp, power), ...])`` pages as byte chunks
+
+    One chunk per page, in the same NDJSON/CSV layout /telemetry/ingest
+    accepts, so exported data can be replayed as is.
+    """
+    if export_format not in EXPORT_CONTENT_TYPES:
+        raise ValueError(f"unsupported export format '{export_format}'")
+    if export_format == 'csv':
+        yield b'device_id,timestamp,power\n'
+        for device_id, rows in pages:
+            yield ''.join(f'{device_id},{ts!r},{power!r}\n' for ts, power in rows).encode()
+    else:
+        for device_id, rows in pages:
+            prefix = '{"device_id": ' + json.dumps(device_id) + ', "timestamp": '
+            yield ''.join(f'{prefix}{ts!r}, "power": {power!r}}}\n' for ts, power in rows).encode()
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compress a stream of byte chunks into one gzip member as they are produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip(accept_encoding):
+    """True when an Accept-Encoding header value allows gzip"""
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding.strip().lower() in ('gzip', 'x-gzip', '*'):
+            q = params.strip()
+            try:
+                return float(q[2:]) > 0 if q.startswith('q=') else True
+            except ValueError:
+                return False
+    return False
+
+
+class TelemetryBuffer:
+    """Bounded per-device history of recent ``(timestamp, power)`` readings"""
+
+    def __init__(self, capacity=10080):
+        self.capacity = capacity
+        self._series = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.total_readings = 0
+
+    def add_listener(self, callback):
+        """Call ``callback(readings)`` after every appended batch"""
+        self._listeners.append(callback)
+
+    def append_batch(self, readings):
+        """Append ``(device_id, timestamp, power)`` readings"""
+        series = self._series
+        capacity = self.capacity
+        with self._lock:
+            for device_id, timestamp, power in readings:
+                history = series.get(device_id)
+                if history is None:
+                    history = series[device_id] = deque(maxlen=capacity)
+                history.append((timestamp, power))
+            self.total_readings += len(readings)
+        for callback in self._listeners:
+            callback(readings)
+
+    def series(self, device_id, since=None):
+        """Buffered readings for one device, optionally only those after ``since``"""
+        with self._lock:
+            history = list(self._series.get(device_id, ()))
+        if since is not None:
+            history = [point for point in history if point[0] >= since]
+        return history
+
+    def device_ids(self):
+        with self._lock:
+            return list(self._series)
+
+    def discard(self, device_id):
+        with self._lock:
+            self._series.pop(device_id, None)
+
+
+def ingest_stream(records, registry, buffer, store=None, batch_size=INGEST_BATCH_SIZE):
+    """Apply parsed records in batches and return accepted/rejected counts
+
+    Valid readings update ``current_power`` in the registry, are appended to
+    the time-series buffer and, when a store is configured, queued for the
+    next grouped commit. Records for unknown devices, and records stamped
+    more than ``MAX_CLOCK_SKEW`` seconds ahead of the clock, are rejected.
+    """
+    accepted = 0
+    rejected = 0
+    batches = 0
+    errors = []
+    batch = []
+
+    def apply(batch):
+        horizon = time.time() + MAX_CLOCK_SKEW
+        future = [r[0] for r in batch if r[1] > horizon]
+        if future:
+            batch = [r for r in batch if r[1] <= horizon]
+        unknown = registry.update_powers((r[0], r[2]) for r in batch)
+        if unknown:
+            missing = set(unknown)
+            batch = [r for r in batch if r[0] not in missing]
+        if batch:
+            buffer.append_batch(batch)
+            if store is not None:
+                store.record_readings(batch)
+        return batch, unknown, future
+
+    def flush():
+        nonlocal accepted, rejected, batches
+        applied, unknown, future = apply(batch)
+        accepted += len(applied)
+        rejected += len(unknown) + len(future)
+        batches += 1
+        for device_id in unknown[:max(0, MAX_REPORTED_ERRORS - len(errors))]:
+            errors.append({"record": device_id, "reason": "unknown device"})
+        for device_id in future[:max(0, MAX_REPORTED_ERRORS - len(errors))]:
+            errors.append({"record": device_id, "reason": "timestamp is in the future"})
+
+    for item in records:
+        if type(item) is tuple:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+        else:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(item.to_dict())
+    if batch:
+        flush()
+
+    return {
+        "accepted": accepted,
+        "rejected": rejected,
+        "batches": batches,
+        "errors": errors
+    }
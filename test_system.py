@@ -7,127 +7,1635 @@ Tests core functionality without external dependencies
 import sys
 import os
 import json
-from datetime import datetime, timedelta
+import http.client
+import tempfile
+import threading
+import time
+from datetime import datetime
 import random
 
 def test_energy_prediction():
-    """Test energy prediction logic"""
+    """Test the /predictions forecast served by the real handler"""
     print("🧪 Testing Energy Prediction...")
     
-    # Simulate prediction data
-    predictions = []
-    current_time = datetime.now()
-    
-    for i in range(24):
-        future_time = current_time + timedelta(hours=i)
-        predicted_usage = 2.5 + random.uniform(-0.5, 0.5)
-        confidence = 0.85 + random.uniform(-0.05, 0.05)
-        
-        predictions.append({
-            'timestamp': future_time.isoformat(),
-            'predicted_usage': round(predicted_usage, 2),
-            'confidence': round(confidence, 2)
-        })
-    
-    total_usage = sum(p['predicted_usage'] for p in predictions)
-    avg_confidence = sum(p['confidence'] for p in predictions) / len(predictions)
+    httpd, port = start_test_server()
+    try:
+        status, result = get_json(port, '/predictions?hours=24')
+    finally:
+        stop_test_server(httpd)
     
-    print(f"✅ Generated {len(predictions)} predictions")
-    print(f"✅ Total predicted usage: {total_usage:.2f} kWh")
-    print(f"✅ Average confidence: {avg_confidence:.2f}")
+    predictions = result['predictions']
+    assert status == 200 and len(predictions) == 24
+    assert all(set(p) == {'timestamp', 'predicted_usage', 'confidence'} for p in predictions)
+    assert all(0.0 <= p['confidence'] <= 1.0 and p['predicted_usage'] >= 0 for p in predictions)
+    timestamps = [datetime.fromisoformat(p['timestamp']) for p in predictions]
+    assert timestamps == sorted(timestamps)
+    assert abs(result['total_predicted_usage'] - sum(p['predicted_usage'] for p in predictions)) < 0.05
     
-    return predictions
+    print(f"✅ {len(predictions)} hourly predictions, {result['total_predicted_usage']:.2f} kWh total")
 
 def test_device_optimization():
-    """Test device optimization logic"""
+    """Test /optimize recommendations for the demo fleet"""
     print("\n🧪 Testing Device Optimization...")
     
-    # Sample devices
-    devices = [
-        {'device_id': 'thermostat_001', 'device_type': 'thermostat', 'current_power': 2.5, 'location': 'living_room', 'is_active': True},
-        {'device_id': 'lighting_001', 'device_type': 'lighting', 'current_power': 0.8, 'location': 'kitchen', 'is_active': True},
-        {'device_id': 'hvac_001', 'device_type': 'hvac', 'current_power': 4.2, 'location': 'basement', 'is_active': True},
-        {'device_id': 'appliance_001', 'device_type': 'appliances', 'current_power': 1.5, 'location': 'kitchen', 'is_active': True}
-    ]
-    
-    # Optimization strategies
-    strategies = {
-        'thermostat': ['lower_temp', 'schedule_optimization', 'eco_mode'],
-        'lighting': ['dim_lights', 'motion_sensors', 'led_upgrade'],
-        'hvac': ['zone_control', 'maintenance', 'smart_scheduling'],
-        'appliances': ['delay_operation', 'eco_mode', 'power_management']
-    }
-    
-    recommendations = []
-    current_usage = 3.0
-    
-    for device in devices:
-        if device['is_active']:
-            device_type = device['device_type']
-            if device_type in strategies:
-                for action in strategies[device_type]:
-                    savings = random.uniform(0.1, 0.5)
-                    recommendations.append({
-                        'device_id': device['device_id'],
-                        'recommended_action': action,
-                        'expected_savings': round(savings, 2),
-                        'priority': 'high' if savings > 0.3 else 'medium'
-                    })
-    
-    total_savings = sum(r['expected_savings'] for r in recommendations)
-    savings_percentage = (total_savings / current_usage) * 100
+    httpd, port = start_test_server()
+    try:
+        status, result = post_raw(port, '/optimize', json.dumps({'top_k': 8}), 'application/json')
+        _, listing = get_json(port, '/devices/sample?is_active=true&fields=device_id')
+    finally:
+        stop_test_server(httpd)
     
-    print(f"✅ Generated {len(recommendations)} optimization recommendations")
-    print(f"✅ Total potential savings: {total_savings:.2f} kWh")
-    print(f"✅ Savings percentage: {savings_percentage:.1f}%")
+    recommendations = result['recommendations']
+    active = {d['device_id'] for d in listing['devices']}
+    assert status == 200 and 0 < len(recommendations) <= 8
+    assert all(r['device_id'] in active for r in recommendations)
+    assert all(r['priority'] in ('high', 'medium', 'low') for r in recommendations)
+    assert abs(result['total_potential_savings'] - sum(r['expected_savings'] for r in recommendations)) < 0.05
     
-    return recommendations
+    print(f"✅ {len(recommendations)} recommendations, {result['savings_percentage']}% potential savings")
 
 def test_analytics():
-    """Test analytics generation"""
+    """Test /analytics/summary after ingesting an hour of readings"""
     print("\n🧪 Testing Analytics...")
     
-    # Generate sample analytics
-    analytics = {
-        'average_daily_usage': round(random.uniform(50, 80), 2),
-        'peak_usage': round(random.uniform(4, 6), 2),
-        'min_usage': round(random.uniform(1, 2), 2),
-        'peak_hours_count': random.randint(4, 8),
-        'efficiency_score': round(random.uniform(70, 90), 1),
-        'prediction_confidence': round(random.uniform(0.8, 0.95), 2)
-    }
+    now = time.time()
+    # A device of its own keeps these readings out of the demo devices' history
+    lines = '\n'.join(f"analytics_probe,{now - 3600 + minute * 60},{2.0 + minute % 3}"
+                      for minute in range(60))
+    probe = {"op": "add", "device_id": "analytics_probe", "device": {"device_type": "probe"}}
+    httpd, port = start_test_server()
+    try:
+        post_raw(port, '/devices/batch', json.dumps({"operations": [probe]}), 'application/json')
+        assert post_raw(port, '/telemetry/ingest', lines, 'text/csv')[0] == 200
+        status, analytics = get_json(port, f'/analytics/summary?start={now - 7200}&device_type=probe')
+        post_raw(port, '/devices/batch', json.dumps({"operations": [
+            {"op": "delete", "device_id": "analytics_probe"}]}), 'application/json')
+    finally:
+        stop_test_server(httpd)
     
-    print(f"✅ Daily average usage: {analytics['average_daily_usage']} kWh")
-    print(f"✅ Efficiency score: {analytics['efficiency_score']}%")
-    print(f"✅ Prediction confidence: {analytics['prediction_confidence']}")
+    assert status == 200 and analytics['hours_with_data'] >= 1
+    assert analytics['peak_usage'] >= analytics['min_usage'] > 0
+    assert 0 < analytics['efficiency_score'] <= 100
+    assert 0.0 <= analytics['prediction_confidence'] <= 1.0
     
-    return analytics
+    print(f"✅ Efficiency score {analytics['efficiency_score']}% over {analytics['hours_with_data']} hours")
+
+def fetch_dashboard_data(port):
+    """The responses the dashboard combines on load"""
+    return {
+        'predictions': get_json(port, '/predictions?hours=24')[1]['predictions'],
+        'optimization': post_raw(port, '/optimize', '{}', 'application/json')[1],
+        'analytics': get_json(port, '/analytics/summary')[1],
+        'devices': get_json(port, '/devices/sample')[1]['devices']
+    }
 
 def test_frontend_data():
-    """Test frontend data structure"""
+    """Test that every response the dashboard reads has the fields it uses"""
     print("\n🧪 Testing Frontend Data Structure...")
     
-    # Simulate API response data
-    api_data = {
-        'predictions': test_energy_prediction(),
-        'optimization': {
-            'recommendations': test_device_optimization(),
-            'total_potential_savings': round(random.uniform(2, 5), 2),
-            'savings_percentage': round(random.uniform(30, 50), 1),
-            'current_usage': round(random.uniform(2.5, 4.0), 2)
-        },
-        'analytics': test_analytics(),
-        'devices': {
-            'connected_devices': 4,
-            'total_power': round(random.uniform(8, 12), 2),
-            'active_devices': 4
-        }
-    }
+    httpd, port = start_test_server()
+    try:
+        api_data = fetch_dashboard_data(port)
+    finally:
+        stop_test_server(httpd)
+    
+    assert {'recommendations', 'total_potential_savings', 'savings_percentage',
+            'current_usage'} <= set(api_data['optimization'])
+    assert {'average_daily_usage', 'peak_usage', 'efficiency_score',
+            'prediction_confidence'} <= set(api_data['analytics'])
+    assert all({'device_id', 'device_name', 'device_type', 'current_power', 'location',
+                'is_active'} == set(d) for d in api_data['devices'])
+    
+    print("✅ Dashboard responses carry every field the frontend reads")
+
+def start_test_server(mode='threaded', workers=None):
+    """Boot the real request handler on an ephemeral port"""
+    from server_modes import create_server
+    from simple_server import EnergyOptimizerHandler
+    
+    httpd = create_server(mode, ('127.0.0.1', 0), EnergyOptimizerHandler, workers)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd, httpd.server_address[1]
+
+def stop_test_server(httpd):
+    """Shut down a server started by start_test_server"""
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_server_modes():
+    """Test every serving engine over a single keep-alive connection"""
+    print("\n🧪 Testing Server Modes...")
     
-    print("✅ All data structures generated successfully")
-    print("✅ API response format is valid")
+    modes = ['threaded', 'asyncio']
+    if hasattr(os, 'fork'):
+        modes.append('prefork')
     
-    return api_data
+    for mode in modes:
+        httpd, port = start_test_server(mode, workers=2)
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            for path in ('/health', '/devices/sample', '/missing'):
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = json.loads(response.read())
+                assert response.version == 11
+                assert response.status == (404 if path == '/missing' else 200)
+                assert body
+            sock = conn.sock
+            conn.request('POST', '/devices/toggle', body=json.dumps({'device_id': 'none'}),
+                         headers={'Content-Type': 'application/json'})
+            assert conn.getresponse().read()
+            assert conn.sock is sock, "connection was not kept alive"
+            conn.close()
+        finally:
+            stop_test_server(httpd)
+        print(f"✅ {mode} server handled keep-alive requests")
+
+def test_device_registry():
+    """Test indexed device registry lookups and concurrent updates"""
+    print("\n🧪 Testing Device Registry...")
+    from device_registry import DeviceRegistry
+    
+    registry = DeviceRegistry()
+    for i in range(1000):
+        registry.add({
+            'device_id': f'device_{i}',
+            'device_type': ('hvac', 'lighting')[i % 2],
+            'location': f'floor_{i % 10}',
+            'current_power': 1.0,
+            'is_active': True
+        })
+    
+    assert len(registry) == 1000
+    assert len(registry.find_ids(device_type='hvac', location='floor_2')) == 100
+    assert registry.toggle('device_2')['is_active'] is False
+    assert 'device_2' in registry.find_ids(is_active=False)
+    assert 'device_2' not in registry.find_ids(device_type='hvac', is_active=True)
+    assert registry.remove('device_3') and not registry.remove('device_3')
+    assert registry.get('device_3') is None
+    
+    # Writers on separate threads must not lose updates
+    def add_many(offset):
+        for i in range(500):
+            registry.add({'device_id': f'thread_{offset}_{i}', 'device_type': 'appliances'})
+    
+    def update_many():
+        for _ in range(200):
+            registry.update_powers((f'device_{i}', 2.0) for i in range(0, 1000, 7))
+    
+    threads = [threading.Thread(target=add_many, args=(n,)) for n in range(4)]
+    threads.append(threading.Thread(target=update_many))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(registry) == 999 + 2000
+    assert len(registry.find_ids(device_type='appliances')) == 2000
+    assert registry.get('device_7')['current_power'] == 2.0
+    ids, types, locations, power = registry.columns(active_only=True)
+    assert len(ids) == len(power) == len(registry) - 1
+    
+    # A device the indexes cannot hold is refused before anything is stored
+    for bad in ({'device_type': [1]}, {'location': {}}, {'current_power': 'nan'}):
+        try:
+            registry.add({'device_id': 'bad_device', **bad})
+            assert False, bad
+        except ValueError:
+            pass
+    assert 'bad_device' not in registry and len(registry) == 999 + 2000
+    
+    httpd, port = start_test_server()
+    try:
+        for bad in ({'device_name': 'Bad', 'device_type': [1]}, {'location': {'a': 1}},
+                    {'power_rating': 'inf'}, [1]):
+            assert post_raw(port, '/devices/add', json.dumps(bad), 'application/json')[0] == 400
+        status, result = post_raw(port, '/optimize', json.dumps({'top_k': 3}), 'application/json')
+        assert status == 200 and len(result['recommendations']) == 3
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Registry holds {len(registry)} devices with consistent indexes")
+
+def test_energy_store():
+    """Test SQLite persistence of devices and readings"""
+    print("\n🧪 Testing Energy Store...")
+    from device_registry import DeviceRegistry
+    from storage import EnergyStore
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'energy_test.db')
+        store = EnergyStore(path)
+        registry = DeviceRegistry()
+        store.attach(registry)
+        
+        registry.add({'device_id': 'hvac_001', 'device_type': 'hvac', 'current_power': 4.2})
+        registry.add({'device_id': 'lighting_001', 'device_type': 'lighting'})
+        registry.toggle('hvac_001')
+        registry.remove('lighting_001')
+        store.record_readings(('hvac_001', 1000.0 + i, float(i)) for i in range(500))
+        assert store.flush(timeout=5)
+        
+        assert store.readings_written == 500
+        assert len(store.readings('hvac_001', 1100.0, 1200.0)) == 100
+        
+        # Rows that cannot be stored are dropped on their own; the rest of the group commits
+        store.record_readings([('hvac_001', 2000.0, 1.0), ('hvac_001', 2001.0, None)])
+        store.record_readings([('hvac_001', 2002.0, [1]), ('hvac_001', 2003.0, 3.0)])
+        assert store.flush(timeout=5)
+        assert store.readings_written == 502 and store.rows_dropped == 2
+        assert store.readings('hvac_001', 2000.0) == [(2000.0, 1.0), (2003.0, 3.0)]
+        assert store.latest_reading('hvac_001') == (2003.0, 3.0)
+        store.close()
+        
+        # A fresh store sees exactly what was committed
+        store = EnergyStore(path)
+        devices = store.load_devices()
+        store.close()
+    
+    assert [d['device_id'] for d in devices] == ['hvac_001']
+    assert devices[0]['is_active'] is False
+    
+    print("✅ Devices and readings survive a restart")
+
+def post_raw(port, path, body, content_type, chunked=False):
+    """POST a raw body and return (status, decoded JSON)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    if chunked:
+        conn.request('POST', path, body=iter(body), encode_chunked=True,
+                     headers={'Content-Type': content_type, 'Transfer-Encoding': 'chunked'})
+    else:
+        conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    conn.close()
+    return response.status, result
+
+def test_telemetry_ingest():
+    """Test NDJSON, CSV, binary and chunked telemetry batches"""
+    print("\n🧪 Testing Telemetry Ingest...")
+    import simple_server
+    from telemetry import encode_binary
+    
+    httpd, port = start_test_server()
+    try:
+        lines = [json.dumps({'device_id': 'hvac_001', 'timestamp': 1700000000 + i, 'power': 3.0 + i})
+                 for i in range(5)]
+        lines.append('{"device_id": "ghost_001", "power": 1.0}')
+        lines.append('not json')
+        status, result = post_raw(port, '/telemetry/ingest', '\n'.join(lines), 'application/x-ndjson')
+        assert status == 200
+        assert (result['accepted'], result['rejected']) == (5, 2), result
+        assert simple_server.DEVICES.get('hvac_001')['current_power'] == 7.0
+        
+        csv_body = 'device_id,timestamp,power\nlighting_001,1700000000,0.5\nlighting_001,1700000060,0.6\n'
+        status, result = post_raw(port, '/telemetry/ingest', csv_body, 'text/csv')
+        assert result['accepted'] == 2 and result['format'] == 'csv'
+        
+        binary = encode_binary([('appliance_001', 1700000000.0, 1.25)] * 100)
+        status, result = post_raw(port, '/telemetry/ingest', binary, 'application/octet-stream')
+        assert result['accepted'] == 100 and result['format'] == 'binary'
+        
+        # Chunk boundaries deliberately split records in the middle
+        chunks = [line.encode() + b'\n' for line in lines[:5]]
+        payload = b''.join(chunks)
+        pieces = [payload[i:i + 7] for i in range(0, len(payload), 7)]
+        status, result = post_raw(port, '/telemetry/ingest', pieces, 'application/x-ndjson',
+                                  chunked=True)
+        assert result['accepted'] == 5, result
+        assert len(simple_server.TELEMETRY.series('hvac_001', since=1700000000)) == 10
+        
+        # Non-finite values are rejected on their own; the good reading next to them still lands
+        body = '{"device_id": "lighting_001", "timestamp": 1700000120, "power": 0.7}\n' \
+               '{"device_id": "lighting_001", "timestamp": 1700000180, "power": NaN}\n'
+        status, result = post_raw(port, '/telemetry/ingest', body, 'application/x-ndjson')
+        assert (result['accepted'], result['rejected']) == (1, 1), result
+        assert 'finite' in result['errors'][0]['reason']
+        csv_body = 'lighting_001,1700000240,0.8\nlighting_001,inf,0.8\nlighting_001,1700000300,-inf\n'
+        status, result = post_raw(port, '/telemetry/ingest', csv_body, 'text/csv')
+        assert (result['accepted'], result['rejected']) == (1, 2), result
+        binary = encode_binary([('lighting_001', 1700000360.0, 0.9),
+                                ('lighting_001', 1700000420.0, float('nan'))])
+        status, result = post_raw(port, '/telemetry/ingest', binary, 'application/octet-stream')
+        assert (result['accepted'], result['rejected']) == (1, 1), result
+        assert abs(simple_server.DEVICES.get('lighting_001')['current_power'] - 0.9) < 1e-6
+    finally:
+        stop_test_server(httpd)
+    
+    # Malformed chunk framing is answered with 400 rather than read forever
+    import socket
+    line = b'{"device_id": "hvac_001", "timestamp": 1700000000, "power": 1.0}\n'
+    for mode in ('threaded', 'asyncio'):
+        httpd, port = start_test_server(mode)
+        try:
+            for framing in (b'-5\r\nhello\r\n0\r\n\r\n', b'+5\r\nhello\r\n0\r\n\r\n',
+                            b'%x\r\n%sXY0\r\n\r\n' % (len(line), line)):
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                    sock.sendall(b'POST /telemetry/ingest HTTP/1.1\r\nHost: test\r\n'
+                                 b'Transfer-Encoding: chunked\r\nContent-Type: application/x-ndjson\r\n\r\n'
+                                 + framing)
+                    assert read_until(sock, b'\r\n').startswith(b'HTTP/1.1 400'), (mode, framing)
+            # A signed Content-Length would leave the body to be read as the next request
+            for length in (b'-5', b'+5', b'5 5'):
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                    sock.sendall(b'POST /devices/add HTTP/1.1\r\nHost: test\r\nContent-Length: ' + length
+                                 + b'\r\n\r\nGET /health HTTP/1.1\r\nHost: test\r\n\r\n')
+                    response = read_until(sock, b'\r\n\r\n')
+                    assert response.startswith(b'HTTP/1.1 400'), (mode, length)
+                    assert b'Connection: close' in response
+        finally:
+            stop_test_server(httpd)
+    
+    print("✅ Streaming ingest accepted valid readings and rejected bad ones")
+
+def get_json(port, path, headers=None):
+    """GET a path and return (status, decoded JSON)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    conn.close()
+    return response.status, result
+
+def test_prediction_engine():
+    """Test that forecasts learn a daily load cycle from telemetry"""
+    print("\n🧪 Testing Prediction Engine...")
+    import math
+    from device_registry import DeviceRegistry
+    from predictor import EnergyPredictor
+    
+    registry = DeviceRegistry([
+        {'device_id': 'hvac_001', 'device_type': 'hvac', 'current_power': 3.0},
+        {'device_id': 'lighting_001', 'device_type': 'lighting', 'current_power': 0.5}
+    ])
+    predictor = EnergyPredictor(registry)
+    predictor.utc_offset = 0.0
+    
+    # Two weeks of 10-minute HVAC readings peaking at 18:00 UTC
+    start = 1700000000 - 1700000000 % 86400
+    readings = []
+    for step in range(14 * 144):
+        ts = start + step * 600
+        hour = (ts % 86400) / 3600.0
+        readings.append(('hvac_001', ts, 3.0 + 2.0 * math.cos(2 * math.pi * (hour - 18) / 24)))
+    predictor.observe(readings)
+    
+    now = start + 14 * 86400
+    forecast = predictor.predict(24, 'hvac_001', now=now)
+    usage = [p['predicted_usage'] for p in forecast['predictions']]
+    assert len(usage) == 24
+    assert usage.index(max(usage)) in (17, 18), usage
+    assert abs(max(usage) - 5.0) < 0.1 and abs(min(usage) - 1.0) < 0.1
+    assert forecast['average_confidence'] > 0.9
+    
+    # The fleet adds the untrained lighting circuit as a flat prior
+    fleet = predictor.predict(168, now=now)
+    assert len(fleet['predictions']) == 168
+    assert abs(fleet['predictions'][18]['predicted_usage'] - 5.5) < 0.1
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = get_json(port, '/predictions?hours=168')
+        assert status == 200 and len(result['predictions']) == 168
+        assert get_json(port, '/predictions?hours=0')[0] == 400
+        assert get_json(port, '/predictions?device_id=missing')[0] == 404
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Forecast peak {max(usage)} kWh at hour {usage.index(max(usage))}")
+
+def test_response_cache():
+    """Test TTL, LRU eviction, invalidation and ETag revalidation"""
+    print("\n🧪 Testing Response Cache...")
+    import time
+    import simple_server
+    from response_cache import ResponseCache, cache_key
+    
+    assert cache_key('/predictions', 'hours=6&device_id=a') == cache_key('/predictions', 'device_id=a&hours=6')
+    
+    cache = ResponseCache(ttl=0.05, max_bytes=2000)
+    cache.put('a', b'x' * 500, tags=('devices',))
+    cache.put('b', b'y' * 500, tags=('telemetry',))
+    assert cache.get('a') is not None
+    cache.put('c', b'z' * 500)  # Over budget: least recently used 'b' goes
+    assert cache.get('b') is None and cache.get('a') is not None
+    cache.invalidate('devices')
+    assert cache.get('a') is None
+    
+    # A response computed across an invalidation of one of its tags is not stored
+    snapshot = cache.generations()
+    cache.invalidate('devices')
+    assert cache.put('d', b'stale', tags=('devices',), generations=snapshot).body == b'stale'
+    assert cache.get('d') is None and cache.stale_puts == 1
+    cache.put('e', b'fresh', tags=('telemetry',), generations=snapshot)
+    assert cache.get('e') is not None
+    time.sleep(0.06)
+    assert cache.get('c') is None
+    
+    httpd, port = start_test_server()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/analytics/summary')
+        first = conn.getresponse()
+        body = first.read()
+        etag = first.getheader('ETag')
+        assert etag
+        
+        conn.request('GET', '/analytics/summary', headers={'If-None-Match': etag})
+        revalidated = conn.getresponse()
+        assert revalidated.status == 304 and revalidated.read() == b''
+        
+        hits = simple_server.RESPONSE_CACHE.hits
+        conn.request('GET', '/analytics/summary')
+        response = conn.getresponse()
+        assert response.read() == body
+        assert simple_server.RESPONSE_CACHE.hits == hits + 1
+        
+        # A device mutation invalidates the cached summary
+        post_raw(port, '/devices/toggle', json.dumps({'device_id': 'lighting_001'}), 'application/json')
+        post_raw(port, '/devices/toggle', json.dumps({'device_id': 'lighting_001'}), 'application/json')
+        conn.request('GET', '/analytics/summary', headers={'If-None-Match': etag})
+        response = conn.getresponse()
+        response.read()
+        assert simple_server.RESPONSE_CACHE.hits == hits + 1
+        conn.close()
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ Cached responses revalidate with 304 and drop on device changes")
+
+def test_optimization_engine():
+    """Test vectorized optimization over a registry fleet"""
+    print("\n🧪 Testing Optimization Engine...")
+    import time
+    from device_registry import DeviceRegistry
+    from optimizer import optimize_fleet
+    
+    device_types = ['thermostat', 'lighting', 'hvac', 'appliances']
+    registry = DeviceRegistry([{
+        'device_id': f'{device_types[i % 4]}_{i:06d}',
+        'device_type': device_types[i % 4],
+        'current_power': 0.5 + (i % 10) * 0.4,
+        'location': f'floor_{i % 5}'
+    } for i in range(100000)])
+    registry.toggle('hvac_000002')
+    
+    started = time.perf_counter()
+    result = optimize_fleet(registry, {'top_k': 20, 'peak': False})
+    elapsed = time.perf_counter() - started
+    assert elapsed < 1.0, elapsed
+    assert result['devices_evaluated'] == 99999
+    savings = [r['expected_savings'] for r in result['recommendations']]
+    assert len(savings) == 20 and savings == sorted(savings, reverse=True)
+    assert all(r['device_id'] != 'hvac_000002' for r in result['recommendations'])
+    
+    # A single device: compounded actions never save more than it draws
+    single = DeviceRegistry([{'device_id': 'hvac_001', 'device_type': 'hvac', 'current_power': 4.0}])
+    result = optimize_fleet(single, {'peak': True})
+    assert len(result['recommendations']) == 3
+    assert result['total_potential_savings'] < result['current_usage'] == 4.0
+    
+    # A comfort budget keeps only zero/low impact actions
+    budgeted = optimize_fleet(registry, {'comfort_budget': 0.5, 'top_k': 100, 'location': 'floor_1'})
+    assert budgeted['comfort_used'] <= 0.5
+    assert {r['recommended_action'] for r in budgeted['recommendations']} <= {
+        'led_upgrade', 'maintenance', 'motion_sensors', 'eco_mode', 'power_management'}
+    
+    # A boost replaces the device's table actions and is charged to the comfort budget
+    from optimizer import BOOST_COMFORT_IMPACT, optimize_arrays
+    ids, kinds, draw = ['light_a', 'light_b', 'hvac_c'], ['lighting', 'lighting', 'hvac'], [2.0, 1.0, 3.0]
+    boosted = optimize_arrays(ids, kinds, draw, top_k=5, hours=2.0,
+                              boosts={'light_a': ('turn_off_lights', 0.8)})
+    assert boosted['recommendations'][0]['recommended_action'] == 'turn_off_lights'
+    for device_id, device_power in zip(ids, draw):
+        saved = sum(r['expected_savings'] for r in boosted['recommendations'] if r['device_id'] == device_id)
+        assert saved <= device_power * 2.0
+    assert [r['device_id'] for r in boosted['recommendations']].count('light_a') == 1
+    assert len(boosted['recommendations']) == 5
+    tight = optimize_arrays(ids, kinds, draw, top_k=5, comfort_budget=BOOST_COMFORT_IMPACT / 2,
+                            boosts={'light_a': ('turn_off_lights', 0.8)})
+    assert all(r['device_id'] != 'light_a' or r['recommended_action'] != 'turn_off_lights'
+               for r in tight['recommendations'])
+    assert tight['comfort_used'] <= BOOST_COMFORT_IMPACT / 2
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = post_raw(port, '/optimize', json.dumps({'top_k': 5}), 'application/json')
+        assert status == 200 and len(result['recommendations']) == 5
+        assert post_raw(port, '/optimize', '[1, 2]', 'application/json')[0] == 400
+        for hours in ('inf', 'nan', 1e308, 0, -1):
+            assert post_raw(port, '/optimize', json.dumps({'hours': hours}), 'application/json')[0] == 400
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Optimized 100k devices in {elapsed * 1000:.0f} ms")
+
+def test_load_scheduler():
+    """Test that deferrable runs move out of peak windows"""
+    print("\n🧪 Testing Load Scheduler...")
+    import random
+    import time
+    from scheduler import build_schedule
+    
+    # Prices: expensive for the first 12 hours, cheap afterwards
+    tariff = [0.40] * 12 + [0.10] * 12
+    jobs = [{'job_id': f'dishwasher_{i}', 'power': 1.5, 'duration': 2, 'earliest': 0, 'deadline': 24}
+            for i in range(3)]
+    exact = build_schedule({'jobs': jobs, 'tariff': tariff, 'solver': 'exact'}, [1.0] * 24,
+                           start=1700006400)
+    greedy = build_schedule({'jobs': jobs, 'tariff': tariff, 'solver': 'greedy'}, [1.0] * 24,
+                            start=1700006400)
+    assert exact['summary']['solver'] == 'exact'
+    assert all(entry['start_slot'] >= 12 for entry in exact['plan'])
+    assert exact['summary']['peak_load'] == 2.5  # Runs spread out, never stacked
+    assert exact['summary']['objective'] <= greedy['summary']['objective']
+    assert exact['summary']['total_cost'] < exact['summary']['baseline_cost']
+    
+    # Infeasible windows are reported, not silently dropped
+    tight = build_schedule({'jobs': [{'job_id': 'x', 'power': 1, 'duration': 5, 'deadline': 3}]},
+                           [0.0] * 24)
+    assert tight['unscheduled'][0]['job_id'] == 'x' and not tight['plan']
+    
+    # 10k jobs over a week of 15-minute slots
+    rng = random.Random(7)
+    many = [{'job_id': f'job_{i}', 'power': rng.uniform(0.5, 3.0), 'duration': rng.choice([1, 2, 3]),
+             'earliest': rng.randint(0, 120), 'deadline': 168} for i in range(10000)]
+    started = time.perf_counter()
+    week = build_schedule({'jobs': many, 'horizon_hours': 168, 'slot_minutes': 15}, [2.0] * 168)
+    elapsed = time.perf_counter() - started
+    assert week['summary']['scheduled'] == 10000 and elapsed < 10
+    assert week['summary']['peak_load'] < week['summary']['baseline_peak_load']
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = post_raw(port, '/schedule', json.dumps({'horizon_hours': 48}), 'application/json')
+        assert status == 200 and result['plan'][0]['device_id'] == 'appliance_001'
+        assert post_raw(port, '/schedule', json.dumps({'slot_minutes': 7}), 'application/json')[0] == 400
+        for bad in ({'jobs': [{'power': 'nan'}]}, {'jobs': [{'power': 1, 'duration': 'inf'}]},
+                    {'jobs': [{'power': 1, 'earliest': '-inf'}]}, {'jobs': [{'power': 1, 'deadline': 'nan'}]},
+                    {'peak_weight': -1}, {'peak_weight': 'nan'}, {'peak_weight': 1e9}):
+            status, result = post_raw(port, '/schedule', json.dumps(bad), 'application/json')
+            assert status == 400 and ('finite' in result['error'] or 'between' in result['error']), result
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Scheduled 10k jobs over 7 days in {elapsed:.2f}s")
+
+def test_analytics_rollups():
+    """Test that usage summaries come from incrementally updated rollups"""
+    print("\n🧪 Testing Analytics Rollups...")
+    from analytics import RollupStore
+    from device_registry import DeviceRegistry
+    
+    registry = DeviceRegistry([
+        {'device_id': 'hvac_001', 'device_type': 'hvac', 'location': 'basement'},
+        {'device_id': 'light_001', 'device_type': 'lighting', 'location': 'office'}
+    ])
+    rollups = RollupStore(registry)
+    
+    # Two days of 10-minute readings: HVAC at 4 kW from 17:00-21:00, 1 kW
+    # otherwise; lighting a constant 0.5 kW. Fed in small out-of-order batches.
+    start = 1700000000 - 1700000000 % 86400
+    readings = []
+    for step in range(2 * 144):
+        ts = start + step * 600
+        hour = (ts % 86400) // 3600
+        readings.append(('hvac_001', ts, 4.0 if 17 <= hour < 21 else 1.0))
+        readings.append(('light_001', ts, 0.5))
+    batches = [readings[i:i + 50] for i in range(0, len(readings), 50)]
+    for batch in reversed(batches[:4]):
+        rollups.observe(batch)
+    for batch in batches[4:]:
+        rollups.observe(batch)
+    
+    end = start + 2 * 86400
+    fleet = rollups.summary(start, end)
+    assert fleet['hours_with_data'] == 48
+    assert fleet['peak_usage'] == 4.5 and fleet['min_usage'] == 1.5
+    assert fleet['peak_hours_count'] == 8
+    assert fleet['average_daily_usage'] == 48.0  # 4h x 4 + 20h x 1 + 24h x 0.5
+    assert 0 < fleet['efficiency_score'] < 100
+    
+    office = rollups.summary(start, end, location='office')
+    assert office['peak_usage'] == office['min_usage'] == 0.5
+    assert office['efficiency_score'] == 100.0
+    hvac = rollups.summary(start, start + 86400, location='basement', device_type='hvac')
+    assert hvac['total_usage'] == 36.0
+    assert rollups.summary(start, end, device_type='thermostat')['hours_with_data'] == 0
+    rollups.observe([('hvac_001', time.time() + 10 * 365 * 86400, 9.0)])
+    assert rollups.summary(start, end) == fleet
+    
+    # Ranges are clamped to the buckets still held; longer than retention is an error
+    later = rollups.summary(start, start + 60 * 86400)
+    assert later['hours_with_data'] == 48 and later['total_usage'] == fleet['total_usage']
+    try:
+        rollups.summary(start, start + 8 * 86400, location='basement', device_type='hvac')
+        assert False, "range beyond the per-device retention was accepted"
+    except ValueError:
+        pass
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = get_json(port, '/analytics/summary?location=kitchen')
+        assert status == 200 and 'prediction_confidence' in result
+        assert get_json(port, '/analytics/summary?start=tomorrow')[0] == 400
+        # Unbounded ranges are refused instead of allocating a bucket per hour
+        assert get_json(port, '/analytics/summary?start=-1e12&end=1e12')[0] == 400
+        
+        # A reading dated years ahead is rejected and cannot hide current usage
+        now = time.time()
+        lines = [{"device_id": "lighting_001", "timestamp": now + 10 * 365 * 86400, "power": 5.0},
+                 {"device_id": "lighting_001", "timestamp": now - 60, "power": 5.0}]
+        body = '\n'.join(json.dumps(line) for line in lines)
+        status, result = post_raw(port, '/telemetry/ingest', body, 'application/x-ndjson')
+        assert (result['accepted'], result['rejected']) == (1, 1) and 'future' in result['errors'][0]['reason']
+        status, result = get_json(port, '/analytics/summary')
+        assert status == 200 and result['hours_with_data'] >= 1 and result['total_usage'] > 0
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Fleet peak {fleet['peak_usage']} kWh, load factor {fleet['efficiency_score']}%")
+
+def test_telemetry_export():
+    """Test paged, streamed and gzipped exports of stored readings"""
+    print("\n🧪 Testing Telemetry Export...")
+    import gzip
+    import tracemalloc
+    from storage import EnergyStore
+    from telemetry import gzip_chunks, iter_export
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EnergyStore(os.path.join(tmp, 'export_test.db'))
+        # Duplicate timestamps must not be skipped or repeated across page boundaries
+        store.record_readings(('hvac_001', 1000.0 + i // 2, float(i)) for i in range(25))
+        store.record_readings(('meter_001', 1000.0 + i, 1.5) for i in range(200000))
+        assert store.flush(timeout=30)
+        
+        pages = list(store.iter_reading_pages('hvac_001', 1002.0, 1010.0, page_size=4))
+        assert [len(page) for page in pages] == [4, 4, 4, 4]
+        assert [power for page in pages for _, power in page] == [float(i) for i in range(4, 20)]
+        
+        # Memory stays flat however many rows stream through the encoder
+        tracemalloc.start()
+        compressed = 0
+        body = gzip_chunks(iter_export(
+            (('meter_001', page) for page in store.iter_reading_pages('meter_001')), 'ndjson'))
+        for chunk in body:
+            compressed += len(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        store.close()
+    assert peak < 8 * 1024 * 1024, peak
+    
+    httpd, port = start_test_server()
+    try:
+        lines = '\n'.join(json.dumps({'device_id': 'lighting_001', 'timestamp': 1600000000 + i,
+                                      'power': 0.25}) for i in range(50))
+        assert post_raw(port, '/telemetry/ingest', lines, 'application/x-ndjson')[0] == 200
+        
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/telemetry/export?device_id=lighting_001&start=1600000010&end=1600000020'
+                            '&format=csv', headers={'Accept-Encoding': 'gzip'})
+        response = conn.getresponse()
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        assert response.getheader('Content-Encoding') == 'gzip'
+        rows = gzip.decompress(response.read()).decode().splitlines()
+        assert rows[0] == 'device_id,timestamp,power' and len(rows) == 11
+        assert rows[1] == 'lighting_001,1600000010.0,0.25'
+        
+        # Same connection stays usable; plain NDJSON when gzip is not accepted
+        conn.request('GET', '/telemetry/export?device_id=lighting_001&end=1600000005')
+        response = conn.getresponse()
+        assert response.getheader('Content-Encoding') is None
+        records = [json.loads(line) for line in response.read().splitlines()]
+        assert [r['timestamp'] for r in records] == [1600000000.0 + i for i in range(5)]
+        conn.close()
+        
+        assert get_json(port, '/telemetry/export?format=xml')[0] == 400
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Streamed 200k readings as {compressed // 1024} KiB gzip with {peak // 1024} KiB peak memory")
+
+def test_router():
+    """Test route matching, path parameters and single-write responses"""
+    print("\n🧪 Testing Router...")
+    from bench_router import FakeConnection, load_server, request_bytes
+    from router import Router
+    
+    router = Router()
+    router.add('GET', '/devices/sample', 'sample')
+    router.add('GET', '/devices/{device_id}', 'detail')
+    router.add('POST', '/devices/{device_id}/toggle', 'toggle')
+    assert router.match('GET', '/devices/sample') == ('sample', {}, ())
+    assert router.match('GET', '/devices/hvac%20001') == ('detail', {'device_id': 'hvac 001'}, ())
+    assert router.match('POST', '/devices/x/toggle') == ('toggle', {'device_id': 'x'}, ())
+    assert router.match('DELETE', '/devices/x') == (None, None, ('GET',))
+    assert router.match('GET', '/devices/x/y') == (None, None, ())
+    
+    handler_class = load_server(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'simple_server.py'), 'router_test_server')
+    requests = [request_bytes('GET', '/health', None),
+                request_bytes('GET', '/devices/hvac_001', None),
+                request_bytes('POST', '/devices/sample', b'{}')]
+    connection = FakeConnection(b''.join(requests))
+    handler_class(connection, ('127.0.0.1', 0), None)
+    assert connection.sends == 3  # Head and body leave in one write per response
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = get_json(port, '/devices/hvac_001')
+        assert status == 200 and result['device']['device_type'] == 'hvac'
+        assert get_json(port, '/devices/ghost_001')[0] == 404
+        assert post_raw(port, '/health', '{}', 'application/json')[0] == 405
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ Routes resolve with path parameters; one write per response")
+
+def test_static_assets():
+    """Test in-memory frontend files with gzip variants and revalidation"""
+    print("\n🧪 Testing Static Assets...")
+    import gzip
+    import simple_server
+    from static_assets import StaticAssets
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'js'))
+        page = '<html><body>' + '<p>Energy dashboard ⚡</p>' * 200 + '</body></html>'
+        with open(os.path.join(tmp, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(page)
+        with open(os.path.join(tmp, 'js', 'app.js'), 'w') as f:
+            f.write('const API_BASE = "";\n')
+        video = os.urandom(300 * 1024)
+        with open(os.path.join(tmp, 'intro.bin'), 'wb') as f:
+            f.write(video)
+        
+        assets = StaticAssets(tmp, max_memory_bytes=256 * 1024)
+        assert len(assets) == 3 and assets.get('') is assets.get('index.html')
+        assert assets.get('../README.md') is None
+        assert assets.get('index.html').gzip_body is not None
+        assert assets.get('js/app.js').gzip_body is None  # Too small to be worth compressing
+        assert not assets.get('intro.bin').in_memory
+        
+        previous = simple_server.STATIC
+        simple_server.STATIC = assets
+        httpd, port = start_test_server()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/frontend/', headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            body = response.read()
+            assert response.getheader('Content-Encoding') == 'gzip'
+            assert int(response.getheader('Content-Length')) == len(body) < len(page)
+            assert gzip.decompress(body).decode() == page
+            etag = response.getheader('ETag')
+            
+            conn.request('GET', '/frontend/index.html', headers={'Accept-Encoding': 'gzip',
+                                                                  'If-None-Match': etag})
+            response = conn.getresponse()
+            assert response.status == 304 and response.read() == b''
+            
+            conn.request('GET', '/frontend/js/app.js', headers={
+                'If-Modified-Since': assets.get('js/app.js').last_modified})
+            response = conn.getresponse()
+            assert response.status == 304 and response.read() == b''
+            
+            # Large files go out with sendfile on the same keep-alive connection
+            conn.request('GET', '/frontend/intro.bin')
+            response = conn.getresponse()
+            assert response.read() == video
+            assert response.getheader('Cache-Control') == 'public, max-age=3600'
+            conn.request('GET', '/frontend/missing.css')
+            response = conn.getresponse()
+            assert response.status == 404
+            response.read()
+            conn.close()
+        finally:
+            stop_test_server(httpd)
+            simple_server.STATIC = previous
+    
+    print("✅ Frontend served from memory with gzip, ETag and 304s")
+
+def read_until(sock, marker, buffer=b''):
+    """Receive from ``sock`` until ``marker`` appears; returns everything read"""
+    while marker not in buffer:
+        data = sock.recv(65536)
+        assert data, "connection closed"
+        buffer += data
+    return buffer
+
+def test_stream_hub():
+    """Test SSE and WebSocket fan-out of device and telemetry deltas"""
+    print("\n🧪 Testing Stream Hub...")
+    import base64
+    import socket
+    import struct
+    import time
+    import simple_server
+    from stream_hub import StreamHub, websocket_frame
+    
+    # 1000 subscribers are served by the hub's one thread
+    hub = StreamHub(coalesce_interval=0.05)
+    threads_before = threading.active_count()
+    clients = []
+    for _ in range(1000):
+        server_side, client_side = socket.socketpair()
+        hub.subscribe(server_side, topics=['devices'])
+        clients.append(client_side)
+    hub.publish('telemetry', {'ignored': True})
+    started = time.perf_counter()
+    hub.publish('devices', {'event': 'toggled', 'devices': [{'device_id': 'hvac_001'}]})
+    for client in clients:
+        client.settimeout(5)
+        received = read_until(client, b'event: devices')
+        assert b'event: telemetry' not in received and b'hvac_001' in read_until(client, b'\n\n', received)
+    fan_out = time.perf_counter() - started
+    assert threading.active_count() - threads_before == 1
+    for client in clients[:10]:
+        client.close()
+    time.sleep(0.2)
+    assert hub.stats()['subscribers'] == 990
+    hub.close()
+    for client in clients[10:]:
+        client.close()
+    
+    simple_server.STREAM_HUB.coalesce_interval = 0.05
+    httpd, port = start_test_server()
+    try:
+        # Server-Sent Events: snapshot first, then deltas as devices change
+        sse = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sse.sendall(b'GET /stream?topics=devices HTTP/1.1\r\nHost: test\r\n\r\n')
+        received = read_until(sse, b'event: snapshot')
+        assert received.startswith(b'HTTP/1.1 200') and b'text/event-stream' in received
+        simple_server.DEVICES.toggle('lighting_001')
+        received = read_until(sse, b'event: devices', received)
+        event = received.split(b'event: devices\ndata: ', 1)[1]
+        event = json.loads(read_until(sse, b'\n\n', event).split(b'\n\n', 1)[0])
+        assert event['event'] == 'toggled' and event['devices'][0]['device_id'] == 'lighting_001'
+        simple_server.DEVICES.toggle('lighting_001')
+        sse.close()
+        
+        # WebSocket: upgrade, snapshot frame, ping/pong and coalesced telemetry
+        ws = socket.create_connection(('127.0.0.1', port), timeout=5)
+        key = base64.b64encode(os.urandom(16)).decode()
+        ws.sendall(f'GET /stream HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\n'
+                   f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+                   f'Sec-WebSocket-Version: 13\r\n\r\n'.encode())
+        received = read_until(ws, b'"event": "snapshot"')
+        assert received.startswith(b'HTTP/1.1 101')
+        mask = os.urandom(4)
+        ws.sendall(struct.pack('!BB', 0x89, 0x84) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(b'ping')))
+        received = read_until(ws, websocket_frame(b'ping', 0xA), received)
+        lines = '\n'.join(json.dumps({'device_id': 'hvac_001', 'timestamp': 1750000000 + i, 'power': i})
+                          for i in range(10))
+        assert post_raw(port, '/telemetry/ingest', lines, 'application/x-ndjson')[0] == 200
+        received = read_until(ws, b'"event": "telemetry"', received)
+        received = read_until(ws, b']}}', received)
+        assert b'"hvac_001": [1750000009.0, 9.0]' in received  # Only the newest reading
+        ws.close()
+    finally:
+        stop_test_server(httpd)
+    
+    print(f"✅ Pushed a delta to 1000 subscribers in {fan_out * 1000:.0f} ms from one thread")
+
+def test_device_pagination():
+    """Test cursor pages, index filters, power sorting and field projection"""
+    print("\n🧪 Testing Device Pagination...")
+    from urllib.parse import quote
+    from device_registry import DeviceRegistry
+    
+    types = ['hvac', 'lighting', 'thermostat']
+    registry = DeviceRegistry([{'device_id': f'dev_{i:05d}', 'device_type': types[i % 3],
+                                'location': f'floor_{i % 4}', 'current_power': float(i % 7),
+                                'is_active': i % 2 == 0} for i in range(5000)])
+    
+    for sort in ('device_id', '-current_power'):
+        seen = []
+        position = None
+        while True:
+            page, position = registry.page(device_type='hvac', is_active=True, sort=sort,
+                                           cursor=position, limit=250)
+            seen.extend(page)
+            if position is None:
+                break
+        ids = [d['device_id'] for d in seen]
+        assert len(ids) == len(set(ids)) == len(registry.find_ids('hvac', is_active=True))
+        assert all(d['device_type'] == 'hvac' and d['is_active'] for d in seen)
+        if sort == 'device_id':
+            assert ids == sorted(ids)
+        else:
+            powers = [d['current_power'] for d in seen]
+            assert powers == sorted(powers, reverse=True)
+    
+    # Pages stay consistent while devices come and go between requests
+    page, position = registry.page(limit=10)
+    registry.remove(page[0]['device_id'])
+    registry.add({'device_id': 'dev_00009a'})
+    page, _ = registry.page(cursor=position, limit=10)
+    assert page[0]['device_id'] == 'dev_00009a'
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = get_json(port, '/devices/sample?limit=2&fields=device_id,current_power'
+                                        '&sort=-current_power')
+        assert status == 200 and result['count'] == 2
+        assert set(result['devices'][0]) == {'device_id', 'current_power'}
+        assert result['devices'][0]['device_id'] == 'hvac_001'
+        status, rest = get_json(port, '/devices/sample?limit=2&fields=device_id,current_power'
+                                      '&sort=-current_power&cursor=' + quote(result['next_cursor']))
+        assert status == 200 and rest['devices'][0] not in result['devices']
+        assert get_json(port, '/devices/sample?location=kitchen')[1]['devices'][0]['device_id'] \
+            == 'appliance_001'
+        assert get_json(port, '/devices/sample?fields=password')[0] == 400
+        assert get_json(port, '/devices/sample?cursor=%%%')[0] == 400
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ Paged 5000 devices by id and by power without gaps or repeats")
+
+def test_device_batch():
+    """Test atomic batch mutations, the single notification and persistence"""
+    print("\n🧪 Testing Device Batch...")
+    from device_registry import BatchError, DeviceRegistry
+    from storage import EnergyStore
+    
+    registry = DeviceRegistry([{'device_id': 'hvac_001'}, {'device_id': 'pump_001'}])
+    events = []
+    registry.add_listener(lambda event, devices: events.append((event, len(devices))))
+    
+    # One bad operation rejects the whole batch
+    try:
+        registry.apply_batch([{'op': 'delete', 'device_id': 'hvac_001'},
+                              {'op': 'toggle', 'device_id': 'hvac_001'}])
+        assert False, "expected BatchError"
+    except BatchError as e:
+        assert [error['index'] for error in e.errors] == [1]
+    assert 'hvac_001' in registry and events == []
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EnergyStore(os.path.join(tmp, 'batch_test.db'))
+        store.attach(registry)
+        results = registry.apply_batch([
+            {'op': 'add', 'device_id': 'fan_001', 'device': {'device_type': 'fan'}},
+            {'op': 'toggle', 'device_id': 'fan_001'},
+            {'op': 'update', 'device_id': 'hvac_001', 'fields': {'current_power': 2.5}},
+            {'op': 'delete', 'device_id': 'pump_001'},
+        ])
+        assert store.flush(timeout=5)
+        stored = {d['device_id']: d for d in store.load_devices()}
+        store.close()
+    assert [r['success'] for r in results] == [True] * 4
+    assert events == [('batch', 4)]
+    assert set(stored) == {'fan_001', 'hvac_001'} and stored['fan_001']['is_active'] is False
+    assert registry.get('hvac_001')['current_power'] == 2.5
+    
+    # Large batches rebuild the sorted indexes once; pages must match a fresh registry
+    devices = [{'device_id': f'd{i:05d}', 'device_type': ('hvac', 'pump')[i % 2],
+                'location': f'floor_{i % 3}'} for i in range(20000)]
+    registry = DeviceRegistry(devices)
+    operations = [{'op': 'delete', 'device_id': f'd{i:05d}'} for i in range(0, 20000, 8)]
+    operations += [{'op': 'toggle', 'device_id': f'd{i:05d}'} for i in range(1, 20000, 16)]
+    operations += [{'op': 'update', 'device_id': f'd{i:05d}', 'fields': {'location': 'roof'}}
+                   for i in range(3, 20000, 32)]
+    operations += [{'op': 'add', 'device_id': f'd{i:05d}x', 'device': {'device_type': 'fan'}}
+                   for i in range(0, 20000, 40)]
+    start = time.time()
+    registry.apply_batch(operations)
+    elapsed = time.time() - start
+    expected = DeviceRegistry(registry.to_list())
+    for filters in ({}, {'device_type': 'fan'}, {'location': 'roof'}, {'location': 'floor_0'},
+                    {'is_active': False}, {'device_type': 'pump', 'is_active': True}):
+        assert registry.page(limit=1000, **filters) == expected.page(limit=1000, **filters), filters
+        assert registry.page(cursor='d10000', **filters) == expected.page(cursor='d10000', **filters)
+    assert elapsed < 0.5, f"batch of {len(operations)} took {elapsed:.2f}s"
+    
+    httpd, port = start_test_server()
+    try:
+        body = json.dumps({"operations": [
+            {"op": "add", "device": {"device_name": "Batch Fan", "power_rating": 0.3}},
+            {"op": "add", "device": {"device_name": "Batch Fan", "power_rating": 0.4}},
+            {"op": "toggle", "device_id": "hvac_001"},
+        ]}).encode()
+        status, result = post_raw(port, '/devices/batch', body, 'application/json')
+        assert status == 200 and result['applied'] == 3
+        added = [r['device']['device_id'] for r in result['results'][:2]]
+        assert len(set(added)) == 2
+        status, result = post_raw(port, '/devices/batch', json.dumps({"operations": [
+            {"op": "delete", "device_id": added[0]},
+            {"op": "delete", "device_id": "missing_device"},
+        ]}).encode(), 'application/json')
+        assert status == 400 and result['errors'][0]['index'] == 1
+        assert get_json(port, f'/devices/{added[0]}')[0] == 200
+        assert post_raw(port, '/devices/batch', b'[]', 'application/json')[0] == 400
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ Batches apply all-or-nothing with one notification")
+
+def test_serialization():
+    """Test encoder negotiation, MessagePack round trips and fragment reuse"""
+    print("\n🧪 Testing Serialization...")
+    from serialization import (JSON, MSGPACK_TYPE, FragmentCache, MsgPackEncoder, loads, negotiate,
+                               pack_msgpack, unpack_msgpack)
+    
+    assert negotiate(None) is JSON and negotiate('text/html, */*') is JSON
+    assert negotiate(f'application/json;q=0.5, {MSGPACK_TYPE}').content_type == MSGPACK_TYPE
+    assert negotiate(f'{MSGPACK_TYPE};q=0, application/json') is JSON
+    
+    value = {"id": "hvac_001", "power": 4.25, "on": True, "none": None, "n": -70000,
+             "tiny": -3, "big": 2 ** 40, "list": list(range(20)), "text": "é" * 40}
+    assert unpack_msgpack(pack_msgpack(value)) == value
+    
+    fragments = FragmentCache()
+    for encoder, decode in ((MsgPackEncoder(), unpack_msgpack), (JSON, loads)):
+        devices = [{"device_id": f"dev_{i}", "current_power": float(i)} for i in range(50)]
+        assert decode(fragments.encode_list(encoder, devices)) == devices
+        # A changed record is re-encoded, not served from its old fragment
+        devices[3]["current_power"] = 99.0
+        assert decode(fragments.encode_list(encoder, devices))[3]["current_power"] == 99.0
+    
+    httpd, port = start_test_server()
+    try:
+        for path in ('/devices/sample?limit=5', '/predictions?hours=6'):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', path, headers={'Accept': MSGPACK_TYPE})
+            response = conn.getresponse()
+            packed = unpack_msgpack(response.read())
+            conn.close()
+            assert response.status == 200
+            assert response.getheader('Content-Type') == MSGPACK_TYPE
+            assert response.getheader('Vary') == 'Accept'
+            assert packed == get_json(port, path)[1]
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ JSON and MessagePack responses decode to the same data")
+
+def test_metrics():
+    """Test latency quantiles, the /metrics exposition and the buffered access log"""
+    print("\n🧪 Testing Metrics...")
+    import io
+    from metrics import AccessLog, Histogram
+    
+    histogram = Histogram(bounds=(0.01, 0.1, 1.0))
+    for _ in range(90):
+        histogram.observe(0.005)
+    for _ in range(10):
+        histogram.observe(0.5)
+    assert histogram.quantile(0.5) < 0.01 and 0.1 < histogram.quantile(0.99) <= 1.0
+    
+    stream = io.StringIO()
+    log = AccessLog(stream, flush_interval=0.01)
+    for i in range(100):
+        log.write(f"line {i}\n")
+    log.close()
+    assert stream.getvalue().count('\n') == 100
+    
+    def scrape(port):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        text = response.read().decode()
+        conn.close()
+        assert response.getheader('Content-Type').startswith('text/plain; version=0.0.4')
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+    
+    httpd, port = start_test_server()
+    try:
+        # Metrics are process-wide, so compare against a scrape taken first
+        before = scrape(port)
+        for path in ('/health', '/devices/hvac_001', '/devices/missing', '/no/such/path'):
+            get_json(port, path)
+        post_raw(port, '/telemetry/ingest', b'hvac_001,1700000000,2.5\nghost,1700000000,1\n', 'text/csv')
+        after = scrape(port)
+    finally:
+        stop_test_server(httpd)
+    
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+    
+    assert delta('energy_http_requests_total{route="/devices/{device_id}",method="GET",status="200"}') == 1
+    assert delta('energy_http_requests_total{route="/devices/{device_id}",method="GET",status="404"}') == 1
+    assert delta('energy_http_requests_total{route="unmatched",method="GET",status="404"}') == 1
+    assert delta('energy_http_request_duration_seconds_count{route="/health",method="GET"}') == 1
+    assert 'energy_http_request_duration_quantile_seconds{route="/health",method="GET",quantile="0.99"}' \
+        in after
+    assert after['energy_http_requests_in_flight{route="/metrics",method="GET"}'] == 1
+    assert delta('energy_ingest_readings_total{outcome="accepted"}') == 1
+    assert delta('energy_ingest_readings_total{outcome="rejected"}') == 1
+    assert 'energy_response_cache_hit_ratio' in after
+    
+    print("✅ Per-route counters, latency quantiles and gauges exposed for Prometheus")
+
+def test_request_profiler():
+    """Test sampled cProfile and stack profiling and the /debug/profile endpoint"""
+    print("\n🧪 Testing Request Profiler...")
+    from profiling import RequestProfiler
+    
+    def busy(seconds):
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            pass
+        return seconds
+    
+    profiler = RequestProfiler(interval=0.001)
+    assert profiler.call('/busy', busy, 0) == 0 and not profiler.status()['sampled_requests']
+    profiler.configure(enabled=True, mode='stack', sample_rate=1.0)
+    profiler.call('/busy', busy, 0.05)
+    profiler.configure(enabled=False)
+    lines = profiler.collapsed().splitlines()
+    assert lines and all(line.startswith('/busy;') for line in lines)
+    assert any('busy (test_system.py' in line for line in lines)
+    
+    httpd, port = start_test_server()
+    try:
+        settings = json.dumps({"enabled": True, "mode": "cprofile", "sample_rate": 1.0,
+                               "routes": ["/predictions"], "reset": True}).encode()
+        status, result = post_raw(port, '/debug/profile', settings, 'application/json')
+        assert status == 200 and result['enabled'] and result['routes'] == ['/predictions']
+        for hours in (6, 12, 24):
+            get_json(port, f'/predictions?hours={hours}')
+        get_json(port, '/health')
+        # Samples are merged after the response is written, so allow a moment
+        deadline = time.time() + 2
+        while True:
+            status, result = get_json(port, '/debug/profile?format=status')
+            if result['sampled_requests'] == {'/predictions': 3} or time.time() > deadline:
+                break
+            time.sleep(0.01)
+        assert result['sampled_requests'] == {'/predictions': 3}
+        
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/debug/profile?format=pstats&sort=tottime&limit=10')
+        response = conn.getresponse()
+        report = response.read().decode()
+        conn.close()
+        assert response.status == 200 and 'function calls' in report and 'predict' in report
+        
+        assert post_raw(port, '/debug/profile', b'{"sample_rate": 5}', 'application/json')[0] == 400
+        assert get_json(port, '/debug/profile?format=svg')[0] == 400
+        post_raw(port, '/debug/profile', b'{"enabled": false}', 'application/json')
+    finally:
+        stop_test_server(httpd)
+    
+    print("✅ Sampled requests aggregated into pstats and collapsed stacks")
+
+def test_load_harness():
+    """Test a short load test run and regression detection against a baseline"""
+    print("\n🧪 Testing Load Harness...")
+    from load_test import DEFAULT_MIX, compare, parse_mix, run_load_test
+    from simple_server import DEVICES
+    
+    devices_before = DEVICES.to_list()
+    report = run_load_test(fleet_sizes=(40, 200), clients=3, duration=0.5, warmup=0.1)
+    assert DEVICES.to_list() == devices_before
+    
+    assert [result['fleet_size'] for result in report['results']] == [40, 200]
+    for result in report['results']:
+        assert result['requests'] > 0 and result['errors'] == 0
+        assert result['latency_ms']['p50'] <= result['latency_ms']['p95'] <= result['latency_ms']['p99']
+        assert 'growth_during_run' in result['memory_mb']
+        assert set(result['endpoints']) <= set(DEFAULT_MIX)
+    json.dumps(report)
+    
+    assert compare(report, report) == []
+    slower = json.loads(json.dumps(report))
+    for result in slower['results']:
+        result['requests_per_second'] *= 2
+    regressions = compare(report, slower, max_regression=0.25)
+    assert {r['metric'] for r in regressions} == {'requests_per_second'}
+    assert parse_mix('metrics=0,predictions=50')['predictions'] == 50
+    assert 'metrics' not in parse_mix('metrics=0')
+    
+    print(f"✅ {sum(r['requests'] for r in report['results'])} requests across 2 fleet sizes without errors")
+
+def test_sites():
+    """Test per-site device state and routing to site shards"""
+    print("\n🧪 Testing Multi-Site State...")
+    import zlib
+    from sites import shard_for, site_for_request, split_site_path
+    from simple_server import DEVICES, TELEMETRY
+    
+    assert split_site_path('/sites/home-1/devices/sample') == ('home-1', '/devices/sample')
+    assert split_site_path('/sites/home-1') == ('home-1', '/')
+    assert site_for_request('/health', 'home-2') == ('home-2', '/health')
+    assert site_for_request('/health') == ('default', '/health')
+    assert shard_for('home-1', 4) == zlib.crc32(b'home-1') % 4 and shard_for('home-1', 1) == 0
+    
+    def add_device(port, site, name):
+        batch = {"operations": [{"op": "add", "device": {"device_name": name, "device_type": "hvac"}}]}
+        return post_raw(port, f'/sites/{site}/devices/batch', json.dumps(batch).encode(),
+                        'application/json')
+    
+    default_devices = DEVICES.to_list()
+    readings_before = TELEMETRY.total_readings
+    httpd, port = start_test_server()
+    try:
+        status, result = add_device(port, 'site-test-a', 'Heat Pump')
+        device_id = result['results'][0]['device_id']
+        assert status == 200
+        status, page = get_json(port, '/devices/sample', headers={'X-Site-Id': 'site-test-a'})
+        assert [device['device_id'] for device in page['devices']] == [device_id]
+        assert get_json(port, f'/sites/site-test-a/devices/{device_id}')[0] == 200
+        assert get_json(port, f'/devices/{device_id}')[0] == 404
+        assert DEVICES.to_list() == default_devices
+        
+        line = json.dumps({"device_id": device_id, "timestamp": time.time(), "power": 3.0}).encode()
+        status, result = post_raw(port, '/sites/site-test-a/telemetry/ingest', line,
+                                  'application/x-ndjson')
+        assert status == 200 and result['accepted'] == 1
+        assert TELEMETRY.total_readings == readings_before
+        
+        assert get_json(port, '/sites/site-test-missing/devices/sample')[0] == 404
+        assert get_json(port, '/devices/sample', headers={'X-Site-Id': '../etc'})[0] == 400
+    finally:
+        stop_test_server(httpd)
+    print("✅ Sites kept separate devices and telemetry")
+    
+    if not hasattr(os, 'fork'):
+        return
+    # Two sites owned by different shards, reached through the coordinator
+    sites = ['site-test-b']
+    sites.append(next(f'site-test-{i}' for i in range(100)
+                      if shard_for(f'site-test-{i}', 2) != shard_for(sites[0], 2)))
+    httpd, port = start_test_server('sharded', workers=2)
+    try:
+        for site in sites:
+            assert add_device(port, site, f'{site} meter')[0] == 200
+        for site in sites:
+            status, page = get_json(port, '/devices/sample', headers={'X-Site-Id': site})
+            names = [device['device_name'] for device in page['devices']]
+            assert status == 200 and names == [f'{site} meter']
+        assert get_json(port, '/health')[0] == 200
+        
+        # Ambiguous body framing is refused before anything reaches a shard
+        import socket
+        for framing in (b'Content-Length: -5', b'Content-Length: +5',
+                        b'Content-Length: 5\r\nContent-Length: 6',
+                        b'Content-Length: 5\r\nTransfer-Encoding: chunked'):
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                sock.sendall(b'POST /devices/batch HTTP/1.1\r\nHost: x\r\n' + framing + b'\r\n\r\nhello')
+                assert read_until(sock, b'\r\n').startswith(b'HTTP/1.1 400'), framing
+    finally:
+        stop_test_server(httpd)
+    print("✅ Coordinator routed each site to its own shard")
+
+def test_startup():
+    """Test metadata-only dependency checks and the /health readiness signal"""
+    print("\n🧪 Testing Startup and Readiness...")
+    import simple_server
+    from start_server import check_dependencies, missing_packages
+    
+    assert missing_packages(['numpy', 'no-such-package-energy']) == ['no-such-package-energy']
+    assert check_dependencies(['numpy'], install=False)
+    assert not check_dependencies(['no-such-package-energy'], install=False)
+    
+    httpd, port = start_test_server()
+    try:
+        simple_server.WARMING.set()
+        status, health = get_json(port, '/health')
+        assert status == 503 and health['ready'] is False and health['status'] == 'warming'
+        simple_server.warm_up()
+        status, health = get_json(port, '/health')
+        assert status == 200 and health['ready'] is True and 'warmup' in health['startup_ms']
+    finally:
+        simple_server.WARMING.clear()
+        stop_test_server(httpd)
+    print("✅ /health reported warming, then ready")
+
+def test_admission():
+    """Test per-route slots, load shedding and request body limits"""
+    print("\n🧪 Testing Admission Control...")
+    import io
+    import socket
+    from admission import AdmissionController, BodyLimitError, LimitedReader, Overloaded
+    from simple_server import ADMISSION
+    
+    controller = AdmissionController(max_concurrent=4, max_queue=4, queue_timeout=0.05,
+                                     route_limits={'/slow': 1})
+    holding = threading.Event()
+    release = threading.Event()
+    
+    def hold(route):
+        with controller.slot(route):
+            holding.set()
+            release.wait(5)
+    
+    holder = threading.Thread(target=hold, args=('/slow',))
+    holder.start()
+    holding.wait(5)
+    try:
+        with controller.slot('/slow'):
+            assert False, "second /slow request was admitted"
+    except Overloaded as e:
+        assert e.status == 503 and e.retry_after >= 1
+    with controller.slot('/health'):
+        pass  # Priority routes never wait
+    with controller.slot('/other'):
+        pass
+    release.set()
+    holder.join()
+    with controller.slot('/slow'):
+        pass
+    assert controller.stats()['routes']['/slow']['rejected'] == {503: 1}
+    
+    reader = LimitedReader(io.BytesIO(b'x' * 100), 10, time.monotonic() + 5)
+    try:
+        reader.read()
+        assert False, "oversized body was read"
+    except BodyLimitError as e:
+        assert e.status == 413
+    
+    httpd, port = start_test_server()
+    saved = (ADMISSION.route_limits['/optimize'], ADMISSION.queue_timeout,
+             ADMISSION.body_limits['/telemetry/ingest'])
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('POST', '/devices/add', body=b'{}', headers={'Content-Length': str(64 * 1024 * 1024)})
+        response = conn.getresponse()
+        assert response.status == 413 and response.getheader('Connection') == 'close'
+        conn.close()
+        
+        # Chunked bodies are cut off once they pass the limit
+        ADMISSION.body_limits['/telemetry/ingest'] = 64
+        line = json.dumps({"device_id": "hvac_001", "timestamp": 0, "power": 1.0}).encode() + b'\n'
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall(b'POST /telemetry/ingest HTTP/1.1\r\nHost: test\r\nTransfer-Encoding: chunked\r\n'
+                     b'Content-Type: application/x-ndjson\r\n\r\n'
+                     + b'%x\r\n%s\r\n' % (len(line), line) * 10 + b'0\r\n\r\n')
+        assert read_until(sock, b'\r\n\r\n').startswith(b'HTTP/1.1 413')
+        sock.close()
+        
+        ADMISSION.configure(route_limits={'/optimize': 1}, queue_timeout=0.05)
+        with ADMISSION.slot('/optimize'):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('POST', '/optimize', body=b'{}', headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            assert response.status == 503 and response.getheader('Retry-After') == '1'
+            conn.close()
+            assert get_json(port, '/health')[0] == 200
+        assert post_raw(port, '/optimize', b'{}', 'application/json')[0] == 200
+    finally:
+        ADMISSION.body_limits['/telemetry/ingest'] = saved[2]
+        ADMISSION.configure(route_limits={'/optimize': saved[0]}, queue_timeout=saved[1])
+        stop_test_server(httpd)
+    print("✅ Oversized bodies got 413 and a busy route shed load while /health answered")
+
+def test_simulator():
+    """Test the seedable fleet simulator, its .npz output and a replay into a site"""
+    print("\n🧪 Testing Fleet Simulator...")
+    import io
+    import tracemalloc
+    import numpy as np
+    from simple_server import DEVICES, SITES
+    from simulator import DEVICE_TYPES, Fleet, iter_npz_readings, load_npz, replay, save_npz, week_origin
+    from telemetry import iter_binary
+    
+    fleet = Fleet(2000, seed=5)
+    again = Fleet(2000, seed=5)
+    assert np.array_equal(fleet.rated_power, again.rated_power)
+    assert not np.array_equal(fleet.rated_power, Fleet(2000, seed=6).rated_power)
+    assert {device['device_type'] for device in fleet.devices()} == set(DEVICE_TYPES)
+    
+    # A Monday of readings: same seed, same numbers; lighting peaks in the evening
+    monday = week_origin(time.time()) + 7 * 86400
+    hours = monday + np.arange(24) * 3600.0
+    power = fleet.power(hours)
+    assert power.shape == (24, 2000) and power.dtype == np.float32 and (power >= 0).all()
+    assert np.array_equal(power, again.power(hours))
+    lighting = (fleet.device_type == DEVICE_TYPES.index('lighting')) & fleet.is_active
+    assert power[20, lighting].mean() > 3 * power[3, lighting].mean()
+    
+    readings = list(iter_binary(io.BytesIO(fleet.encode_binary(hours[:1], 10, power[:1, 10:13]))))
+    assert [r[0] for r in readings] == ['sim_0000010', 'sim_0000011', 'sim_0000012']
+    assert readings[0][2] == float(power[0, 10])
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fleet.npz')
+        assert save_npz(path, fleet, monday, 6, 600) == 12000
+        columns = load_npz(path)
+        assert columns['power'].shape == (6, 2000)
+        assert np.array_equal(columns['device_type'], fleet.device_type)
+        first = next(iter_npz_readings(columns, chunk=100))
+        assert len(first) == 100 and first[0] == ('sim_0000000', monday, float(columns['power'][0, 0]))
+        # Readings do not depend on how devices and times are chunked
+        for timestamps, offset, block in fleet.iter_blocks(monday, 6, 600, chunk=700):
+            step = int((timestamps[0] - monday) // 600)
+            assert np.array_equal(block[0], columns['power'][step, offset:offset + block.shape[1]])
+        
+        # The power matrix is streamed, never held whole: 20 steps x 200k devices is 16 MB
+        large = Fleet(200000, seed=3)
+        tracemalloc.start()
+        save_npz(os.path.join(tmp, 'large.npz'), large, monday, 20, 600)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert peak < 8 * 1024 * 1024, peak
+    
+    default_devices = DEVICES.to_list()
+    httpd, port = start_test_server()
+    try:
+        small = Fleet(300, seed=1)
+        report = replay('127.0.0.1', port, small, rate=20000, steps=3, step_seconds=600, batch=128,
+                        connections=2, site='sim-test')
+        assert report['registered'] == 300 and report['errors'] == 0
+        assert report['readings_sent'] == report['accepted'] == 900 and report['rejected'] == 0
+        site = SITES.get('sim-test', create=False)
+        assert len(site.devices.to_list()) == 300
+        assert DEVICES.to_list() == default_devices
+    finally:
+        stop_test_server(httpd)
+    print(f"✅ Deterministic fleet, .npz round trip and {report['accepted']} readings replayed "
+          f"at {report['achieved_rate']:.0f}/s")
+
+def test_anomaly_detection():
+    """Test streaming anomaly alerts, /anomalies and their place in /optimize"""
+    print("\n🧪 Testing Anomaly Detection...")
+    import math
+    import numpy as np
+    from anomaly import AnomalyDetector
+    from device_registry import DeviceRegistry
+    from simulator import DEVICE_TYPES, Fleet, replay, week_origin
+    
+    fleet = Fleet(60, seed=4)
+    origin = week_origin(time.time()) - 14 * 86400
+    lights = [i for i in range(fleet.size)
+              if fleet.is_active[i] and DEVICE_TYPES[fleet.device_type[i]] == 'lighting']
+    device_id = fleet.device_ids()[lights[0]]
+    rated = float(fleet.rated_power[lights[0]])
+    night = origin + 8 * 86400 + 3 * 3600
+    stuck = [(device_id, night + i * 900, rated) for i in range(4)]
+    
+    # Eight days of ordinary readings, then the lights stay on at 3am
+    detector = AnomalyDetector(DeviceRegistry(fleet.devices()))
+    for readings in fleet.iter_readings(origin, 8 * 96, 900):
+        detector.observe(readings)
+    assert detector.stats()['readings_total'] == 60 * 8 * 96
+    assert not detector.alerts(device_id=device_id)
+    detector.observe(stuck)
+    alert = detector.alerts(device_id=device_id)[0]
+    assert alert['kind'] == 'high_usage' and alert['readings'] >= 3 and alert['power'] > alert['expected']
+    action, fraction = detector.boosts()[device_id]
+    assert action == 'turn_off_lights' and 0.5 < fraction <= 1.0
+    normal = fleet.power(night + 3600 + np.arange(4) * 900, lights[0], lights[0] + 1)[:, 0]
+    detector.observe([(device_id, night + 3600 + i * 900, float(p)) for i, p in enumerate(normal)])
+    assert not detector.alerts(device_id=device_id) and device_id not in detector.boosts()
+    assert detector.alerts(status='resolved', device_id=device_id)[0]['alert_id'] == alert['alert_id']
+    
+    # Several readings per device in one batch are applied in order
+    ordered = AnomalyDetector(DeviceRegistry(fleet.devices()))
+    flat = [r for readings in fleet.iter_readings(origin, 2 * 96, 900) for r in readings]
+    ordered.observe(sorted(flat, key=lambda r: (r[0], r[1])))
+    assert ordered.stats()['readings_total'] == len(flat)
+    
+    # 100k readings from a 5k-device fleet, well inside a second
+    large = Fleet(5000, seed=1)
+    batches = list(large.iter_readings(origin, 20, 900))
+    timed = AnomalyDetector(DeviceRegistry(large.devices()))
+    started = time.perf_counter()
+    for readings in batches:
+        timed.observe(readings)
+    elapsed = time.perf_counter() - started
+    assert timed.stats()['readings_total'] == 100000 and elapsed < 1.0
+    
+    # 100k readings of one device, ingested through the detector, also inside a second
+    from telemetry import TelemetryBuffer, ingest_stream
+    registry = DeviceRegistry(fleet.devices())
+    history = AnomalyDetector(registry)
+    buffer = TelemetryBuffer()
+    buffer.add_listener(history.observe)
+    readings = [(device_id, origin - (100000 - i) * 60.0, 1.0 + 0.1 * math.sin(i)) for i in range(100000)]
+    started = time.perf_counter()
+    result = ingest_stream(iter(readings), registry, buffer)
+    single_elapsed = time.perf_counter() - started
+    assert result['accepted'] == 100000 and history.stats()['readings_total'] == 100000
+    assert single_elapsed < 1.0, single_elapsed
+    
+    httpd, port = start_test_server()
+    try:
+        report = replay('127.0.0.1', port, fleet, rate=10 ** 6, start_time=origin, steps=8 * 96,
+                        step_seconds=900, site='anomaly-test')
+        assert report['errors'] == 0
+        body = '\n'.join(f"{d},{t},{p}" for d, t, p in stuck).encode()
+        assert post_raw(port, '/sites/anomaly-test/telemetry/ingest', body, 'text/csv')[0] == 200
+        status, result = get_json(port, f'/sites/anomaly-test/anomalies?device_id={device_id}')
+        assert status == 200 and result['count'] == 1 and result['anomalies'][0]['device_type'] == 'lighting'
+        status, result = post_raw(port, '/sites/anomaly-test/optimize', json.dumps({'top_k': 1}),
+                                  'application/json')
+        top = result['recommendations'][0]
+        assert top['device_id'] == device_id and top['recommended_action'] == 'turn_off_lights'
+        assert get_json(port, '/anomalies?status=open')[0] == 400
+        assert 'active' in get_json(port, '/anomalies')[1]
+    finally:
+        stop_test_server(httpd)
+    print(f"✅ Stuck lighting flagged, resolved and recommended first; one device at "
+          f"{100000 / single_elapsed / 1000:.0f}k readings/s, "
+          f"100k readings in {elapsed * 1000:.0f}ms")
+
+def test_command_dispatch():
+    """Test background device commands: coalescing, gateway batches, retries and /commands"""
+    print("\n🧪 Testing Command Dispatch...")
+    from commands import CommandDispatcher, StubTransport
+    from simple_server import SITES
+    
+    class GatedTransport(StubTransport):
+        def __init__(self):
+            super().__init__()
+            self.gate = threading.Event()
+            self.entered = threading.Event()
+        
+        def send(self, site_id, gateway, commands):
+            self.entered.set()
+            self.gate.wait(5)
+            return super().send(site_id, gateway, commands)
+    
+    transport = GatedTransport()
+    dispatcher = CommandDispatcher(transport, max_batch=100, max_attempts=3, backoff_base=0.01,
+                                   backoff_max=0.02)
+    try:
+        lamp = {'device_id': 'lamp', 'location': 'kitchen'}
+        first = dispatcher.submit('default', lamp, 'eco_mode')
+        assert transport.entered.wait(5)  # In flight, so later commands wait behind it
+        on = dispatcher.submit('default', lamp, 'toggle')
+        off = dispatcher.submit('default', lamp, 'toggle')
+        assert off['status'] == 'coalesced' and off['coalesced_with'] == on['command_id']
+        assert dispatcher.get(on['command_id'])['status'] == 'coalesced'
+        dim = dispatcher.submit('default', lamp, 'dim_lights', {'level': 50})
+        dim = dispatcher.submit('default', lamp, 'dim_lights', {'level': 20})
+        assert dispatcher.stats()['pending'] == 2
+        
+        fleet = [{'device_id': f'dev_{i}', 'location': ('kitchen', 'garage', 'office')[i % 3]}
+                 for i in range(600)]
+        submitted = dispatcher.submit_many('default', [(device, 'eco_mode', None) for device in fleet])
+        transport.gate.set()
+        assert dispatcher.wait(10)
+        assert dispatcher.get(first['command_id'])['status'] == 'delivered'
+        delivered = [(command['action'], command['params']) for _, _, batch in transport.batches
+                     for command in batch if command['device_id'] == 'lamp']
+        assert delivered == [('eco_mode', {}), ('dim_lights', {'level': 20})]
+        assert all(len(batch) <= 100 for _, _, batch in transport.batches)
+        assert all(dispatcher.get(command['command_id'])['status'] == 'delivered' for command in submitted)
+        assert transport.delivered == 602
+        
+        # An unreachable gateway is retried with backoff, then given up on
+        transport.unreachable.add('garage')
+        failing = dispatcher.submit('default', {'device_id': 'door', 'location': 'garage'}, 'lock')
+        assert dispatcher.wait(5)
+        failed = dispatcher.get(failing['command_id'])
+        assert failed['status'] == 'failed' and failed['attempts'] == 3 and 'unreachable' in failed['error']
+        assert dispatcher.stats()['totals']['retries'] == 2
+        
+        transport.gate.clear()
+        transport.entered.clear()
+        transport.unreachable.clear()
+        dispatcher.submit('default', lamp, 'eco_mode')
+        assert transport.entered.wait(5)
+        queued = dispatcher.submit('default', lamp, 'toggle')
+        assert dispatcher.cancel_device('default', 'lamp') == 1
+        assert dispatcher.get(queued['command_id'])['status'] == 'cancelled'
+        transport.gate.set()
+    finally:
+        transport.gate.set()
+        dispatcher.close()
+    
+    httpd, port = start_test_server()
+    try:
+        status, result = post_raw(port, '/devices/toggle', json.dumps({'device_id': 'lighting_001'}),
+                                  'application/json')
+        command_id = result['command']['command_id']
+        assert status == 200 and result['command']['action'] == 'toggle'
+        post_raw(port, '/devices/toggle', json.dumps({'device_id': 'lighting_001'}), 'application/json')
+        assert SITES.commands.wait(5)
+        status, result = get_json(port, f'/commands/{command_id}')
+        assert status == 200 and result['command']['status'] in ('delivered', 'coalesced')
+        assert get_json(port, f'/sites/other-site/commands/{command_id}')[0] == 404
+        assert get_json(port, '/commands/missing')[0] == 404
+        
+        status, result = post_raw(port, '/commands', json.dumps(
+            {'commands': [{'device_id': 'hvac_001', 'action': 'eco_mode', 'params': {'setpoint': 21}}]}),
+            'application/json')
+        assert status == 202 and result['commands'][0]['status'] in ('queued', 'sending', 'delivered')
+        bad = {'commands': [{'device_id': 'hvac_001', 'action': 'eco_mode'},
+                            {'device_id': 'nope', 'action': 'x'}]}
+        status, result = post_raw(port, '/commands', json.dumps(bad), 'application/json')
+        assert status == 400 and result['errors'][0]['index'] == 1
+        
+        status, result = post_raw(port, '/optimize', json.dumps({'top_k': 2, 'apply': True}),
+                                  'application/json')
+        commands = result['commands']
+        assert status == 200 and len(commands) == len(result['recommendations']) == 2
+        assert [c['device_id'] for c in commands] == [r['device_id'] for r in result['recommendations']]
+        assert SITES.commands.wait(5)
+        assert get_json(port, f"/commands/{commands[0]['command_id']}")[1]['command']['status'] == 'delivered'
+    finally:
+        stop_test_server(httpd)
+    print("✅ Toggle pairs cancelled, 600 commands batched per gateway, failures retried with backoff")
 
 def main():
     """Main test function"""
@@ -138,7 +1646,41 @@ def main():
     
     try:
         # Run all tests
-        api_data = test_frontend_data()
+        test_energy_prediction()
+        test_device_optimization()
+        test_analytics()
+        test_frontend_data()
+        test_server_modes()
+        test_device_registry()
+        test_energy_store()
+        test_telemetry_ingest()
+        test_prediction_engine()
+        test_response_cache()
+        test_optimization_engine()
+        test_load_scheduler()
+        test_analytics_rollups()
+        test_telemetry_export()
+        test_router()
+        test_static_assets()
+        test_stream_hub()
+        test_device_pagination()
+        test_device_batch()
+        test_serialization()
+        test_metrics()
+        test_request_profiler()
+        test_load_harness()
+        test_sites()
+        test_startup()
+        test_admission()
+        test_simulator()
+        test_anomaly_detection()
+        test_command_dispatch()
+        
+        httpd, port = start_test_server()
+        try:
+            api_data = fetch_dashboard_data(port)
+        finally:
+            stop_test_server(httpd)
         
         print("\n" + "=" * 60)
         print("✅ ALL TESTS PASSED!")